@@ -0,0 +1,84 @@
+# encoding: utf8
+
+import os
+import sys
+sys.path.append(os.getcwd())
+import socket
+import struct
+import timeit
+from ctypes import POINTER, c_void_p, c_float, c_size_t, create_string_buffer
+from macdivert import binding
+from macdivert.emulator import Emulator, DelayPipe
+from macdivert.pool import BufferPool
+
+__author__ = 'huangyan13@baidu.com'
+
+
+def make_packet(payload_len=512):
+    return struct.pack('!BBHHHBBH4s4s', 0x45, 0, 20 + payload_len, 0, 0, 64,
+                       socket.IPPROTO_UDP, 0, socket.inet_aton('10.0.0.1'),
+                       socket.inet_aton('10.0.0.2')) + '\x00' * payload_len
+
+
+def bench(func, number):
+    return min(timeit.repeat(func, number=number, repeat=3)) / number * 1e9
+
+
+def legacy_delay_pipe(lib, delay_time, t):
+    """
+    What DelayPipe.__init__ did before prototypes were declared once
+    """
+    setattr(getattr(lib, 'delay_pipe_create'), "argtypes",
+            [c_void_p, c_void_p, c_size_t, POINTER(c_float), POINTER(c_float), c_size_t])
+    setattr(getattr(lib, 'delay_pipe_create'), "restype", c_void_p)
+    arr_type = c_float * len(delay_time)
+    return lib.delay_pipe_create(None, None, len(delay_time), arr_type(*list(t)),
+                                 arr_type(*list(delay_time)), 8172)
+
+
+def work(lib_path, number):
+    lib = binding.load_library(lib_path)
+    binding.bind_emulator(lib)
+    # pipes only need the library reference, no emulator is created
+    Emulator.libdivert_ref = lib
+    handle = lib.divert_create(0, 0)
+    ip_data = make_packet()
+    sockaddr = '\x10\x02' + '\x00' * 14
+    pool_data = create_string_buffer(ip_data, 2048)
+    pool_addr = create_string_buffer(sockaddr, 16)
+
+    ctypes_reinject = lib.divert_reinject
+    fast_reinject = binding.reinject_function(lib, handle)
+    pool = BufferPool(16)
+    pool.data_buffers[0].raw = pool_data.raw
+    slot_reinject = binding.slot_reinject_function(lib, handle, pool)
+    results = [
+        ('ctypes divert_reinject str', bench(
+            lambda: ctypes_reinject(handle, ip_data, -1, sockaddr), number)),
+        ('ctypes divert_reinject buffer', bench(
+            lambda: ctypes_reinject(handle, pool_data, -1, pool_addr), number)),
+        ('%s reinject str' % ('cffi' if binding.cffi else 'ctypes closure'), bench(
+            lambda: fast_reinject(ip_data, sockaddr), number)),
+        ('%s reinject buffer' % ('cffi' if binding.cffi else 'ctypes closure'), bench(
+            lambda: fast_reinject(pool_data, pool_addr), number)),
+        ('%s reinject pool slot' % ('cffi' if binding.cffi else 'ctypes closure'), bench(
+            lambda: slot_reinject(0), number)),
+    ]
+    # pipes are leaked by both variants, so create fewer of them
+    t = range(10)
+    delay_time = [0.1] * 10
+    results += [
+        ('pipe create, argtypes per call', bench(
+            lambda: legacy_delay_pipe(lib, delay_time, t), number / 10)),
+        ('pipe create, declared once', bench(
+            lambda: DelayPipe(delay_time, t), number / 10)),
+    ]
+    for name, cost in results:
+        print '%-36s %10.1f ns' % (name, cost)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print 'Usage: python binding_bench.py <libdivert_path> [number]'
+    else:
+        work(sys.argv[1], int(sys.argv[2]) if len(sys.argv) > 2 else 100000)
@@ -0,0 +1,102 @@
+# encoding: utf8
+
+import os
+import sys
+sys.path.append(os.getcwd())
+import socket
+import struct
+import timeit
+from copy import deepcopy
+from ctypes import pointer, create_string_buffer
+from macdivert import macdivert
+from macdivert.enum import Defaults
+from macdivert.models import ProcInfo
+from macdivert.proccache import ProcCache
+from macdivert.backend import PythonDivert
+
+__author__ = 'huangyan13@baidu.com'
+
+
+class LegacyProcCache(ProcCache):
+    """
+    What ip_callback did before process information was interned
+    """
+
+    def get(self, proc_info):
+        if proc_info[0].pid != -1 or proc_info[0].epid != -1:
+            return deepcopy(proc_info[0])
+        return None
+
+
+def make_packet(payload_len=512):
+    tcp = struct.pack('!HHIIBBHHH', 54321, 80, 1, 1, 5 << 4, 0x18, 65535, 0, 0)
+    ip = struct.pack('!BBHHHBBH4s4s', 0x45, 0, 40 + payload_len, 0, 0,
+                     64, socket.IPPROTO_TCP, 0, socket.inet_aton('10.0.0.1'),
+                     socket.inet_aton('10.0.0.2'))
+    return ip + tcp + '\x00' * payload_len
+
+
+def create_handle(cache_type):
+    # the handle looks up ProcCache from its module when created
+    macdivert.ProcCache = cache_type
+    try:
+        return macdivert.DivertHandle(PythonDivert())
+    finally:
+        macdivert.ProcCache = ProcCache
+
+
+def bench(func, number):
+    return min(timeit.repeat(func, number=number, repeat=3)) / number * 1e9
+
+
+def work(number):
+    ip_buf = create_string_buffer(make_packet(), Defaults.PACKET_BUF_SIZE)
+    addr_buf = create_string_buffer('\x10\x02' + '\x00' * 14, Defaults.SOCKET_ADDR_SIZE)
+    # name: list of process information, used in turn
+    cases = [
+        ('one process', [ProcInfo(1234, 1234, 'Safari')]),
+        ('64 processes', [ProcInfo(pid, pid, 'proc%d' % pid) for pid in xrange(1000, 1064)]),
+        ('unknown process', [ProcInfo(-1, -1, '')]),
+    ]
+    print '%-34s %12s %12s %8s' % ('case', 'deepcopy', 'interned', 'speedup')
+    for name, infos in cases:
+        pointers = [pointer(info) for info in infos]
+        num_ptr = len(pointers)
+        costs = []
+        for cache_type in (LegacyProcCache, ProcCache):
+            cache = cache_type()
+            state = [0]
+
+            def lookup():
+                state[0] += 1
+                return cache.get(pointers[state[0] % num_ptr])
+            costs.append(bench(lookup, number))
+        print '%-34s %9.1f ns %9.1f ns %7.2fx' % (
+            'proc info, ' + name, costs[0], costs[1], costs[0] / costs[1])
+    for name, infos in cases:
+        pointers = [pointer(info) for info in infos]
+        num_ptr = len(pointers)
+        costs = []
+        for cache_type in (LegacyProcCache, ProcCache):
+            handle = create_handle(cache_type)
+            callback = handle.ip_callback
+            queue = handle.packet_queue
+            state = [0]
+
+            def run():
+                state[0] += 1
+                callback(None, pointers[state[0] % num_ptr], ip_buf, addr_buf)
+
+            def drain():
+                while queue.get_batch(1024, timeout=0):
+                    pass
+            costs.append(min(timeit.repeat(run, setup=drain, number=number, repeat=3))
+                         / number * 1e9)
+            drain()
+            handle.close()
+        print '%-34s %9.1f ns %9.1f ns %7.2fx' % (
+            'ip_callback, ' + name, costs[0], costs[1], costs[0] / costs[1])
+
+
+if __name__ == '__main__':
+    work(int(sys.argv[1]) if len(sys.argv) > 1 else 100000)
@@ -0,0 +1,111 @@
+# encoding: utf8
+
+import os
+import sys
+sys.path.append(os.getcwd())
+import socket
+import struct
+import timeit
+from macdivert.macdivert import Packet
+
+__author__ = 'huangyan13@baidu.com'
+
+
+class LegacyPacket:
+    """
+    The dict-backed Packet before __slots__, kept for comparison
+    """
+    def __init__(self):
+        self.proc = None
+        self.ip_data = None
+        self.sockaddr = None
+        self.valid = False
+        self.flag = 0
+
+
+def make_tcp_packet(payload_len=512):
+    tcp = struct.pack('!HHIIBBHHH', 54321, 80, 1, 1, 5 << 4, 0x18, 65535, 0, 0)
+    ip = struct.pack('!BBHHHBBH4s4s', 0x45, 0, 20 + len(tcp) + payload_len, 0, 0,
+                     64, socket.IPPROTO_TCP, 0, socket.inet_aton('10.0.0.1'),
+                     socket.inet_aton('10.0.0.2'))
+    return ip + tcp + '\x00' * payload_len
+
+
+def object_size(obj):
+    size = sys.getsizeof(obj)
+    if hasattr(obj, '__dict__'):
+        size += sys.getsizeof(obj.__dict__)
+    return size
+
+
+def struct_decode(ip_data):
+    """
+    What consumers had to do to get the 5-tuple of a packet
+    """
+    proto = ord(ip_data[9])
+    src, dst = socket.inet_ntoa(ip_data[12:16]), socket.inet_ntoa(ip_data[16:20])
+    header_len = (ord(ip_data[0]) & 0x0f) * 4
+    sport, dport = struct.unpack_from('!HH', ip_data, header_len)
+    return proto, src, dst, sport, dport
+
+
+def bench(func, number):
+    return min(timeit.repeat(func, number=number, repeat=3)) / number * 1e9
+
+
+def work(number):
+    ip_data = make_tcp_packet()
+
+    for cls in (LegacyPacket, Packet):
+        packet = cls()
+        packet.ip_data = ip_data
+        print '%-14s %4d bytes per packet object' % (cls.__name__, object_size(packet))
+
+    def create_legacy():
+        packet = LegacyPacket()
+        packet.ip_data = ip_data
+
+    def create_slotted():
+        # as done by capture callback, header is not decoded
+        Packet(ip_data)
+
+    def create_access():
+        packet = Packet(ip_data)
+        return packet.proto, packet.src, packet.dst, packet.sport, packet.dport
+
+    def legacy_access():
+        packet = LegacyPacket()
+        packet.ip_data = ip_data
+        return struct_decode(packet.ip_data)
+
+    cached = Packet(ip_data)
+
+    def cached_access():
+        return cached.proto, cached.src, cached.dst, cached.sport, cached.dport
+
+    results = [
+        ('create LegacyPacket', bench(create_legacy, number)),
+        ('create Packet', bench(create_slotted, number)),
+        ('LegacyPacket + struct decode', bench(legacy_access, number)),
+        ('Packet + 5-tuple first access', bench(create_access, number)),
+        ('Packet 5-tuple cached access', bench(cached_access, number)),
+    ]
+    try:
+        from impacket import ImpactDecoder
+        decoder = ImpactDecoder.IPDecoder()
+
+        def impacket_decode():
+            ip_packet = decoder.decode(ip_data)
+            tcp_packet = ip_packet.child()
+            return (ip_packet.get_ip_p(), ip_packet.get_ip_src(), ip_packet.get_ip_dst(),
+                    tcp_packet.get_th_sport(), tcp_packet.get_th_dport())
+        results.append(('impacket decode', bench(impacket_decode, number / 10)))
+    except ImportError:
+        pass
+
+    for name, cost in results:
+        print '%-30s %10.1f ns' % (name, cost)
+
+
+if __name__ == '__main__':
+    work(int(sys.argv[1]) if len(sys.argv) > 1 else 100000)
@@ -0,0 +1,248 @@
+# encoding: utf8
+
+import os
+import sys
+sys.path.append(os.getcwd())
+import gc
+import json
+import time
+import socket
+import struct
+import platform
+import resource
+import subprocess
+from ctypes import pointer, create_string_buffer
+from macdivert.enum import Defaults
+from macdivert.backend import PythonLib, PythonDivert
+try:
+    import tracemalloc
+except ImportError:
+    # only in Python 3, or Python 2 patched for pytracemalloc
+    tracemalloc = None
+
+__author__ = 'huangyan13@baidu.com'
+
+
+# name: (pool_size, ring_size, batch_size, latency)
+CASES = [
+    ('queue read', (0, 0, 1, False)),
+    ('queue read_batch', (0, 0, 64, False)),
+    ('ring read_batch', (0, Defaults.RING_CAPACITY, 64, False)),
+    ('pool read_batch', (Defaults.BUFFER_POOL_SIZE, 0, 64, False)),
+    ('pool+ring read_batch', (Defaults.BUFFER_POOL_SIZE, Defaults.RING_CAPACITY, 64, False)),
+    ('queue read_batch latency', (0, 0, 64, True)),
+]
+
+SIZES = [64, 576, 1500]
+
+
+def make_packet(size):
+    payload_len = max(size - 40, 0)
+    tcp = struct.pack('!HHIIBBHHH', 54321, 80, 1, 1, 5 << 4, 0x18, 65535, 0, 0)
+    ip = struct.pack('!BBHHHBBH4s4s', 0x45, 0, 40 + payload_len, 0, 0,
+                     64, socket.IPPROTO_TCP, 0, socket.inet_aton('10.0.0.1'),
+                     socket.inet_aton('10.0.0.2'))
+    return ip + tcp + '\x00' * payload_len
+
+
+class StubLib(PythonLib):
+    """
+    libdivert stub which calls the callback with the same buffers again and
+    again like the receive buffer of C library, and only counts reinjected packets
+    """
+
+    def __init__(self, ip_data, number, pid=1234, comm='bench'):
+        super(StubLib, self).__init__((), None, pid=pid, comm=comm)
+        self.number = number
+        self.ip_buf = create_string_buffer(ip_data, Defaults.PACKET_BUF_SIZE)
+        self.addr_buf = create_string_buffer(self._sockaddr(ip_data), Defaults.SOCKET_ADDR_SIZE)
+
+    def divert_loop(self, handle, count):
+        raw = handle.contents
+        raw.is_looping = 1
+        handle.stopped = False
+        handle.stop_event.clear()
+        callback, args = handle.callback, handle.args
+        proc_ptr = pointer(self.proc_info)
+        ip_buf, addr_buf = self.ip_buf, self.addr_buf
+        for _ in xrange(self.number):
+            if handle.stopped:
+                break
+            callback(args, proc_ptr, ip_buf, addr_buf)
+        raw.num_diverted += self.number
+        self._wait_stopped(handle)
+        raw.is_looping = 0
+        return 0
+
+    def divert_reinject(self, handle, ip_data, length, sockaddr):
+        handle.num_reinjected += 1
+        return length
+
+
+class StubDivert(PythonDivert):
+    def __init__(self, ip_data, number):
+        super(StubDivert, self).__init__()
+        self._lib = StubLib(ip_data, number)
+
+
+# what allocated() counts, objects tracked by garbage collector
+# miss str and buffer copies of packet data
+if hasattr(sys, 'getallocatedblocks'):
+    ALLOCATION_UNIT = 'blocks'
+elif tracemalloc is not None:
+    ALLOCATION_UNIT = 'traced blocks'
+else:
+    ALLOCATION_UNIT = 'gc objects'
+
+# column header of allocations in the table
+ALLOCATION_COLUMN = {
+    'blocks': 'blocks/pkt',
+    'traced blocks': 'blocks/pkt',
+    'gc objects': 'gcobj/pkt',
+}[ALLOCATION_UNIT]
+
+
+def allocated():
+    """
+    Allocated memory blocks if the interpreter could tell,
+    otherwise objects tracked by garbage collector, see ALLOCATION_UNIT
+    """
+    if ALLOCATION_UNIT == 'blocks':
+        return sys.getallocatedblocks()
+    if ALLOCATION_UNIT == 'traced blocks':
+        return len(tracemalloc.take_snapshot().traces)
+    return len(gc.get_objects())
+
+
+def peak_rss_kb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # bytes on Mac OS, kilobytes on Linux
+    return peak / 1024 if sys.platform == 'darwin' else peak
+
+
+def drain(handle, number, batch_size):
+    written = 0
+    if batch_size > 1:
+        while written < number:
+            batch = handle.read_batch(batch_size, timeout=1.0)
+            if not batch:
+                break
+            for packet in batch:
+                handle.write(packet)
+            written += len(batch)
+    else:
+        while written < number:
+            handle.write(handle.read(timeout=1.0))
+            written += 1
+    return written
+
+
+def count_allocations(ip_data, options, number):
+    """
+    Allocations retained per packet between callback and write, measured
+    with the capture finished before the consumer starts
+    """
+    pool_size, ring_size, batch_size, latency = options
+    # all packets are held at once
+    if pool_size:
+        pool_size = max(pool_size, number)
+    if ring_size:
+        ring_size = max(ring_size, number)
+    divert = StubDivert(ip_data, number)
+    gc.collect()
+    gc.disable()
+    if ALLOCATION_UNIT == 'traced blocks':
+        tracemalloc.start()
+    try:
+        handle = divert.open_handle(pool_size=pool_size, ring_size=ring_size, latency=latency)
+        while handle.packet_queue.qsize() < number:
+            time.sleep(0.001)
+        before = allocated()
+        drain(handle, number, batch_size)
+        after = allocated()
+        handle.close()
+        return float(before - after) / number
+    finally:
+        if ALLOCATION_UNIT == 'traced blocks':
+            tracemalloc.stop()
+        gc.enable()
+
+
+def run_case(name, size, number):
+    options = dict(CASES)[name]
+    pool_size, ring_size, batch_size, latency = options
+    ip_data = make_packet(size)
+    # a short warm up, so that code paths and pools are initialized
+    divert = StubDivert(ip_data, 1000)
+    handle = divert.open_handle(pool_size=pool_size, ring_size=ring_size, latency=latency)
+    drain(handle, 1000, batch_size)
+    handle.close()
+
+    divert = StubDivert(ip_data, number)
+    start = time.time()
+    handle = divert.open_handle(pool_size=pool_size, ring_size=ring_size, latency=latency)
+    written = drain(handle, number, batch_size)
+    elapsed = time.time() - start
+    handle.close()
+    result = {
+        'case': name,
+        'size': size,
+        'packets': written,
+        'pps': written / elapsed,
+        'ns_per_packet': elapsed / written * 1e9,
+        # taken before counting allocations, which holds many packets at once
+        'peak_rss_kb': peak_rss_kb(),
+    }
+    result['allocs_per_packet'] = count_allocations(ip_data, options, min(number, 10000))
+    if latency:
+        result['latency'] = handle.latency_stats()
+    return result
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+                                       stderr=subprocess.STDOUT).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def work(number, out_file):
+    results = []
+    print '%-26s %6s %12s %12s %10s %10s' % ('case', 'size', 'pps', 'ns/packet',
+                                              ALLOCATION_COLUMN, 'rss(KB)')
+    for name, _ in CASES:
+        for size in SIZES:
+            # each case runs in a new process, so that peak RSS is its own
+            output = subprocess.check_output([sys.executable, __file__, '--case',
+                                              name, str(size), str(number)])
+            result = json.loads(output.strip().splitlines()[-1])
+            results.append(result)
+            print '%-26s %6d %12.0f %12.1f %10.2f %10d' % (
+                name, size, result['pps'], result['ns_per_packet'],
+                result['allocs_per_packet'], result['peak_rss_kb'])
+    if ALLOCATION_UNIT == 'gc objects':
+        print '%s: objects tracked by gc, str and buffer copies are not counted' % ALLOCATION_COLUMN
+    report = {
+        'time': time.time(),
+        'revision': git_revision(),
+        'python': sys.version.split()[0],
+        'platform': platform.platform(),
+        'allocation_unit': ALLOCATION_UNIT,
+        'number': number,
+        'results': results,
+    }
+    if out_file:
+        with open(out_file, 'w') as fid:
+            json.dump(report, fid, indent=2, sort_keys=True)
+        print 'Results saved to %s' % out_file
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == '--case':
+        print json.dumps(run_case(sys.argv[2], int(sys.argv[3]), int(sys.argv[4])))
+    elif len(sys.argv) > 3:
+        print 'Usage: python pipeline_bench.py [num_packets] [result.json]'
+    else:
+        work(int(sys.argv[1]) if len(sys.argv) > 1 else 100000,
+             sys.argv[2] if len(sys.argv) > 2 else None)
@@ -0,0 +1,78 @@
+# encoding: utf8
+
+import os
+import sys
+sys.path.append(os.getcwd())
+import time
+import threading
+from macdivert.ring import BatchQueue, RingQueue
+
+__author__ = 'huangyan13@baidu.com'
+
+
+def percentile(sorted_list, pct):
+    return sorted_list[min(len(sorted_list) - 1, int(len(sorted_list) * pct))]
+
+
+def run(queue, number, batch_size, rate=0):
+    """
+    One producer thread puts timestamps, like the capture thread does,
+    and the current thread consumes them like a user loop.
+    :param rate: packets per second of producer, 0 means as fast as possible
+    :return: tuple of (packets per second, sorted latency list in microseconds)
+    """
+    def producer():
+        clock = time.time
+        put = queue.put
+        burst = 16
+        interval = float(burst) / rate if rate else 0.0
+        deadline = clock()
+        for i in xrange(number):
+            put(clock())
+            if interval and i % burst == burst - 1:
+                deadline += interval
+                delay = deadline - clock()
+                if delay > 0:
+                    time.sleep(delay)
+
+    latency = []
+    thread = threading.Thread(target=producer)
+    start = time.time()
+    thread.start()
+    received = 0
+    while received < number:
+        if batch_size > 1:
+            items = queue.get_batch(batch_size, timeout=1.0)
+        else:
+            items = [queue.get(timeout=1.0)]
+        now = time.time()
+        latency.extend((now - ts) * 1e6 for ts in items)
+        received += len(items)
+    elapsed = time.time() - start
+    thread.join()
+    latency.sort()
+    return number / elapsed, latency
+
+
+def work(number, rate):
+    for title, pace in (('Saturated producer', 0),
+                        ('Producer paced at %d pps' % rate, rate)):
+        print title
+        print '%-24s %12s %10s %10s %10s' % ('transport', 'pps', 'p50(us)', 'p99(us)', 'p999(us)')
+        for name, factory, batch_size in (('Queue', BatchQueue, 1),
+                                          ('Queue batch=64', BatchQueue, 64),
+                                          ('RingQueue', RingQueue, 1),
+                                          ('RingQueue batch=64', RingQueue, 64)):
+            pps, latency = run(factory(), number, batch_size, pace)
+            print '%-24s %12.0f %10.1f %10.1f %10.1f' % (
+                name, pps, percentile(latency, 0.5),
+                percentile(latency, 0.99), percentile(latency, 0.999))
+        print
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 3:
+        print 'Usage: python queue_bench.py [num_packets] [paced_rate]'
+    else:
+        work(int(sys.argv[1]) if len(sys.argv) > 1 else 200000,
+             int(sys.argv[2]) if len(sys.argv) > 2 else 20000)
@@ -14,7 +14,8 @@ def work():
     libdivert = MacDivert()
     decoder = ImpactDecoder.IPDecoder()
     with DivertHandle(libdivert, 0, "ip from any to any via en0") as fid:
-        pcap = fid.open_pcap('sniff.pcap')
+        # dump packets in background, so a slow disk never stalls re-injection
+        pcap = fid.open_pcap('sniff.pcap', buffered=True)
         # register stop loop signal
         signal(SIGINT, lambda x, y: fid.close())
         while not fid.closed:
@@ -43,6 +44,7 @@ def work():
                 fid.write(packet)
                 # save the packet into sniff.pcap
                 pcap.write(packet)
+        pcap.close()
 
 
 if __name__ == '__main__':
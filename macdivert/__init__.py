@@ -1,4 +1,8 @@
 # encoding: utf8
 from macdivert import *
 from emulator import *
-import libdivert as nids
+try:
+    import libdivert as nids
+except ImportError:
+    # libnids binding is only required by find_tcp_stream()
+    nids = None
@@ -0,0 +1,104 @@
+# encoding: utf8
+
+import sys
+import json
+import time
+import signal
+import argparse
+# resolved within the package, so that the classes are those of macdivert.emulator
+from emulator import Emulator, load_config_file
+
+__author__ = 'huangyan13@baidu.com'
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m macdivert',
+                                     description='Run network emulator without GUI.')
+    commands = parser.add_subparsers(dest='command')
+    run_parser = commands.add_parser('run', help='run emulator with a json configuration')
+    run_parser.add_argument('config', help='json configuration of pipes')
+    run_parser.add_argument('--filter', default='ip from any to any',
+                            help='ipfw rule of diverted packets (default: %(default)s)')
+    run_parser.add_argument('--pid', action='append', default=[],
+                            help='PID or process name, comma separated or repeated')
+    run_parser.add_argument('--no-unknown', action='store_true',
+                            help='do not emulate on packets whose process is unknown')
+    run_parser.add_argument('--device', help='emulate on packets forwarded to this device, '
+                                             'e.g. bridge100 for Internet-Sharing')
+    run_parser.add_argument('--dump', help='directory to dump .pcap files')
+    run_parser.add_argument('--interval', type=float, default=1.0,
+                            help='seconds between stats lines (default: %(default)s)')
+    run_parser.add_argument('--duration', type=float, default=0,
+                            help='stop after so many seconds, 0 to run until interrupted')
+    return parser.parse_args(argv)
+
+
+def create_emulator(args):
+    conf = load_config_file(args.config)
+    emulator = Emulator()
+    if args.dump:
+        emulator.set_dump(args.dump)
+    if args.device:
+        emulator.set_device(args.device)
+        # this is a fake PID, nothing would match
+        emulator.add_pid(-2)
+    else:
+        pid_list = [pid.strip() for pid_str in args.pid
+                    for pid in pid_str.split(',') if pid.strip()]
+        if pid_list and not args.no_unknown:
+            emulator.add_pid(-1)
+        for pid in pid_list:
+            try:
+                emulator.add_pid(int(pid))
+            except ValueError:
+                emulator.add_pid(pid)
+    emulator.load_config(conf)
+    return emulator
+
+
+def main(argv=None):
+    args = parse_args(argv)
+
+    # stdout only carries stats, messages of emulator go to stderr
+    stats_out = sys.stdout
+    sys.stdout = sys.stderr
+
+    try:
+        emulator = create_emulator(args)
+        emulator.start(args.filter)
+    except Exception as e:
+        print 'Unable to start emulator: %s' % e
+        return -1
+
+    # cleared by signal handler
+    looping = [True]
+
+    # register signal handler
+    def sig_handler(signum, frame):
+        print 'Catch signal: %d' % signum
+        looping[0] = False
+    signal.signal(signal.SIGINT, sig_handler)
+    signal.signal(signal.SIGTERM, sig_handler)
+
+    start_time = time.time()
+    next_time = start_time
+    while looping[0]:
+        now = time.time()
+        if args.duration > 0 and now - start_time >= args.duration:
+            break
+        if now >= next_time:
+            record = emulator.stats()
+            record['time'] = now
+            record['elapsed'] = now - start_time
+            stats_out.write(json.dumps(record) + '\n')
+            stats_out.flush()
+            next_time += args.interval
+        time.sleep(min(0.1, max(next_time - time.time(), 0)))
+    # stop loop
+    emulator.stop()
+    print 'Program exited.'
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,184 @@
+# encoding: utf8
+
+from collections import deque
+from enum import Defaults
+from macdivert import DivertHandle
+
+try:
+    import asyncio
+except ImportError:
+    # trollius provides the same event loop API on Python 2
+    import trollius as asyncio
+
+try:
+    _StopAsyncIteration = StopAsyncIteration
+except NameError:
+    _StopAsyncIteration = StopIteration
+
+__author__ = 'huangyan13@baidu.com'
+
+
+class AsyncDivertHandle(object):
+    """
+    Event loop front-end of DivertHandle. The capture thread wakes the loop
+    through the file descriptor of packet ring, then packets are dispatched
+    to waiting futures in batches without any executor.
+
+    On Python 3:
+        async with AsyncDivertHandle(libdivert, 0, rule) as handle:
+            async for packet in handle:
+                await handle.write(packet)
+    """
+
+    def __init__(self, libdivert=None, port=0, filter_str="", flags=0, count=-1,
+                 encoding='utf-8', pool_size=0, ring_size=Defaults.RING_CAPACITY,
+                 loop=None, max_batch=256, max_pending=4096):
+        """
+        :param loop: the event loop, default to current event loop
+        :param max_batch: maximum number of packets taken from ring in one step
+        :param max_pending: stop reading from ring if so many packets are not consumed
+        """
+        self.loop = loop if loop is not None else asyncio.get_event_loop()
+        self.handle = DivertHandle(libdivert, port, filter_str, flags, count,
+                                   encoding, pool_size, ring_size)
+        self.max_batch = max_batch
+        self.max_pending = max_pending
+        self._ring = self.handle.packet_queue
+        self._ready = deque()
+        # pairs of (future, exception type raised when handle closed)
+        self._waiters = deque()
+        self._reading = False
+        self._finished = False
+
+    def _create_future(self):
+        if hasattr(self.loop, 'create_future'):
+            return self.loop.create_future()
+        return asyncio.Future(loop=self.loop)
+
+    def _done_future(self, result):
+        future = self._create_future()
+        future.set_result(result)
+        return future
+
+    def open(self):
+        self.handle.open()
+        # the ring is replaced if the handle was closed before
+        self._ring = self.handle.packet_queue
+        self._resume()
+        return self
+
+    def close(self):
+        self._pause()
+        self._finish()
+        self.handle.close()
+
+    @property
+    def closed(self):
+        return self._finished and not self._ready
+
+    def _resume(self):
+        if not self._reading and not self._finished:
+            self._reading = True
+            self.loop.add_reader(self.handle.fileno(), self._on_readable)
+            # packets may have arrived before the reader is registered
+            self.loop.call_soon(self._on_readable)
+
+    def _pause(self):
+        if self._reading:
+            self._reading = False
+            self.loop.remove_reader(self.handle.fileno())
+
+    def _finish(self):
+        self._finished = True
+        while self._waiters:
+            waiter, exc_type = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_exception(exc_type())
+
+    def _on_readable(self):
+        if not self._reading:
+            return
+        ring = self._ring
+        ring.drain()
+        while True:
+            while len(self._ready) < self.max_pending:
+                batch = ring.get_batch(self.max_batch, 0)
+                if not batch:
+                    break
+                if self.handle.latency is not None:
+                    self.handle.latency.on_dequeue(batch)
+                self._dispatch(batch)
+            if len(self._ready) >= self.max_pending:
+                # let the ring fill up, which slows down the capture thread
+                self._pause()
+                return
+            # ask for a wakeup, and read again if packets came in meanwhile
+            if not ring.arm():
+                break
+        if not self.handle.looping and ring.empty():
+            self._pause()
+            self._finish()
+
+    def _dispatch(self, batch):
+        waiters = self._waiters
+        ready = self._ready
+        for packet in batch:
+            while waiters:
+                waiter = waiters.popleft()[0]
+                # cancelled waiters are already done
+                if not waiter.done():
+                    waiter.set_result(packet)
+                    break
+            else:
+                ready.append(packet)
+
+    def _next(self, exc_type):
+        future = self._create_future()
+        if self._ready:
+            future.set_result(self._ready.popleft())
+            if not self._reading and len(self._ready) <= self.max_pending // 2:
+                self._resume()
+        elif self._finished:
+            future.set_exception(exc_type())
+        else:
+            self._waiters.append((future, exc_type))
+        return future
+
+    def read(self):
+        """
+        :return: a future of next packet, raise EOFError if handle is closed
+        """
+        return self._next(EOFError)
+
+    def write(self, packet_obj):
+        """
+        Re-inject the packet, which never blocks on divert socket
+        :return: a future of the result of DivertHandle.write()
+        """
+        future = self._create_future()
+        try:
+            future.set_result(self.handle.write(packet_obj))
+        except Exception as e:
+            future.set_exception(e)
+        return future
+
+    # Asynchronous iterator protocol
+    def __aiter__(self):
+        return self
+
+    def __anext__(self):
+        return self._next(_StopAsyncIteration)
+
+    # Context Manager protocols
+    def __enter__(self):
+        return self.open()
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __aenter__(self):
+        return self._done_future(self.open())
+
+    def __aexit__(self, *args):
+        self.close()
+        return self._done_future(None)
@@ -0,0 +1,197 @@
+# encoding: utf8
+
+import time
+import socket
+import struct
+import threading
+from ctypes import pointer, create_string_buffer
+from enum import Defaults
+from models import ProcInfo, DivertHandleRaw
+from pcap import PcapReader
+from macdivert import DivertHandle
+
+__author__ = 'huangyan13@baidu.com'
+
+
+def _to_bytes(data):
+    """
+    Packet data from DivertHandle may be str, memoryview or ctypes char array
+    """
+    if isinstance(data, str):
+        return data
+    if isinstance(data, memoryview):
+        return data.tobytes()
+    return data.raw
+
+
+class PythonLib(object):
+    """
+    Pure Python implementation of the libdivert functions used by DivertHandle.
+    Instead of reading a divert socket, divert_loop() feeds packets from a
+    source iterator into the registered callback, exactly like the C library
+    does, and divert_reinject() hands the packets to a sink. Like reading a
+    divert socket, the loop keeps running after the source is exhausted
+    until divert_loop_stop(), so queued packets could still be written.
+    """
+
+    def __init__(self, source, sink, local_addrs=(), pid=-1, comm='', realtime=False):
+        self.source = source
+        self.sink = sink
+        self.local_addrs = set(struct.unpack('!I', socket.inet_aton(addr))[0]
+                               for addr in local_addrs)
+        self.realtime = realtime
+        self.proc_info = ProcInfo(pid, pid, comm)
+
+    def divert_create(self, port, flags):
+        handle = pointer(DivertHandleRaw(flags=flags, divert_port=port))
+        # state of Python backend is kept on the pointer object
+        handle.callback = handle.args = None
+        handle.stopped = False
+        handle.stop_event = threading.Event()
+        handle.num_reinjected = 0
+        return handle
+
+    def divert_set_callback(self, handle, callback, args):
+        handle.callback = callback
+        handle.args = args
+        return 0
+
+    def divert_activate(self, handle):
+        return 0
+
+    def divert_update_ipfw(self, handle, filter_str):
+        handle.contents.ipfw_filter = filter_str
+        return 0
+
+    def _sockaddr(self, ip_data):
+        """
+        libdivert sets sin_addr to zero for outbound packets
+        """
+        src, dst = struct.unpack_from('!II', ip_data, 12)
+        addr = dst if dst in self.local_addrs and src not in self.local_addrs else 0
+        return struct.pack('!BBHI8x', Defaults.SOCKET_ADDR_SIZE,
+                           socket.AF_INET, 0, addr)
+
+    def divert_loop(self, handle, count):
+        raw = handle.contents
+        raw.is_looping = 1
+        handle.stopped = False
+        handle.stop_event.clear()
+        callback, args = handle.callback, handle.args
+        proc_ptr = pointer(self.proc_info)
+        start_time = first_ts = None
+        for item in self.source:
+            if handle.stopped or count == 0:
+                break
+            if isinstance(item, tuple):
+                ts, ip_data = item
+                if self.realtime:
+                    if start_time is None:
+                        start_time, first_ts = time.time(), ts
+                    delay = (ts - first_ts) - (time.time() - start_time)
+                    if delay > 0:
+                        handle.stop_event.wait(delay)
+            else:
+                ip_data = item
+            raw.num_diverted += 1
+            callback(args, proc_ptr, create_string_buffer(ip_data, len(ip_data)),
+                     create_string_buffer(self._sockaddr(ip_data), Defaults.SOCKET_ADDR_SIZE))
+            count -= 1
+        if count != 0:
+            self._wait_stopped(handle)
+        raw.is_looping = 0
+        return 0
+
+    @staticmethod
+    def _wait_stopped(handle):
+        """
+        Block until divert_loop_stop(), as no more packets would arrive
+        """
+        while not handle.stopped:
+            handle.stop_event.wait(1.0)
+
+    def divert_is_looping(self, handle):
+        return handle.contents.is_looping
+
+    def divert_loop_stop(self, handle):
+        handle.stopped = True
+        handle.stop_event.set()
+
+    def divert_loop_wait(self, handle):
+        pass
+
+    def divert_reinject(self, handle, ip_data, length, sockaddr):
+        data = _to_bytes(ip_data)
+        if length < 0:
+            length = struct.unpack_from('!H', data, 2)[0]
+        self.sink(data[0:length])
+        handle.num_reinjected += 1
+        return length
+
+    def divert_close(self, handle):
+        return 0
+
+    def divert_is_inbound(self, sockaddr, ip_hdr):
+        return int(struct.unpack_from('!I', _to_bytes(sockaddr), 4)[0] != 0)
+
+    def divert_is_outbound(self, sockaddr):
+        return int(struct.unpack_from('!I', _to_bytes(sockaddr), 4)[0] == 0)
+
+    def divert_find_tcp_stream(self, ip_data):
+        return None
+
+    def ipfw_compile_rule(self, rule_data, port, rule_str, errmsg):
+        return 0
+
+    def ipfw_print_rule(self, rule_data):
+        pass
+
+    def ipfw_flush(self, errmsg):
+        return 0
+
+
+class PythonDivert(object):
+    """
+    Capture backend which could replace MacDivert off Mac OS,
+    packets come from a pcap file or any iterable, and re-injected
+    packets are collected instead of being sent to the network stack.
+    """
+
+    def __init__(self, source=(), sink=None, local_addrs=(), pid=-1,
+                 comm='', realtime=False, encoding='utf-8'):
+        """
+        :param source: iterable of IP packet str or (timestamp, ip_data) tuples,
+                       or a filename of pcap file
+        :param sink: callable which receives each re-injected IP packet,
+                     default to collect them in self.reinjected
+        :param local_addrs: addresses of local host, packets sent to them are inbound,
+                            all packets are outbound if not set
+        :param pid: process ID attached to all packets, -1 means unknown
+        :param comm: process name attached to all packets
+        :param realtime: sleep between packets according to their timestamps
+        """
+        if isinstance(source, basestring):
+            source = PcapReader(source)
+        self.reinjected = []
+        if sink is None:
+            sink = self.reinjected.append
+        self.encoding = encoding
+        self._lib = PythonLib(source, sink, local_addrs, pid, comm, realtime)
+
+    def get_reference(self):
+        """
+        Return the object which provides libdivert functions
+        """
+        return self._lib
+
+    def acquire(self):
+        # there is no kernel extension to keep loaded
+        pass
+
+    def release(self):
+        pass
+
+    def open_handle(self, port=0, filter_str="", flags=0, count=-1,
+                    pool_size=0, ring_size=0, latency=False):
+        return DivertHandle(self, port, filter_str, flags, count,
+                            self.encoding, pool_size, ring_size, latency).open()
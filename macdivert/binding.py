@@ -0,0 +1,251 @@
+# encoding: utf8
+
+import threading
+from ctypes import cdll, CDLL, POINTER, cast
+from ctypes import (c_void_p, c_uint32, c_char_p, c_int, c_ushort, c_ssize_t,
+                    c_int32, c_float, c_size_t, c_uint64)
+from models import PacketHeader, DivertHandleRaw
+
+try:
+    import cffi
+except ImportError:
+    # ctypes is used for all calls without cffi
+    cffi = None
+
+__author__ = 'huangyan13@baidu.com'
+
+divert_argtypes = {
+    # divert functions
+    "divert_create": [c_int, c_uint32],
+    "divert_activate": [POINTER(DivertHandleRaw)],
+    "divert_update_ipfw": [POINTER(DivertHandleRaw), c_char_p],
+    "divert_loop": [POINTER(DivertHandleRaw), c_int],
+    "divert_is_looping": [POINTER(DivertHandleRaw)],
+    "divert_loop_stop": [POINTER(DivertHandleRaw)],
+    "divert_loop_wait": [POINTER(DivertHandleRaw)],
+    "divert_reinject": [POINTER(DivertHandleRaw), c_char_p, c_ssize_t, c_char_p],
+    "divert_close": [POINTER(DivertHandleRaw)],
+    "divert_is_inbound": [c_char_p, c_void_p],
+    "divert_is_outbound": [c_char_p],
+    "divert_set_callback": [c_void_p, c_void_p, c_void_p],
+    "divert_init_pcap": [c_void_p],
+    "divert_dump_pcap": [c_void_p, c_void_p],
+    "divert_find_tcp_stream": [c_char_p],
+    "divert_set_device": [c_void_p, c_char_p],
+
+    # util functions
+    "divert_load_kext": [c_char_p],
+    "divert_unload_kext": [],
+    "divert_dump_packet": [c_char_p, POINTER(PacketHeader), c_uint32, c_char_p],
+
+    # note that we use char[] to store the ipfw rule for convenience
+    # although the type is mismatched, the length of pointer variable is the same
+    # so this would work
+    "ipfw_compile_rule": [c_char_p, c_ushort, c_ushort, c_char_p, c_char_p],
+    "ipfw_print_rule": [c_char_p],
+    "ipfw_flush": [c_char_p],
+}
+
+divert_restypes = {
+    "divert_create": POINTER(DivertHandleRaw),
+    "divert_activate": c_int,
+    "divert_update_ipfw": c_int,
+    "divert_loop": c_int,
+    "divert_is_looping": c_int,
+    "divert_loop_stop": None,
+    "divert_loop_wait": None,
+    "divert_reinject": c_ssize_t,
+    "divert_close": c_int,
+    "divert_is_inbound": c_int,
+    "divert_is_outbound": c_int,
+    "divert_set_callback": c_int,
+    "divert_init_pcap": c_int,
+    "divert_dump_pcap": c_int,
+    "divert_find_tcp_stream": c_void_p,
+    "divert_set_device": c_int,
+
+    "divert_load_kext": c_int,
+    "divert_unload_kext": c_int,
+    "divert_dump_packet": c_char_p,
+    "ipfw_compile_rule": c_int,
+    "ipfw_print_rule": None,
+    "ipfw_flush": c_int,
+}
+
+emulator_argtypes = {
+    'emulator_callback': [c_void_p, c_void_p, c_char_p, c_char_p],
+    'emulator_create_config': [c_void_p],
+    'emulator_destroy_config': [c_void_p],
+    'emulator_flush': [c_void_p],
+    'emulator_add_pipe': [c_void_p, c_void_p, c_int],
+    'emulator_del_pipe': [c_void_p, c_void_p, c_int],
+    'emulator_add_flag': [c_void_p, c_uint64],
+    'emulator_clear_flags': [c_void_p],
+    'emulator_clear_flag': [c_void_p, c_uint64],
+    'emulator_set_dump_pcap': [c_void_p, c_char_p],
+    'emulator_set_pid_list': [c_void_p, POINTER(c_int32), c_ssize_t],
+    'emulator_config_check': [c_void_p, c_char_p],
+    'emulator_is_running': [c_void_p],
+    'emulator_data_size': [c_void_p, c_int],
+    'emulator_create_ip_filter': [c_char_p, c_char_p, c_char_p, c_char_p, c_int, c_int],
+    'emulator_create_size_filter': [c_size_t, POINTER(c_size_t), POINTER(c_float)],
+
+    # pipe constructors
+    'delay_pipe_create': [c_void_p, c_void_p, c_size_t, POINTER(c_float),
+                          POINTER(c_float), c_size_t],
+    'drop_pipe_create': [c_void_p, c_void_p, c_size_t, POINTER(c_float), POINTER(c_float)],
+    'bandwidth_pipe_create': [c_void_p, c_void_p, c_size_t, POINTER(c_float),
+                              POINTER(c_float), c_size_t],
+    'biterr_pipe_create': [c_void_p, c_void_p, c_size_t, POINTER(c_float),
+                           POINTER(c_float), c_int],
+    'disorder_pipe_create': [c_void_p, c_void_p, c_size_t, POINTER(c_float),
+                             POINTER(c_float), c_size_t, c_int],
+    'duplicate_pipe_create': [c_void_p, c_void_p, c_size_t, POINTER(c_float),
+                              POINTER(c_float), c_size_t],
+    'throttle_pipe_create': [c_void_p, c_void_p, c_size_t, POINTER(c_float),
+                             POINTER(c_float), c_size_t],
+}
+
+emulator_restypes = {
+    'emulator_callback': None,
+    'emulator_create_config': c_void_p,
+    'emulator_destroy_config': None,
+    'emulator_flush': None,
+    'emulator_add_pipe': c_int,
+    'emulator_del_pipe': c_int,
+    'emulator_add_flag': None,
+    'emulator_clear_flags': None,
+    'emulator_clear_flag': None,
+    'emulator_set_dump_pcap': None,
+    'emulator_set_pid_list': None,
+    'emulator_config_check': c_int,
+    'emulator_is_running': c_int,
+    'emulator_data_size': c_uint64,
+    'emulator_create_ip_filter': c_void_p,
+    'emulator_create_size_filter': c_void_p,
+
+    'delay_pipe_create': c_void_p,
+    'drop_pipe_create': c_void_p,
+    'bandwidth_pipe_create': c_void_p,
+    'biterr_pipe_create': c_void_p,
+    'disorder_pipe_create': c_void_p,
+    'duplicate_pipe_create': c_void_p,
+    'throttle_pipe_create': c_void_p,
+}
+
+# declarations of functions called through cffi
+cffi_cdef = """
+    ssize_t divert_reinject(void *handle, const char *packet,
+                            ssize_t length, const char *sin);
+"""
+
+_lock = threading.Lock()
+# loaded libraries indexed by path
+_libraries = {}
+# paths of libraries whose emulator functions are bound
+_emulator_bound = set()
+# cffi library objects indexed by path
+_cffi_libraries = {}
+
+
+def _bind(lib, argtypes_dict, restypes_dict):
+    # set the types of parameters
+    for func_name, argtypes in argtypes_dict.items():
+        # first check if function exists
+        if not hasattr(lib, func_name):
+            raise RuntimeError("Not a valid libdivert library")
+        setattr(getattr(lib, func_name), "argtypes", argtypes)
+
+    # set the types of return value
+    for func_name, restype in restypes_dict.items():
+        setattr(getattr(lib, func_name), "restype", restype)
+
+
+def load_library(lib_path):
+    """
+    Load libdivert and declare its divert functions, this is done only once
+    for each path, later calls return the same library object
+    :param lib_path: The OS path where to load the libdivert.so
+    :return: ctypes library object
+    """
+    with _lock:
+        lib = _libraries.get(lib_path)
+        if lib is None:
+            lib = cdll.LoadLibrary(lib_path)
+            _bind(lib, divert_argtypes, divert_restypes)
+            _libraries[lib_path] = lib
+        return lib
+
+
+def bind_emulator(lib):
+    """
+    Declare emulator and pipe functions of a loaded library, only once
+    """
+    with _lock:
+        if lib._name not in _emulator_bound:
+            _bind(lib, emulator_argtypes, emulator_restypes)
+            _emulator_bound.add(lib._name)
+
+
+def _cffi_library(lib_path):
+    with _lock:
+        entry = _cffi_libraries.get(lib_path)
+        if entry is None:
+            ffi = cffi.FFI()
+            ffi.cdef(cffi_cdef)
+            entry = _cffi_libraries[lib_path] = (ffi, ffi.dlopen(lib_path))
+        return entry
+
+
+def reinject_function(lib, handle):
+    """
+    Specialize divert_reinject for a divert handle, with cffi if it is
+    installed and lib is a real library, otherwise with ctypes.
+    :return: function of (ip_data, sockaddr), both could be str or any
+             object supporting buffer protocol like ctypes char arrays
+    """
+    if cffi is None or not isinstance(lib, CDLL):
+        reinject = lib.divert_reinject
+
+        def ctypes_reinject(ip_data, sockaddr):
+            return reinject(handle, ip_data, -1, sockaddr)
+        return ctypes_reinject
+
+    ffi, cffi_lib = _cffi_library(lib._name)
+    reinject = cffi_lib.divert_reinject
+    from_buffer = ffi.from_buffer
+    handle_ptr = ffi.cast('void *', cast(handle, c_void_p).value)
+
+    def cffi_reinject(ip_data, sockaddr):
+        # str is passed without copy, other buffers are wrapped
+        if not isinstance(ip_data, str):
+            ip_data = from_buffer(ip_data)
+        if not isinstance(sockaddr, str):
+            sockaddr = from_buffer(sockaddr)
+        return reinject(handle_ptr, ip_data, -1, sockaddr)
+    return cffi_reinject
+
+
+def slot_reinject_function(lib, handle, pool):
+    """
+    Specialize divert_reinject for packets kept in slots of a BufferPool,
+    with cffi pointers of all slots computed in advance
+    :return: function of slot index
+    """
+    data_buffers, addr_buffers = pool.data_buffers, pool.addr_buffers
+    if cffi is None or not isinstance(lib, CDLL):
+        reinject = lib.divert_reinject
+
+        def ctypes_reinject(slot):
+            return reinject(handle, data_buffers[slot], -1, addr_buffers[slot])
+        return ctypes_reinject
+
+    ffi, cffi_lib = _cffi_library(lib._name)
+    reinject = cffi_lib.divert_reinject
+    handle_ptr = ffi.cast('void *', cast(handle, c_void_p).value)
+    data_ptrs = [ffi.cast('char *', addr) for addr in pool.data_addrs]
+    addr_ptrs = [ffi.cast('char *', addr) for addr in pool.addr_addrs]
+
+    def cffi_reinject(slot):
+        return reinject(handle_ptr, data_ptrs[slot], -1, addr_ptrs[slot])
+    return cffi_reinject
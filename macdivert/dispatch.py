@@ -0,0 +1,245 @@
+# encoding: utf8
+
+import Queue
+import random
+import signal
+import threading
+import traceback
+import multiprocessing
+
+__author__ = 'huangyan13@baidu.com'
+
+
+def _worker(index, func, in_queue, out_queue):
+    """
+    Main loop of worker process, batches are processed in arrival order
+    and results of each batch are sent back as a whole
+    """
+    # interrupt is handled by the parent process, which closes the handle
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    # forked workers would otherwise share the random state of the parent
+    random.seed()
+    while True:
+        batch = in_queue.get()
+        if batch is None:
+            # tell the reinject stage this worker is done
+            out_queue.put(index)
+            break
+        results = []
+        for seq, ip_data in batch:
+            try:
+                results.append((seq, func(ip_data)))
+            except Exception:
+                # let the packet pass unmodified instead of losing it
+                traceback.print_exc()
+                results.append((seq, ip_data))
+        out_queue.put(results)
+
+
+class FlowDispatcher(object):
+    """
+    Spread the per-packet work of a DivertHandle over multiple processes.
+    Packets are sharded by the 5-tuple of their flow, so that all packets of
+    one flow, in both directions, are processed by the same worker in order.
+    Packet data is sent to workers, while the packets stay in this process
+    and are re-injected by a single thread once their results come back.
+    At most max_pending packets are in workers, reading stops meanwhile and
+    new packets wait in the handle. Packets of a crashed worker are dropped.
+
+        def process(ip_data):
+            return ip_data.replace('foo', 'bar')
+
+        with DivertHandle(libdivert, 0, rule) as fid:
+            with FlowDispatcher(fid, process, 4) as dispatcher:
+                dispatcher.wait()
+    """
+
+    def __init__(self, handle, func, num_workers=None, batch_size=64, max_pending=4096):
+        """
+        :param handle: an opened DivertHandle
+        :param func: function called with IP packet data in worker process,
+                     returns the new packet data, or None to drop the packet
+        :param num_workers: number of worker processes, default to CPU count
+        :param batch_size: maximum number of packets read from handle at once
+        :param max_pending: maximum number of packets being processed by workers
+        """
+        self.handle = handle
+        self.func = func
+        self.num_workers = num_workers or multiprocessing.cpu_count()
+        self.batch_size = batch_size
+        self.max_pending = max(max_pending, 1)
+        self.num_dispatched = [0] * self.num_workers
+        self.num_reinjected = 0
+        self.num_dropped = 0
+        # packets being processed by workers and index of their worker,
+        # indexed by sequence number
+        self._pending = {}
+        # notified when packets leave _pending
+        self._room = threading.Condition()
+        # indexes of workers which exited without finishing
+        self._crashed = set()
+        self._seq = 0
+        self._stopped = False
+        self._in_queues = []
+        self._out_queue = None
+        self._workers = []
+        self._reader = None
+        self._writer = None
+
+    @property
+    def num_pending(self):
+        return len(self._pending)
+
+    def shard(self, packet):
+        """
+        :return: index of the worker which processes the flow of packet
+        """
+        # xor is symmetric, so both directions of a flow map to one worker
+        return (hash((packet.src, packet.sport)) ^ hash((packet.dst, packet.dport)) ^
+                (packet.proto or 0)) % self.num_workers
+
+    def start(self):
+        self._stopped = False
+        self._crashed = set()
+        self._in_queues = [multiprocessing.Queue() for _ in xrange(self.num_workers)]
+        self._out_queue = multiprocessing.Queue()
+        self._workers = []
+        for index, in_queue in enumerate(self._in_queues):
+            worker = multiprocessing.Process(target=_worker,
+                                             args=(index, self.func, in_queue, self._out_queue))
+            worker.daemon = True
+            worker.start()
+            self._workers.append(worker)
+        self._writer = threading.Thread(target=self._reinject_loop)
+        self._writer.start()
+        self._reader = threading.Thread(target=self._dispatch_loop)
+        self._reader.start()
+        return self
+
+    def _dispatch_loop(self):
+        handle = self.handle
+        num_workers = self.num_workers
+        pending = self._pending
+        shard = self.shard
+        crashed = self._crashed
+        room = self._room
+        max_pending = self.max_pending
+        seq = self._seq
+        while not self._stopped and not handle.closed:
+            # back-pressure, packets wait in the handle until workers catch up
+            with room:
+                if len(pending) >= max_pending:
+                    room.wait(0.1)
+                    continue
+            size = min(self.batch_size, max_pending - len(pending))
+            packets = handle.read_batch(size, timeout=0.1)
+            shards = [[] for _ in xrange(num_workers)]
+            for packet in packets:
+                if not packet.valid:
+                    continue
+                index = shard(packet)
+                if index in crashed:
+                    handle.release(packet)
+                    self.num_dropped += 1
+                    continue
+                ip_data = packet.ip_data
+                if isinstance(ip_data, memoryview):
+                    ip_data = ip_data.tobytes()
+                pending[seq] = (packet, index)
+                shards[index].append((seq, ip_data))
+                seq += 1
+            for i in xrange(num_workers):
+                if shards[i]:
+                    self._in_queues[i].put(shards[i])
+                    self.num_dispatched[i] += len(shards[i])
+        self._seq = seq
+        for in_queue in self._in_queues:
+            in_queue.put(None)
+
+    def _reinject_loop(self):
+        handle = self.handle
+        pending = self._pending
+        finished = set()
+        while len(finished) < self.num_workers:
+            try:
+                results = self._out_queue.get(timeout=0.5)
+            except Queue.Empty:
+                self._check_workers(finished)
+                continue
+            if isinstance(results, int):
+                finished.add(results)
+                continue
+            for seq, ip_data in results:
+                packet, _ = pending.pop(seq)
+                if ip_data is None:
+                    handle.release(packet)
+                    self.num_dropped += 1
+                    continue
+                packet.ip_data = ip_data
+                try:
+                    handle.write(packet)
+                except RuntimeError:
+                    # the handle is closed while the packet is in flight
+                    handle.release(packet)
+                    self.num_dropped += 1
+                    continue
+                self.num_reinjected += 1
+            with self._room:
+                self._room.notify()
+        # packets of crashed workers dispatched before the crash was seen
+        self._drop_pending(lambda index: True)
+
+    def _check_workers(self, finished):
+        """
+        Find workers which exited without finishing, e.g. killed by a signal,
+        their packets would never come back
+        """
+        for index, worker in enumerate(self._workers):
+            # a worker which finished normally has its index still queued
+            if index in finished or worker.is_alive() or worker.exitcode == 0:
+                continue
+            print 'Worker %d exited with code %s, its packets are dropped' % (index, worker.exitcode)
+            finished.add(index)
+            self._crashed.add(index)
+        if self._crashed:
+            self._drop_pending(lambda index: index in self._crashed)
+
+    def _drop_pending(self, match):
+        dropped = 0
+        for seq, (packet, index) in self._pending.items():
+            if match(index) and self._pending.pop(seq, None) is not None:
+                self.handle.release(packet)
+                dropped += 1
+        if dropped:
+            self.num_dropped += dropped
+            with self._room:
+                self._room.notify()
+
+    def wait(self, timeout=None):
+        """
+        Wait until the handle is closed and all packets are processed,
+        packets still in workers when the handle is closed are dropped
+        """
+        if self._reader is not None:
+            self._reader.join(timeout)
+        if self._writer is not None:
+            self._writer.join(timeout)
+
+    def close(self):
+        """
+        Stop reading from handle, packets already dispatched are still
+        re-injected if the handle is not closed before
+        """
+        self._stopped = True
+        self.wait()
+        self._reader = self._writer = None
+        for worker in self._workers:
+            worker.join()
+        self._workers = []
+
+    # Context Manager protocol
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.close()
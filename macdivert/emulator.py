@@ -1,30 +1,42 @@
 # encoding: utf8
 
 import os
-import sys
 import json
 import copy
-import psutil
 import threading
-import netifaces
 import socket
 import time
-import signal
-import Tkinter as tk
 from macdivert import MacDivert
-from tkMessageBox import showerror, showwarning
+from binding import bind_emulator, emulator_argtypes, emulator_restypes
+from profiles import float32_array, optional_float32_array, check_schedule, resolve_profiles
 from enum import Defaults
-from tkFileDialog import askopenfilename, askdirectory
-from ctypes import POINTER, pointer, cast
-from ctypes import (c_uint8, c_void_p, c_int32, c_char_p, c_int,  c_float,
-                    create_string_buffer, c_size_t, c_ssize_t, c_uint64)
+from stats import PipeStats
+from ctypes import pointer, cast
+from ctypes import (c_uint8, c_int32, c_float,
+                    create_string_buffer, c_size_t)
 
 # import pydevd
 # pydevd.settrace('localhost', port=9999, stdoutToServer=True, stderrToServer=True)
 
+# GUI modules are imported by EmulatorGUI, so that headless usage starts fast
+tk = showerror = showwarning = askopenfilename = askdirectory = netifaces = None
+
 __author__ = 'huangyan13@baidu.com'
 
 
+def _import_gui():
+    global tk, showerror, showwarning, askopenfilename, askdirectory, netifaces
+    if tk is None:
+        import Tkinter
+        import tkMessageBox
+        import tkFileDialog
+        import netifaces as netifaces_module
+        showerror, showwarning = tkMessageBox.showerror, tkMessageBox.showwarning
+        askopenfilename, askdirectory = tkFileDialog.askopenfilename, tkFileDialog.askdirectory
+        netifaces = netifaces_module
+        tk = Tkinter
+
+
 class Flags(object):
     # direction flags
     DIRECTION_IN = 0
@@ -52,8 +64,12 @@ class Flags(object):
 
 
 class BasicPipe(object):
+    pipe_name = None
+
     def __init__(self):
         self.handle = None
+        # capacity of pipe queue, None if pipe holds no packets
+        self.queue_size = None
         if Emulator.libdivert_ref is None:
             raise RuntimeError("Should first instantiate an Emulator object")
         else:
@@ -61,174 +77,138 @@ class BasicPipe(object):
 
 
 class DelayPipe(BasicPipe):
+    pipe_name = 'delay'
+
     def __init__(self, delay_time, t=None,
                  queue_size=Flags.DELAY_QUEUE_SIZE,
                  ip_filter_obj=None, size_filter_obj=None):
         super(DelayPipe, self).__init__()
-        # first set function signature
-        setattr(getattr(self._lib, 'delay_pipe_create'), "argtypes",
-                [c_void_p, c_void_p, c_size_t, POINTER(c_float), POINTER(c_float), c_size_t])
-        setattr(getattr(self._lib, 'delay_pipe_create'), "restype", c_void_p)
-        arr_len = len(delay_time)
-        arr_type = c_float * arr_len
+        self.queue_size = queue_size
+        delay_time = float32_array(delay_time)
+        t = optional_float32_array(t)
+        check_schedule(t, delay_time)
         # then check packet size filter handle
         ip_filter_handle = None if ip_filter_obj is None else ip_filter_obj.handle
         size_filter_handle = None if size_filter_obj is None else size_filter_obj.handle
-        self.handle = self._lib.delay_pipe_create(ip_filter_handle, size_filter_handle, arr_len,
-                                                  arr_type(*list(t)) if t else None,
-                                                  arr_type(*list(delay_time)),
-                                                  queue_size)
+        self.handle = self._lib.delay_pipe_create(ip_filter_handle, size_filter_handle,
+                                                  len(delay_time), t, delay_time, queue_size)
 
 
 class DropPipe(BasicPipe):
+    pipe_name = 'drop'
+
     def __init__(self, drop_rate, t=None,
                  ip_filter_obj=None, size_filter_obj=None):
         super(DropPipe, self).__init__()
-        # first set function signature
-        setattr(getattr(self._lib, 'drop_pipe_create'), "argtypes",
-                [c_void_p, c_void_p, c_size_t, POINTER(c_float), POINTER(c_float)])
-        setattr(getattr(self._lib, 'drop_pipe_create'), "restype", c_void_p)
-        arr_len = len(drop_rate)
-        arr_type = c_float * arr_len
+        drop_rate = float32_array(drop_rate)
+        t = optional_float32_array(t)
+        check_schedule(t, drop_rate)
         # then check packet size filter handle
         ip_filter_handle = None if ip_filter_obj is None else ip_filter_obj.handle
         size_filter_handle = None if size_filter_obj is None else size_filter_obj.handle
-        self.handle = self._lib.drop_pipe_create(ip_filter_handle, size_filter_handle, arr_len,
-                                                 arr_type(*list(t)) if t else None,
-                                                 arr_type(*list(drop_rate)))
+        self.handle = self._lib.drop_pipe_create(ip_filter_handle, size_filter_handle,
+                                                 len(drop_rate), t, drop_rate)
 
 
 class BandwidthPipe(BasicPipe):
+    pipe_name = 'bandwidth'
+
     def __init__(self, t, bandwidth, queue_size=Flags.DELAY_QUEUE_SIZE,
                  ip_filter_obj=None, size_filter_obj=None):
         super(BandwidthPipe, self).__init__()
-        # first set function signature
-        setattr(getattr(self._lib, 'bandwidth_pipe_create'), "argtypes",
-                [c_void_p, c_void_p, c_size_t, POINTER(c_float), POINTER(c_float), c_size_t])
-        setattr(getattr(self._lib, 'bandwidth_pipe_create'), "restype", c_void_p)
-        arr_len = len(t)
-        arr_type = c_float * arr_len
+        self.queue_size = queue_size
+        t = float32_array(t)
+        bandwidth = float32_array(bandwidth)
+        check_schedule(t, bandwidth)
         # then check packet size filter handle
         ip_filter_handle = None if ip_filter_obj is None else ip_filter_obj.handle
         size_filter_handle = None if size_filter_obj is None else size_filter_obj.handle
         self.handle = self._lib.bandwidth_pipe_create(ip_filter_handle, size_filter_handle,
-                                                      arr_len, arr_type(*list(t)),
-                                                      arr_type(*list(bandwidth)),
-                                                      queue_size)
+                                                      len(t), t, bandwidth, queue_size)
 
 
 class BiterrPipe(BasicPipe):
+    pipe_name = 'biterr'
+
     def __init__(self, t, biterr_rate, max_flip, ip_filter_obj=None, size_filter_obj=None):
         super(BiterrPipe, self).__init__()
-        # first set function signature
-        setattr(getattr(self._lib, 'biterr_pipe_create'), "argtypes",
-                [c_void_p, c_void_p, c_size_t, POINTER(c_float), POINTER(c_float), c_int])
-        setattr(getattr(self._lib, 'biterr_pipe_create'), "restype", c_void_p)
-        arr_len = len(t)
-        arr_type = c_float * arr_len
+        t = float32_array(t)
+        biterr_rate = float32_array(biterr_rate)
+        check_schedule(t, biterr_rate)
         # then check packet size filter handle
         ip_filter_handle = None if ip_filter_obj is None else ip_filter_obj.handle
         size_filter_handle = None if size_filter_obj is None else size_filter_obj.handle
         self.handle = self._lib.biterr_pipe_create(ip_filter_handle, size_filter_handle,
-                                                   arr_len, arr_type(*list(t)),
-                                                   arr_type(*list(biterr_rate)), max_flip)
+                                                   len(t), t, biterr_rate, max_flip)
 
 
 class DisorderPipe(BasicPipe):
+    pipe_name = 'disorder'
+
     def __init__(self, t, disorder_rate, queue_size, max_disorder,
                  ip_filter_obj=None, size_filter_obj=None):
         super(DisorderPipe, self).__init__()
-        # first set function signature
-        setattr(getattr(self._lib, 'disorder_pipe_create'), "argtypes",
-                [c_void_p, c_void_p, c_size_t, POINTER(c_float), POINTER(c_float), c_size_t, c_int])
-        setattr(getattr(self._lib, 'disorder_pipe_create'), "restype", c_void_p)
-        arr_len = len(t)
-        arr_type = c_float * arr_len
+        self.queue_size = queue_size
+        t = float32_array(t)
+        disorder_rate = float32_array(disorder_rate)
+        check_schedule(t, disorder_rate)
         # then check packet size filter handle
         ip_filter_handle = None if ip_filter_obj is None else ip_filter_obj.handle
         size_filter_handle = None if size_filter_obj is None else size_filter_obj.handle
         self.handle = self._lib.disorder_pipe_create(ip_filter_handle, size_filter_handle,
-                                                     arr_len, arr_type(*list(t)),
-                                                     arr_type(*list(disorder_rate)),
+                                                     len(t), t, disorder_rate,
                                                      queue_size, max_disorder)
 
 
 class DuplicatePipe(BasicPipe):
+    pipe_name = 'duplicate'
+
     def __init__(self, t, duplicate_rate, max_duplicate,
                  ip_filter_obj=None, size_filter_obj=None):
         super(DuplicatePipe, self).__init__()
-        # first set function signature
-        setattr(getattr(self._lib, 'duplicate_pipe_create'), "argtypes",
-                [c_void_p, c_void_p, c_size_t, POINTER(c_float), POINTER(c_float), c_size_t])
-        setattr(getattr(self._lib, 'duplicate_pipe_create'), "restype", c_void_p)
-        arr_len = len(t)
-        arr_type = c_float * arr_len
+        t = float32_array(t)
+        duplicate_rate = float32_array(duplicate_rate)
+        check_schedule(t, duplicate_rate)
         # then check packet size filter handle
         ip_filter_handle = None if ip_filter_obj is None else ip_filter_obj.handle
         size_filter_handle = None if size_filter_obj is None else size_filter_obj.handle
-        self.handle = self._lib.duplicate_pipe_create(ip_filter_handle, size_filter_handle, arr_len,
-                                                      arr_type(*list(t)),
-                                                      arr_type(*list(duplicate_rate)),
-                                                      max_duplicate)
+        self.handle = self._lib.duplicate_pipe_create(ip_filter_handle, size_filter_handle,
+                                                      len(t), t, duplicate_rate, max_duplicate)
 
 
 class ThrottlePipe(BasicPipe):
+    pipe_name = 'throttle'
+
     def __init__(self, t_start, t_end, queue_size, ip_filter_obj=None, size_filter_obj=None):
         super(ThrottlePipe, self).__init__()
-        # first set function signature
-        setattr(getattr(self._lib, 'throttle_pipe_create'), "argtypes",
-                [c_void_p, c_void_p, c_size_t, POINTER(c_float), POINTER(c_float), c_size_t])
-        setattr(getattr(self._lib, 'throttle_pipe_create'), "restype", c_void_p)
-        arr_len = len(t_start)
-        arr_type = c_float * arr_len
+        self.queue_size = queue_size
+        t_start = float32_array(t_start)
+        t_end = float32_array(t_end)
+        check_schedule(t_start, t_end)
         # then check packet size filter handle
         ip_filter_handle = None if ip_filter_obj is None else ip_filter_obj.handle
         size_filter_handle = None if size_filter_obj is None else size_filter_obj.handle
         self.handle = self._lib.throttle_pipe_create(ip_filter_handle, size_filter_handle,
-                                                     arr_len, arr_type(*list(t_start)),
-                                                     arr_type(*list(t_end)),
-                                                     queue_size)
+                                                     len(t_start), t_start, t_end, queue_size)
 
 
 class Emulator(object):
     libdivert_ref = None
+    # MacDivert which loaded libdivert_ref, None if libdivert_ref is set directly
+    libdivert = None
 
-    emulator_argtypes = {
-        'emulator_callback': [c_void_p, c_void_p, c_char_p, c_char_p],
-        'emulator_create_config': [c_void_p],
-        'emulator_destroy_config': [c_void_p],
-        'emulator_flush': [c_void_p],
-        'emulator_add_pipe': [c_void_p, c_void_p, c_int],
-        'emulator_del_pipe': [c_void_p, c_void_p, c_int],
-        'emulator_add_flag': [c_void_p, c_uint64],
-        'emulator_clear_flags': [c_void_p],
-        'emulator_clear_flag': [c_void_p, c_uint64],
-        'emulator_set_dump_pcap': [c_void_p, c_char_p],
-        'emulator_set_pid_list': [c_void_p, POINTER(c_int32), c_ssize_t],
-        'emulator_config_check': [c_void_p, c_char_p],
-        'emulator_is_running': [c_void_p],
-        'emulator_data_size': [c_void_p, c_int],
-        'emulator_create_ip_filter': [c_char_p, c_char_p, c_char_p, c_char_p, c_int, c_int],
-        'emulator_create_size_filter': [c_size_t, POINTER(c_size_t), POINTER(c_float)],
-    }
+    # prototypes of emulator and pipe functions are declared in binding module
+    emulator_argtypes = emulator_argtypes
+    emulator_restypes = emulator_restypes
 
-    emulator_restypes = {
-        'emulator_callback': None,
-        'emulator_create_config': c_void_p,
-        'emulator_destroy_config': None,
-        'emulator_flush': None,
-        'emulator_add_pipe': c_int,
-        'emulator_del_pipe': c_int,
-        'emulator_add_flag': None,
-        'emulator_clear_flags': None,
-        'emulator_clear_flag': None,
-        'emulator_set_dump_pcap': None,
-        'emulator_set_pid_list': None,
-        'emulator_config_check': c_int,
-        'emulator_is_running': c_int,
-        'emulator_data_size': c_uint64,
-        'emulator_create_ip_filter': c_void_p,
-        'emulator_create_size_filter': c_void_p,
+    pipe_name2type = {
+        'drop': DropPipe,
+        'delay': DelayPipe,
+        'biterr': BiterrPipe,
+        'disorder': DisorderPipe,
+        'throttle': ThrottlePipe,
+        'duplicate': DuplicatePipe,
+        'bandwidth': BandwidthPipe,
     }
 
     class PacketIPFilter(object):
@@ -251,16 +231,43 @@ class Emulator(object):
     def __init__(self):
         # get reference for libdivert
         if Emulator.libdivert_ref is None:
-            lib_obj = MacDivert()
+            lib_obj = MacDivert.shared()
+            Emulator.libdivert = lib_obj
             Emulator.libdivert_ref = lib_obj.get_reference()
             # initialize prototype of functions
             self._init_func_proto()
+        self._libdivert = None
         # create divert handle and emulator config
         self.handle, self.config = self._create_config()
+        # keep the kernel extension loaded while this emulator exists
+        if Emulator.libdivert is not None:
+            Emulator.libdivert.acquire()
+            self._libdivert = Emulator.libdivert
         # background thread for divert loop
         self.thread = None
         # list to store pids
         self.pid_list = []
+        # keeps PIDs of process names up to date while running
+        self.resolver = None
+        # settings which could be replaced but not removed from config
+        self.dump_dir = None
+        self.device = None
+        self.filter_str = ''
+        # pipes currently linked in each direction
+        self.pipes = {
+            Flags.DIRECTION_IN: [],
+            Flags.DIRECTION_OUT: [],
+        }
+        # pipes unlinked while running, freed when the loop stops
+        self.retired_pipes = []
+        # seconds the divert loop was paused during last replace_pipes()
+        self.last_replace_window = 0.
+        self.pipe_lock = threading.Lock()
+        # set while the loop thread reads packets, guarded by pipe_lock
+        self._reading = False
+        # replace_pipes() stopped the loop, which should read again
+        self._loop_paused = False
+        self._loop_exited = threading.Event()
         # error information
         self.errmsg = create_string_buffer(Defaults.DIVERT_ERRBUF_SIZE)
         self.quit_loop = False
@@ -268,21 +275,18 @@ class Emulator(object):
 
     def __del__(self):
         lib = self.libdivert_ref
-        lib.emulator_destroy_config(self.config)
-        if lib.divert_close(self.handle) != 0:
-            raise RuntimeError('Divert handle could not be cleaned.')
+        try:
+            lib.emulator_destroy_config(self.config)
+            if lib.divert_close(self.handle) != 0:
+                raise RuntimeError('Divert handle could not be cleaned.')
+        finally:
+            # the reference is dropped even if the handle failed to close
+            libdivert, self._libdivert = self._libdivert, None
+            if libdivert is not None:
+                libdivert.release()
 
     def _init_func_proto(self):
-        # set the types of parameters
-        for func_name, argtypes in self.emulator_argtypes.items():
-            # first check if function exists
-            if not hasattr(self.libdivert_ref, func_name):
-                raise RuntimeError("Not a valid libdivert library")
-            setattr(getattr(self.libdivert_ref, func_name), "argtypes", argtypes)
-
-        # set the types of return value
-        for func_name, restype in self.emulator_restypes.items():
-            setattr(getattr(self.libdivert_ref, func_name), "restype", restype)
+        bind_emulator(self.libdivert_ref)
 
     def _create_config(self):
         lib = self.libdivert_ref
@@ -312,7 +316,36 @@ class Emulator(object):
             self.quit_loop = False
             return
         lib = self.libdivert_ref
-        lib.divert_loop(self.handle, -1)
+        while True:
+            # the loop could not start while pipes are being replaced
+            with self.pipe_lock:
+                if self.quit_loop:
+                    break
+                self._loop_exited.clear()
+                self._reading = True
+            lib.divert_loop(self.handle, -1)
+            self._loop_exited.set()
+            # blocks until replace_pipes() has swapped the chain
+            with self.pipe_lock:
+                self._reading = False
+                paused, self._loop_paused = self._loop_paused, False
+            if not paused:
+                break
+
+    def _pause_loop(self):
+        # called with pipe_lock held, packets arriving meanwhile
+        # wait in the divert socket until the loop reads again
+        if not self._reading:
+            return
+        lib = self.libdivert_ref
+        self._loop_paused = True
+        deadline = time.time() + 1.0
+        # the loop thread may not have entered divert_loop() yet
+        while not self._loop_exited.isSet():
+            if time.time() > deadline:
+                raise RuntimeError('Divert loop failed to pause.')
+            lib.divert_loop_stop(self.handle)
+            self._loop_exited.wait(0.01)
 
     def _divert_loop_stop(self):
         lib = self.libdivert_ref
@@ -321,16 +354,97 @@ class Emulator(object):
         print 'Emulator stop OK'
         lib.emulator_flush(self.config)
         print 'Emulator flush OK'
+        self._free_retired()
+
+    def _free_retired(self):
+        # libdivert frees a pipe only when it is deleted from the config,
+        # so link them again and delete with their memory
+        lib = self.libdivert_ref
+        with self.pipe_lock:
+            retired, self.retired_pipes = self.retired_pipes, []
+            for pipe, direction in retired:
+                if lib.emulator_add_pipe(self.config, pipe.handle, direction) != 0 or \
+                        lib.emulator_del_pipe(self.config, pipe.handle, 1) != 0:
+                    self.retired_pipes.append((pipe, direction))
+            if self.retired_pipes:
+                raise RuntimeError('%d retired pipes could not be freed.' %
+                                   len(self.retired_pipes))
 
     def add_pipe(self, pipe, direction=Flags.DIRECTION_IN):
         lib = self.libdivert_ref
-        if lib.emulator_add_pipe(self.config, pipe.handle, direction) != 0:
-            raise RuntimeError("Pipe already exists.")
+        with self.pipe_lock:
+            if lib.emulator_add_pipe(self.config, pipe.handle, direction) != 0:
+                raise RuntimeError("Pipe already exists.")
+            self.pipes[direction].append(pipe)
 
     def del_pipe(self, pipe, free_mem=False):
         lib = self.libdivert_ref
-        if lib.emulator_del_pipe(self.config, pipe.handle, int(free_mem)) != 0:
-            raise RuntimeError("Pipe do not exists.")
+        with self.pipe_lock:
+            if lib.emulator_del_pipe(self.config, pipe.handle, int(free_mem)) != 0:
+                raise RuntimeError("Pipe do not exists.")
+            for pipe_list in self.pipes.values():
+                if pipe in pipe_list:
+                    pipe_list.remove(pipe)
+
+    def replace_pipes(self, direction, new_pipes):
+        """
+        Replace all pipes of one direction while the emulator is running,
+        without flushing queued packets or recreating the divert handle.
+        libdivert could not swap a chain at once, so the divert loop is
+        paused while old pipes are unlinked and new pipes linked, and no
+        packet is read meanwhile. Packets arriving in this window wait in
+        the divert socket, its length in seconds is kept in last_replace_window.
+        If a pipe could not be linked, the old pipes are linked again and
+        the error is raised. Old pipes are freed when the emulator stops.
+        :param direction: DIRECTION_IN or DIRECTION_OUT
+        :param new_pipes: list of pipe objects, in the order of the chain
+        :return: list of replaced pipe objects
+        """
+        lib = self.libdivert_ref
+        new_pipes = list(new_pipes)
+        with self.pipe_lock:
+            old_pipes = self.pipes[direction]
+            for pipe in new_pipes:
+                if any(pipe in pipe_list for pipe_list in self.pipes.values()):
+                    raise RuntimeError("Pipe already exists.")
+            # pipes in the chain of libdivert, used to roll back
+            linked = list(old_pipes)
+            start_time = time.time()
+            self._pause_loop()
+            try:
+                # unlink old pipes first, so that packets queued in them are
+                # not passed through the new pipes again
+                for pipe in old_pipes:
+                    if lib.emulator_del_pipe(self.config, pipe.handle, 0) != 0:
+                        raise RuntimeError("Pipe do not exists.")
+                    linked.remove(pipe)
+                for pipe in new_pipes:
+                    if lib.emulator_add_pipe(self.config, pipe.handle, direction) != 0:
+                        raise RuntimeError("Pipe already exists.")
+                    linked.append(pipe)
+            except RuntimeError as e:
+                # restore the old chain in its order
+                for pipe in list(linked):
+                    if lib.emulator_del_pipe(self.config, pipe.handle, 0) == 0:
+                        linked.remove(pipe)
+                for pipe in old_pipes:
+                    if pipe not in linked and \
+                            lib.emulator_add_pipe(self.config, pipe.handle, direction) == 0:
+                        linked.append(pipe)
+                if linked != old_pipes:
+                    # keep track of the chain libdivert really has
+                    self.pipes[direction] = linked
+                    self.retired_pipes.extend((pipe, direction) for pipe in old_pipes
+                                              if pipe not in linked)
+                    raise RuntimeError('%s Old pipes could not be linked again.' % e)
+                raise
+            finally:
+                self.last_replace_window = time.time() - start_time
+            self.pipes[direction] = new_pipes
+            self.retired_pipes.extend((pipe, direction) for pipe in old_pipes)
+        if not self.is_looping:
+            self._free_retired()
+        return old_pipes
 
     def add_pid(self, pid):
         self.pid_list.append(pid)
@@ -339,40 +453,53 @@ class Emulator(object):
         lib = self.libdivert_ref
         if lib.divert_set_device(self.handle, dev_name) != 0:
             raise RuntimeError('Could not set capture device.')
+        self.device = dev_name
+
+    def _set_pid_list(self, real_pid_list):
+        # an empty list clears the PID filter of emulator config
+        if real_pid_list:
+            print 'Found PID: %s' % ', '.join(map(str, real_pid_list))
+        lib = self.libdivert_ref
+        arr_len = len(real_pid_list)
+        arr_type = c_int32 * arr_len
+        lib.emulator_set_pid_list(self.config, arr_type(*real_pid_list), arr_len)
 
     def _wait_pid(self):
         # first wait until all processes are started
         proc_list = filter(lambda x: isinstance(x, str) or isinstance(x, unicode), self.pid_list)
         real_pid_list = filter(lambda x: isinstance(x, int), self.pid_list)
+        if not proc_list:
+            self._set_pid_list(real_pid_list)
+            return
+        # processes started later, e.g. children or a relaunched app,
+        # are pushed into the running emulator by the resolver
+        from resolver import ProcessResolver
         self.is_waiting = True
-        while not self.quit_loop:
-            if len(real_pid_list) == len(self.pid_list):
-                break
-            for proc in psutil.process_iter():
-                proc_name = proc.name().lower()
-                for name in proc_list:
-                    if name.lower() in proc_name:
-                        real_pid_list.append(proc.pid)
+        self.resolver = ProcessResolver(proc_list, real_pid_list,
+                                        callback=self._set_pid_list).start()
+        while not self.quit_loop and not self.resolver.all_found:
             print 'Waiting for process: %s' % ', '.join(proc_list)
-            time.sleep(0.2)
+            self.resolver.wait_all(timeout=0.2)
         self.is_waiting = False
         if self.quit_loop:
-            return
-        print 'Found PID: %s' % ', '.join(map(str, real_pid_list))
-        lib = self.libdivert_ref
-        arr_len = len(real_pid_list)
-        arr_type = c_int32 * arr_len
-        lib.emulator_set_pid_list(self.config, arr_type(*real_pid_list), arr_len)
+            self._stop_resolver()
+
+    def _stop_resolver(self):
+        resolver, self.resolver = self.resolver, None
+        if resolver is not None:
+            resolver.stop()
 
     def set_dump(self, directory):
         lib = self.libdivert_ref
         if not os.path.isdir:
             raise RuntimeError('Invalid save position.')
         lib.emulator_set_dump_pcap(self.config, directory)
+        self.dump_dir = directory
 
     def start(self, filter_str=''):
         # first check the config
         lib = self.libdivert_ref
+        self.quit_loop = False
         if lib.emulator_config_check(self.config, self.errmsg) != 0:
             raise RuntimeError('Invalid configuration:\n%s' % self.errmsg.value)
         print 'Config check OK'
@@ -380,6 +507,7 @@ class Emulator(object):
         if filter_str:
             if lib.divert_update_ipfw(self.handle, filter_str) != 0:
                 raise RuntimeError(self.handle.errmsg)
+            self.filter_str = filter_str
         # start a new thread to run emulator
         self.thread = threading.Thread(target=self._divert_loop, args=(filter_str,))
         self.thread.start()
@@ -389,13 +517,35 @@ class Emulator(object):
         # then just use a quit loop flag
         if self.is_waiting:
             self.quit_loop = True
+            resolver = self.resolver
+            if resolver is not None:
+                resolver.stop()
         else:
+            # keeps a loop paused by replace_pipes() from reading again
+            self.quit_loop = True
+            self._stop_resolver()
             self._divert_loop_stop()
         self.thread.join(timeout=1.0)
         if self.thread.isAlive():
             raise RuntimeError('Divert loop failed to stop.')
         self.thread = None
 
+    def reset(self):
+        """
+        Free all pipes and forget PIDs of a stopped emulator, so that it
+        could be started again with another configuration, while the
+        divert handle and emulator config are kept
+        """
+        if self.is_looping:
+            raise RuntimeError('Emulator is running.')
+        for pipe_list in self.pipes.values():
+            for pipe in list(pipe_list):
+                self.del_pipe(pipe, free_mem=True)
+        self._free_retired()
+        self.pid_list = []
+        self.quit_loop = False
+        self.is_waiting = False
+
     @property
     def is_looping(self):
         return self.thread is not None and self.thread.isAlive()
@@ -404,6 +554,173 @@ class Emulator(object):
         lib = self.libdivert_ref
         return lib.emulator_data_size(self.config, direction)
 
+    def stats(self):
+        """
+        Snapshot of runtime statistics. Per pipe counters are not implemented
+        for live pipes yet: libdivert only exposes the data size of each
+        direction, so pipe entries have the keys of PipeStats.snapshot() with
+        every counter set to None and 'counters' set to False. Counters of
+        offline runs are returned by ReplayEmulator.stats().
+        """
+        with self.pipe_lock:
+            pipes = dict((direction, list(pipe_list))
+                         for direction, pipe_list in self.pipes.items())
+            num_retired = len(self.retired_pipes)
+        result = {
+            'running': self.is_looping,
+            'retired_pipes': num_retired,
+        }
+        for direction, name in ((Flags.DIRECTION_IN, 'in'), (Flags.DIRECTION_OUT, 'out')):
+            result[name] = {
+                'data_size': self.data_size(direction),
+                'pipes': [dict(PipeStats.unavailable(pipe.queue_size), pipe=pipe.pipe_name)
+                          for pipe in pipes[direction]],
+            }
+        return result
+
+    def load_config(self, conf_list):
+        """
+        Create pipes from the json configuration and add them
+        """
+        for dir_flag, pipe_list in self.create_pipes(conf_list).items():
+            for pipe_obj in pipe_list:
+                self.add_pipe(pipe_obj, dir_flag)
+        return self
+
+    @classmethod
+    def create_pipes(cls, conf_list):
+        """
+        Create pipes from the json configuration, without adding them
+        :return: dict of direction flag to list of pipes, see replace_pipes()
+        """
+        pipes = {
+            Flags.DIRECTION_IN: [],
+            Flags.DIRECTION_OUT: [],
+        }
+        for pipe in copy.deepcopy(conf_list):
+            if not isinstance(pipe, dict):
+                raise TypeError('Invalid configuration')
+            pipe_name = pipe.pop('pipe', None)
+            if not pipe_name:
+                raise RuntimeError('Configuration do not have pipe type')
+            direction = pipe.pop('direction', None)
+            if not direction:
+                raise RuntimeError('Configuration do not have direction field')
+            if direction == "out":
+                dir_flag = Flags.DIRECTION_OUT
+            elif direction == "in":
+                dir_flag = Flags.DIRECTION_IN
+            else:
+                raise RuntimeError('Unknown direction flag')
+            ip_filter = cls._create_ip_filter(pipe.pop('ip_filter', None))
+            size_filter = cls._create_size_filter(pipe.pop('size_filter', None))
+            try:
+                pipe_type = cls.pipe_name2type[pipe_name.lower()]
+            except:
+                raise RuntimeError('Invalid pipe type')
+            pipe_obj = pipe_type(ip_filter_obj=ip_filter,
+                                 size_filter_obj=size_filter, **pipe)
+            pipes[dir_flag].append(pipe_obj)
+        return pipes
+
+    @staticmethod
+    def _create_size_filter(filter_dict):
+        if not filter_dict:
+            return None
+        size_arr = filter_dict['size']
+        rate_arr = filter_dict['rate']
+        return Emulator.PacketSizeFilter(size_arr, rate_arr)
+
+    @staticmethod
+    def _create_ip_filter(filter_dict):
+        if not filter_dict:
+            return None
+        src_str = filter_dict['src']
+        dst_str = filter_dict['dst']
+        strip_func = lambda x: x.strip()
+        src_addr, port_src = map(strip_func, src_str.split(':'))
+        src_addr, src_mask = map(strip_func, src_addr.split('/'))
+        dst_addr, port_dst = map(strip_func, dst_str.split(':'))
+        dst_addr, dst_mask = map(strip_func, dst_addr.split('/'))
+        return Emulator.PacketIPFilter(src_addr, src_mask,
+                                       dst_addr, dst_mask,
+                                       int(port_src), int(port_dst))
+
+
+def load_config_file(file_path):
+    """
+    Read a json configuration, profile references are relative to the json file
+    """
+    with open(file_path, 'r') as fid:
+        return resolve_profiles(json.loads(fid.read()), os.path.dirname(file_path))
+
+
+class EmulatorSession(object):
+    """
+    Keep one emulator between runs, so that restarting with another
+    configuration only swaps pipes, PIDs and filter rule, instead of
+    creating and activating a new divert handle and config each time.
+    Dump position, device and filter rule could only be replaced,
+    so a new emulator is created if a run needs to remove them.
+    """
+
+    def __init__(self):
+        self.emulator = None
+        self.num_cold = 0
+        self.num_warm = 0
+
+    def acquire(self, filter_str='', pid_list=(), dump_dir=None, device=None):
+        """
+        :return: a stopped emulator without pipes
+        """
+        emulator = self.emulator
+        if emulator is not None:
+            emulator.reset()
+            if (emulator.dump_dir and emulator.dump_dir != dump_dir) or \
+                    (emulator.device and emulator.device != device) or \
+                    (emulator.filter_str and not filter_str):
+                emulator = None
+        if emulator is None:
+            # the old one is released before creating another
+            self.emulator = None
+            self.emulator = emulator = Emulator()
+            self.num_cold += 1
+        else:
+            self.num_warm += 1
+        return emulator
+
+    def start(self, conf_list, filter_str='', pid_list=(), dump_dir=None, device=None):
+        """
+        :param conf_list: json configuration of pipes
+        :param pid_list: PIDs or process names, see Emulator.add_pid()
+        :return: the running emulator
+        """
+        emulator = self.acquire(filter_str, pid_list, dump_dir, device)
+        if dump_dir and dump_dir != emulator.dump_dir:
+            emulator.set_dump(dump_dir)
+        if device and device != emulator.device:
+            emulator.set_device(device)
+        for pid in pid_list:
+            emulator.add_pid(pid)
+        emulator.load_config(conf_list)
+        emulator.start(filter_str)
+        return emulator
+
+    def stop(self):
+        if self.emulator is not None and self.emulator.thread is not None:
+            try:
+                self.emulator.stop()
+            except Exception:
+                # an emulator failed to stop could not be reused
+                self.emulator = None
+                raise
+
+    def close(self):
+        try:
+            self.stop()
+        finally:
+            self.emulator = None
+
 
 class EmulatorGUI(object):
     LOCAL_MODE = 0
@@ -429,23 +746,14 @@ class EmulatorGUI(object):
     2. Reboot.
     """
 
-    pipe_name2type = {
-        'drop': DropPipe,
-        'delay': DelayPipe,
-        'biterr': BiterrPipe,
-        'disorder': DisorderPipe,
-        'throttle': ThrottlePipe,
-        'duplicate': DuplicatePipe,
-        'bandwidth': BandwidthPipe,
-    }
+    pipe_name2type = Emulator.pipe_name2type
 
     def exit_func(self):
-        if self.emulator is not None:
-            try:
-                self.emulator.stop()
-                self.emulator = None
-            except Exception as e:
-                print e.message
+        try:
+            self.emulator = None
+            self.session.close()
+        except Exception as e:
+            print e.message
         self._flush_ipfw()
         self.master.quit()
         self.master.destroy()
@@ -479,8 +787,11 @@ class EmulatorGUI(object):
                         return
 
     def __init__(self, master):
+        _import_gui()
         self.master = master
+        # emulator is not None while running
         self.emulator = None
+        self.session = EmulatorSession()
 
         self.conf_dict = {}
         self.conf_name = tk.StringVar()
@@ -517,7 +828,8 @@ class EmulatorGUI(object):
         self.init_GUI()
 
         try:
-            Emulator()
+            # also loads the kernel extension, and is kept for the first start
+            self.session.acquire()
         except OSError:
             def close_func():
                 self.master.quit()
@@ -610,16 +922,15 @@ class EmulatorGUI(object):
         if file_path and os.path.isfile(file_path):
             try:
                 _, fname = os.path.split(file_path)
-                with open(file_path, 'r') as fid:
-                    data = fid.read()
-                    self.conf_dict[file_path] = json.loads(data)
-                    fname_sec = fname.split('.')
-                    if len(fname_sec) > 1:
-                        fname = '.'.join(fname_sec[:-1])
-                    tk.Radiobutton(self.conf_frame, text=fname,
-                                   variable=self.conf_name,
-                                   value=file_path).pack(side=tk.LEFT)
-                    self.conf_name.set(file_path)
+                self.conf_dict[file_path] = load_config_file(file_path)
+                fname_sec = fname.split('.')
+                if len(fname_sec) > 1:
+                    fname = '.'.join(fname_sec[:-1])
+                tk.Radiobutton(self.conf_frame, text=fname,
+                               variable=self.conf_name,
+                               value=file_path,
+                               command=self.switch_config).pack(side=tk.LEFT)
+                self.conf_name.set(file_path)
             except Exception as e:
                 showerror(title='Open file',
                           message='Unable to load json: %s' % e.message)
@@ -642,9 +953,8 @@ class EmulatorGUI(object):
             return
         if self.emulator is None:
             try:
-                self.emulator = Emulator()
-                self._load_config()
-                self.emulator.start(self.filter_str.get())
+                self.emulator = self.session.start(self.conf_dict[self.conf_name.get()],
+                                                   self.filter_str.get(), **self._load_config())
                 self.start_btn.config(text='Stop')
             except Exception as e:
                 self.emulator = None
@@ -652,7 +962,7 @@ class EmulatorGUI(object):
                           message='Unable to start emulator:\n%s' % e.message)
         else:
             try:
-                self.emulator.stop()
+                self.session.stop()
                 self.emulator = None
                 self.start_btn.config(text='Start')
             except Exception as e:
@@ -661,126 +971,57 @@ class EmulatorGUI(object):
                           message='Unable to stop emulator:\n%s' % e.message)
 
     def _load_config(self):
-        if self.emulator is None:
-            return
+        """
+        :return: settings of EmulatorSession.start() from GUI
+        """
+        settings = {'pid_list': []}
         # set dump position
         dump_path = self.dump_pos.get()
         if dump_path and os.path.isdir(dump_path):
-            self.emulator.set_dump(dump_path)
+            settings['dump_dir'] = dump_path
         # set emulation device
         dev_name = self.dev_str.get()
         if dev_name:
-            self.emulator.set_device(dev_name)
+            settings['device'] = dev_name
         # set pid list if not empty
+        pid_list = settings['pid_list']
         if self.mode.get() == self.LOCAL_MODE:
             pid_str = self.proc_str.get().strip()
             if pid_str and pid_str != self.prompt_str:
                 if self.divert_unknown.get():
-                    self.emulator.add_pid(-1)
+                    pid_list.append(-1)
                 for pid in map(lambda x: x.strip(), pid_str.split(',')):
                     try:
-                        pid_int = int(pid)
-                        self.emulator.add_pid(pid_int)
+                        pid_list.append(int(pid))
                     except:
-                        self.emulator.add_pid(pid)
+                        pid_list.append(pid)
         elif self.mode.get() == self.ROUTER_MODE:
             # this is a fake PID, nothing would match
-            self.emulator.add_pid(-2)
+            pid_list.append(-2)
         else:
             raise RuntimeError("Unknown Mode!")
-        # finally load all pipes
-        for pipe in copy.deepcopy(self.conf_dict[self.conf_name.get()]):
-            if not isinstance(pipe, dict):
-                raise TypeError('Invalid configuration')
-            pipe_name = pipe.pop('pipe', None)
-            if not pipe_name:
-                raise RuntimeError('Configuration do not have pipe type')
-            direction = pipe.pop('direction', None)
-            if not direction:
-                raise RuntimeError('Configuration do not have direction field')
-            if direction == "out":
-                dir_flag = Flags.DIRECTION_OUT
-            elif direction == "in":
-                dir_flag = Flags.DIRECTION_IN
-            else:
-                raise RuntimeError('Unknown direction flag')
-            ip_filter = self._create_ip_filter(pipe.pop('ip_filter', None))
-            size_filter = self._create_size_filter(pipe.pop('size_filter', None))
-            try:
-                pipe_type = self.pipe_name2type[pipe_name.lower()]
-            except:
-                raise RuntimeError('Invalid pipe type')
-            pipe_obj = pipe_type(ip_filter_obj=ip_filter,
-                                 size_filter_obj=size_filter, **pipe)
-            self.emulator.add_pipe(pipe_obj, dir_flag)
-
-    def _create_size_filter(self, filter_dict):
-        if not filter_dict:
-            return None
-        size_arr = filter_dict['size']
-        rate_arr = filter_dict['rate']
-        return Emulator.PacketSizeFilter(size_arr, rate_arr)
-
-    def _create_ip_filter(self, filter_dict):
-        if not filter_dict:
-            return None
-        src_str = filter_dict['src']
-        dst_str = filter_dict['dst']
-        strip_func = lambda x: x.strip()
-        src_addr, port_src = map(strip_func, src_str.split(':'))
-        src_addr, src_mask = map(strip_func, src_addr.split('/'))
-        dst_addr, port_dst = map(strip_func, dst_str.split(':'))
-        dst_addr, dst_mask = map(strip_func, dst_addr.split('/'))
-        return Emulator.PacketIPFilter(src_addr, src_mask,
-                                       dst_addr, dst_mask,
-                                       int(port_src), int(port_dst))
+        return settings
+
+    def switch_config(self):
+        """
+        Apply the selected configuration to the running emulator, queued
+        packets are not flushed and the divert handle is kept, new packets are
+        not read while pipes are swapped, see Emulator.replace_pipes()
+        """
+        if self.emulator is None or not self.emulator.is_looping:
+            return
+        try:
+            pipes = Emulator.create_pipes(self.conf_dict[self.conf_name.get()])
+            for dir_flag, pipe_list in pipes.items():
+                self.emulator.replace_pipes(dir_flag, pipe_list)
+                # packets wait in the divert socket while the chain is swapped
+                print 'Switched %s pipes, loop paused for %.3f ms' % (
+                    'inbound' if dir_flag == Flags.DIRECTION_IN else 'outbound',
+                    self.emulator.last_replace_window * 1000)
+        except Exception as e:
+            showerror(title='Runtime error',
+                      message='Unable to switch configuration:\n%s' % e.message)
 
     def mainloop(self):
         self.master.mainloop()
 
-
-if __name__ == '__main__':
-
-    pid_num = 0
-
-    try:
-        pid_num = int(sys.argv[1])
-    except Exception as e:
-        print 'Exception: %s' % e.message
-        print 'Usage: python emulator.py <PID>'
-        exit(-1)
-
-    emulator = Emulator()
-    emulator.add_pid(pid_num)
-    emulator.add_pid(-1)
-    emulator.set_dump('/Users/baidu/Downloads')
-
-    emulator.add_pipe(DelayPipe([0, 10], [0.1, 0.6], 1024), Flags.DIRECTION_IN)
-
-    is_looping = True
-
-    # register signal handler
-    def sig_handler(signum, frame):
-        print 'Catch signal: %d' % signum
-        global is_looping
-        is_looping = False
-    signal.signal(signal.SIGINT, sig_handler)
-    signal.signal(signal.SIGTSTP, sig_handler)
-
-    perMB = 1024 * 1024
-
-    trans_size = 0
-    # start loop
-    emulator.start('ip from any to any via en0')
-    while is_looping:
-        data_size = emulator.data_size(Flags.DIRECTION_IN)
-        if data_size > 5 * perMB:
-            print 'Finish'
-            break
-        if data_size > (trans_size + 1) * perMB:
-            trans_size = data_size / perMB
-            print 'Transfer %d MB data.' % trans_size
-        time.sleep(0.5)
-    # stop loop
-    emulator.stop()
-    print 'Program exited.'
@@ -6,6 +6,10 @@ class Defaults(object):
     SOCKET_ADDR_SIZE = 16
     DIVERT_ERRBUF_SIZE = 256
     IPFW_RULE_SIZE = 192
+    PACKET_BUF_SIZE = 2048
+    BUFFER_POOL_SIZE = 1024
+    RING_CAPACITY = 8192
+    PROC_CACHE_SIZE = 256
 
 
 class Flags(object):
@@ -0,0 +1,315 @@
+# encoding: utf8
+
+import time
+import struct
+import numpy as np
+
+__author__ = 'huangyan13@baidu.com'
+
+
+class FlowTable(object):
+    """
+    Table of per-flow counters keyed by 5-tuple, for TCP, UDP and any other
+    IP protocol. Entries live in preallocated NumPy arrays with open
+    addressing and linear probing, so there is no Python object per flow.
+    Both directions of a connection share one entry, the endpoint which
+    sends the first packet is stored as src.
+
+        table = FlowTable(idle_timeout=30)
+        packet = fid.read()
+        table.update_packet(packet, fid.is_inbound(packet.sockaddr))
+        ...
+        table.expire()
+        flows = table.snapshot()
+    """
+    # state of slots
+    EMPTY = 0
+    USED = 1
+    DELETED = 2
+
+    # direction flags, same values as emulator.Flags
+    DIRECTION_IN = 0
+    DIRECTION_OUT = 1
+
+    snapshot_dtype = np.dtype([
+        ('proto', np.uint8), ('src', np.uint32), ('sport', np.uint16),
+        ('dst', np.uint32), ('dport', np.uint16),
+        ('packets', np.uint64), ('bytes', np.uint64),
+        ('first_ts', np.float64), ('last_ts', np.float64),
+        ('direction', np.int8), ('pid', np.int32),
+    ])
+
+    _ip_header = struct.Struct('!B8xB2xII')
+    _ports = struct.Struct('!HH')
+
+    def __init__(self, capacity=1 << 16, idle_timeout=60.0,
+                 max_capacity=1 << 24, max_load=0.5):
+        """
+        :param capacity: initial number of slots, rounded up to power of two
+        :param idle_timeout: seconds without packets before a flow is expired
+        :param max_capacity: the table never grows beyond this number of slots,
+                             least recently active flows are evicted instead
+        :param max_load: fraction of occupied slots which triggers resize
+        """
+        size = 1
+        while size < capacity:
+            size <<= 1
+        self.idle_timeout = idle_timeout
+        self.max_capacity = max(size, max_capacity)
+        self.max_load = max_load
+        # flows removed to make room, and flows removed for being idle
+        self.num_evicted = 0
+        self.num_expired = 0
+        # newest timestamp passed to update(), the clock of automatic expiry
+        self._latest_ts = 0.
+        self._allocate(size)
+
+    def _allocate(self, capacity):
+        self.capacity = capacity
+        self._mask = capacity - 1
+        self._state = np.zeros(capacity, dtype=np.uint8)
+        # addresses and ports of both ends packed into two 64 bits words,
+        # signed so that comparing with Python integers is exact
+        self._addrs = np.zeros(capacity, dtype=np.int64)
+        self._ports_proto = np.zeros(capacity, dtype=np.int64)
+        # the initiator is the second end of the key
+        self._swapped = np.zeros(capacity, dtype=np.bool_)
+        self._packets = np.zeros(capacity, dtype=np.uint64)
+        self._bytes = np.zeros(capacity, dtype=np.uint64)
+        self._first_ts = np.zeros(capacity, dtype=np.float64)
+        self._last_ts = np.zeros(capacity, dtype=np.float64)
+        self._direction = np.zeros(capacity, dtype=np.int8)
+        self._pid = np.zeros(capacity, dtype=np.int32)
+        self._num_used = 0
+        self._num_deleted = 0
+
+    def __len__(self):
+        return self._num_used
+
+    @staticmethod
+    def _hash(addrs, ports_proto):
+        # multiplicative mixing of the unsigned key words
+        h = ((addrs & 0xFFFFFFFFFFFFFFFF) * 0x9E3779B97F4A7C15 ^
+             ports_proto * 0xC2B2AE3D27D4EB4F) & 0xFFFFFFFFFFFFFFFF
+        return h ^ (h >> 29)
+
+    @staticmethod
+    def _hash_array(addrs, ports_proto):
+        """
+        Same as _hash() on arrays of keys
+        """
+        h = (addrs.view(np.uint64) * np.uint64(0x9E3779B97F4A7C15) ^
+             ports_proto.view(np.uint64) * np.uint64(0xC2B2AE3D27D4EB4F))
+        return h ^ (h >> np.uint64(29))
+
+    @staticmethod
+    def _key(proto, src, sport, dst, dport):
+        """
+        :return: (addrs, ports_proto, swapped) of the direction independent key
+        """
+        if (src, sport) <= (dst, dport):
+            addrs, ports_proto, swapped = (src << 32) | dst, (proto << 32) | (sport << 16) | dport, False
+        else:
+            addrs, ports_proto, swapped = (dst << 32) | src, (proto << 32) | (dport << 16) | sport, True
+        if addrs >= 1 << 63:
+            addrs -= 1 << 64
+        return addrs, ports_proto, swapped
+
+    def _find(self, addrs, ports_proto):
+        """
+        :return: (slot, found), slot is where the key should be inserted if not found
+        """
+        # item() and itemset() avoid creating NumPy scalars on the per-packet path
+        state = self._state.item
+        mask = self._mask
+        i = self._hash(addrs, ports_proto) & mask
+        insert_at = None
+        while True:
+            slot_state = state(i)
+            if slot_state == self.EMPTY:
+                return (i if insert_at is None else insert_at), False
+            if slot_state == self.USED:
+                if self._addrs.item(i) == addrs and self._ports_proto.item(i) == ports_proto:
+                    return i, True
+            elif insert_at is None:
+                insert_at = i
+            i = (i + 1) & mask
+
+    def update(self, proto, src, sport, dst, dport, size, ts=None,
+               direction=DIRECTION_OUT, pid=-1):
+        """
+        Account one packet of a flow
+        :param src: source address as integer
+        :param size: length of IP packet in bytes
+        :param ts: timestamp of packet, default to current time
+        :param direction: direction of the packet, DIRECTION_IN or DIRECTION_OUT
+        :param pid: owning process ID, -1 if unknown
+        :return: slot of the flow
+        """
+        if ts is None:
+            ts = time.time()
+        if ts > self._latest_ts:
+            self._latest_ts = ts
+        addrs, ports_proto, swapped = self._key(proto, src, sport, dst, dport)
+        i, found = self._find(addrs, ports_proto)
+        if not found:
+            if (self._num_used + self._num_deleted + 1) > self.max_load * self.capacity:
+                self._resize()
+                i, found = self._find(addrs, ports_proto)
+            if self._state.item(i) == self.DELETED:
+                self._num_deleted -= 1
+            self._state.itemset(i, self.USED)
+            self._num_used += 1
+            self._addrs.itemset(i, addrs)
+            self._ports_proto.itemset(i, ports_proto)
+            # keep the endpoint which sends first as source
+            self._swapped.itemset(i, swapped)
+            self._packets.itemset(i, 1)
+            self._bytes.itemset(i, size)
+            self._first_ts.itemset(i, ts)
+            self._last_ts.itemset(i, ts)
+            self._direction.itemset(i, direction)
+            self._pid.itemset(i, pid)
+            return i
+        if pid != -1 and self._pid.item(i) == -1:
+            self._pid.itemset(i, pid)
+        self._packets.itemset(i, self._packets.item(i) + 1)
+        self._bytes.itemset(i, self._bytes.item(i) + size)
+        self._last_ts.itemset(i, ts)
+        return i
+
+    def update_packet(self, packet, inbound, ts=None):
+        """
+        Account a Packet read from DivertHandle
+        :param inbound: result of DivertHandle.is_inbound() on the packet
+        :return: slot of the flow, or None if the packet is not valid
+        """
+        data = packet.ip_data
+        if not packet.valid or data is None or len(data) < 20:
+            return None
+        vhl, proto, src, dst = self._ip_header.unpack_from(data, 0)
+        sport = dport = 0
+        offset = (vhl & 0x0f) * 4
+        if proto in (6, 17) and len(data) >= offset + 4:
+            sport, dport = self._ports.unpack_from(data, offset)
+        pid = packet.proc.pid if packet.proc is not None else -1
+        return self.update(proto, src, sport, dst, dport, len(data), ts,
+                           self.DIRECTION_IN if inbound else self.DIRECTION_OUT, pid)
+
+    def _used_slots(self):
+        return np.flatnonzero(self._state == self.USED)
+
+    def _resize(self):
+        """
+        Grow the table, or rehash to clean deleted slots, or evict
+        least recently active flows if the table could not grow
+        """
+        capacity = self.capacity
+        if self._num_used + 1 > self.max_load * capacity / 2:
+            if capacity < self.max_capacity:
+                capacity *= 2
+            else:
+                # packets may come from a capture file, so its time is used
+                self.expire(self._latest_ts)
+                if self._num_used + 1 > self.max_load * capacity / 2:
+                    self._evict_oldest(self._num_used // 8 + 1)
+        slots = self._used_slots()
+        columns = [column[slots] for column in self._columns()]
+        self._allocate(capacity)
+        self._insert_columns(columns)
+
+    def _columns(self):
+        return (self._addrs, self._ports_proto, self._swapped, self._packets, self._bytes,
+                self._first_ts, self._last_ts, self._direction, self._pid)
+
+    def _insert_columns(self, columns):
+        addrs, ports_proto = columns[0], columns[1]
+        mask = self._mask
+        state = self._state
+        # the probing order is sequential, but hashes are vectorized
+        hashes = self._hash_array(addrs, ports_proto) & np.uint64(mask)
+        slots = np.empty(len(addrs), dtype=np.int64)
+        for n, i in enumerate(hashes.tolist()):
+            while state[i] != self.EMPTY:
+                i = (i + 1) & mask
+            state[i] = self.USED
+            slots[n] = i
+        for column, values in zip(self._columns(), columns):
+            column[slots] = values
+        self._num_used = len(slots)
+
+    def _evict_oldest(self, num):
+        slots = self._used_slots()
+        num = min(num, len(slots))
+        oldest = slots[np.argpartition(self._last_ts[slots], num - 1)[:num]]
+        self._delete(oldest)
+        self.num_evicted += len(oldest)
+
+    def _delete(self, slots):
+        self._state[slots] = self.DELETED
+        self._num_used -= len(slots)
+        self._num_deleted += len(slots)
+
+    def _export(self, slots):
+        result = np.empty(len(slots), dtype=self.snapshot_dtype)
+        addrs = self._addrs[slots].view(np.uint64)
+        ports_proto = self._ports_proto[slots].view(np.uint64)
+        swapped = self._swapped[slots]
+        low_addr = addrs & np.uint64(0xFFFFFFFF)
+        high_addr = addrs >> np.uint64(32)
+        low_port = ports_proto & np.uint64(0xFFFF)
+        high_port = (ports_proto >> np.uint64(16)) & np.uint64(0xFFFF)
+        result['proto'] = (ports_proto >> np.uint64(32)) & np.uint64(0xFF)
+        result['src'] = np.where(swapped, low_addr, high_addr)
+        result['sport'] = np.where(swapped, low_port, high_port)
+        result['dst'] = np.where(swapped, high_addr, low_addr)
+        result['dport'] = np.where(swapped, high_port, low_port)
+        result['packets'] = self._packets[slots]
+        result['bytes'] = self._bytes[slots]
+        result['first_ts'] = self._first_ts[slots]
+        result['last_ts'] = self._last_ts[slots]
+        result['direction'] = self._direction[slots]
+        result['pid'] = self._pid[slots]
+        return result
+
+    def expire(self, now=None):
+        """
+        Remove flows idle for longer than idle_timeout
+        :param now: current time, default to wall clock time,
+                    pass the time of packets if they are replayed
+        :return: snapshot of the expired flows, see snapshot()
+        """
+        if now is None:
+            now = time.time()
+        slots = np.flatnonzero((self._state == self.USED) &
+                               (self._last_ts < now - self.idle_timeout))
+        expired = self._export(slots)
+        self._delete(slots)
+        self.num_expired += len(slots)
+        return expired
+
+    def snapshot(self):
+        """
+        :return: NumPy structured array of all active flows, with fields of
+                 snapshot_dtype, addresses are integers in host byte order
+        """
+        return self._export(self._used_slots())
+
+    def get(self, proto, src, sport, dst, dport):
+        """
+        :return: snapshot record of one flow, or None if not found
+        """
+        addrs, ports_proto, _ = self._key(proto, src, sport, dst, dport)
+        i, found = self._find(addrs, ports_proto)
+        if not found:
+            return None
+        return self._export([i])[0]
+
+    def save(self, filename):
+        """
+        Save snapshot of active flows into a .npy file
+        """
+        np.save(filename, self.snapshot())
+
+    def clear(self):
+        self._allocate(self.capacity)
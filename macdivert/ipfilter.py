@@ -0,0 +1,296 @@
+# encoding: utf8
+
+import socket
+import struct
+
+__author__ = 'huangyan13@baidu.com'
+
+
+class FilterProto(object):
+    # protocol names accepted in rules, None means any protocol
+    names = {
+        'ip': None,
+        'all': None,
+        'icmp': socket.IPPROTO_ICMP,
+        'tcp': socket.IPPROTO_TCP,
+        'udp': socket.IPPROTO_UDP,
+    }
+    # TCP flag bits accepted by tcpflags option
+    tcp_flags = {
+        'fin': 0x01,
+        'syn': 0x02,
+        'rst': 0x04,
+        'psh': 0x08,
+        'ack': 0x10,
+        'urg': 0x20,
+        'ece': 0x40,
+        'cwr': 0x80,
+    }
+
+
+# maximum number of compiled filters kept in cache
+FILTER_CACHE_SIZE = 1024
+
+_filter_cache = {}
+_ip_header = struct.Struct('!BxHxxHxB2xII')
+_ports = struct.Struct('!HH')
+_byte = struct.Struct('!B')
+
+
+def _error(rule, msg):
+    return RuntimeError("Error rule: %s (%s)" % (rule, msg))
+
+
+def _parse_addr(rule, token):
+    """
+    :return: tuple of (network, mask) pairs, None means any address
+    """
+    if token == 'any':
+        return None
+    if token.startswith('{') and token.endswith('}'):
+        token = token[1:-1]
+    nets = []
+    for item in token.split(','):
+        addr, _, bits = item.partition('/')
+        try:
+            value = struct.unpack('!I', socket.inet_aton(addr))[0]
+            bits = int(bits) if bits else 32
+        except (socket.error, ValueError):
+            raise _error(rule, "bad address %s" % item)
+        if not 0 <= bits <= 32:
+            raise _error(rule, "bad mask %s" % item)
+        mask = (0xffffffff << (32 - bits)) & 0xffffffff
+        nets.append((value & mask, mask))
+    return tuple(nets)
+
+
+def _parse_ports(rule, token):
+    """
+    :return: tuple of (low, high) port ranges
+    """
+    ranges = []
+    for item in token.split(','):
+        low, _, high = item.partition('-')
+        try:
+            low = int(low)
+            high = int(high) if high else low
+        except ValueError:
+            raise _error(rule, "bad port %s" % item)
+        ranges.append((low, high))
+    return tuple(ranges)
+
+
+class _PortRanges(object):
+    """
+    Container of wide port ranges, which are too large for a set
+    """
+
+    def __init__(self, ranges):
+        self.ranges = ranges
+
+    def __contains__(self, port):
+        for low, high in self.ranges:
+            if low <= port <= high:
+                return True
+        return False
+
+
+def _port_set(ranges):
+    """
+    :return: container of ports with fast membership test
+    """
+    if sum(high - low + 1 for low, high in ranges) <= 4096:
+        ports = set()
+        for low, high in ranges:
+            ports.update(xrange(low, high + 1))
+        return frozenset(ports)
+    return _PortRanges(ranges)
+
+
+def _is_ports(token):
+    return token[0].isdigit()
+
+
+def _parse_tcp_flags(rule, token):
+    """
+    :return: (set_bits, clear_bits)
+    """
+    set_bits = clear_bits = 0
+    for name in token.split(','):
+        negate = name.startswith('!')
+        bit = FilterProto.tcp_flags.get(name.lstrip('!'))
+        if bit is None:
+            raise _error(rule, "unknown tcp flag %s" % name)
+        if negate:
+            clear_bits |= bit
+        else:
+            set_bits |= bit
+    return set_bits, clear_bits
+
+
+def _parse(rule):
+    """
+    Parse rule like "tcp from 10.0.0.0/8 80,443 to not any 1000-2000 in tcpflags syn,!ack"
+    :return: dict of match conditions
+    """
+    tokens = rule.split()
+    cond = {'proto': None, 'src': None, 'src_not': False, 'sport': None,
+            'dst': None, 'dst_not': False, 'dport': None, 'inbound': None,
+            'flags': None}
+    if not tokens:
+        raise _error(rule, "empty rule")
+    name = tokens.pop(0)
+    if name in FilterProto.names:
+        cond['proto'] = FilterProto.names[name]
+    elif name.isdigit():
+        cond['proto'] = int(name)
+    else:
+        raise _error(rule, "unknown protocol %s" % name)
+    for side in ('src', 'dst'):
+        keyword = 'from' if side == 'src' else 'to'
+        if not tokens or tokens.pop(0) != keyword:
+            raise _error(rule, "missing %s" % keyword)
+        if tokens and tokens[0] == 'not':
+            tokens.pop(0)
+            cond[side + '_not'] = True
+        if not tokens:
+            raise _error(rule, "missing address")
+        cond[side] = _parse_addr(rule, tokens.pop(0))
+        if cond[side] is None and cond[side + '_not']:
+            raise _error(rule, "not any matches nothing")
+        if tokens and _is_ports(tokens[0]):
+            cond[side[0] + 'port'] = _parse_ports(rule, tokens.pop(0))
+    # options
+    while tokens:
+        option = tokens.pop(0)
+        if option in ('in', 'out'):
+            cond['inbound'] = option == 'in'
+        elif option in ('via', 'recv', 'xmit'):
+            # packets are already filtered by interface on divert socket
+            if not tokens:
+                raise _error(rule, "missing interface")
+            tokens.pop(0)
+        elif option in ('src-port', 'dst-port'):
+            if not tokens:
+                raise _error(rule, "missing port")
+            cond[option[0] + 'port'] = _parse_ports(rule, tokens.pop(0))
+        elif option == 'tcpflags':
+            if not tokens:
+                raise _error(rule, "missing tcp flags")
+            cond['flags'] = _parse_tcp_flags(rule, tokens.pop(0))
+        elif option == 'setup':
+            cond['flags'] = (0x02, 0x10)
+        elif option == 'established':
+            # ipfw matches packets with RST or ACK set
+            cond['flags'] = 'established'
+        else:
+            raise _error(rule, "unknown option %s" % option)
+    proto = cond['proto']
+    if cond['sport'] is not None or cond['dport'] is not None:
+        if proto not in (None, socket.IPPROTO_TCP, socket.IPPROTO_UDP):
+            raise _error(rule, "ports only apply to tcp and udp")
+    if cond['flags'] is not None:
+        if proto not in (None, socket.IPPROTO_TCP):
+            raise _error(rule, "tcp flags only apply to tcp")
+        cond['proto'] = socket.IPPROTO_TCP
+    return cond
+
+
+def _make_filter(cond):
+    """
+    Build a closure which only performs the checks required by the rule
+    """
+    proto = cond['proto']
+    src, src_not = cond['src'], cond['src_not']
+    dst, dst_not = cond['dst'], cond['dst_not']
+    sport = None if cond['sport'] is None else _port_set(cond['sport'])
+    dport = None if cond['dport'] is None else _port_set(cond['dport'])
+    inbound = cond['inbound']
+    flags = cond['flags']
+    established = flags == 'established'
+    set_bits, clear_bits = (0, 0) if flags is None or established else flags
+    need_ports = sport is not None or dport is not None
+    need_l4 = need_ports or flags is not None
+    unpack_header = _ip_header.unpack_from
+    unpack_ports = _ports.unpack_from
+    unpack_byte = _byte.unpack_from
+    l4_protos = (socket.IPPROTO_TCP, socket.IPPROTO_UDP)
+    tcp = socket.IPPROTO_TCP
+
+    # a single network is checked inline instead of looping over the list
+    src_net, src_mask = src[0] if src is not None and len(src) == 1 else (None, None)
+    dst_net, dst_mask = dst[0] if dst is not None and len(dst) == 1 else (None, None)
+
+    def match_net(addr, nets, negate):
+        for net, mask in nets:
+            if addr & mask == net:
+                return not negate
+        return negate
+
+    def ip_filter(ip_data, is_inbound=None):
+        """
+        :param ip_data: raw IP packet, e.g. Packet.ip_data
+        :param is_inbound: direction of packet, required by in/out rules
+        :return: True if the packet matches the rule
+        """
+        if inbound is not None and is_inbound != inbound:
+            return False
+        if len(ip_data) < 20:
+            return False
+        vhl, total_len, frag, pkt_proto, pkt_src, pkt_dst = unpack_header(ip_data, 0)
+        if proto is not None and pkt_proto != proto:
+            return False
+        if src_mask is not None:
+            if (pkt_src & src_mask == src_net) == src_not:
+                return False
+        elif src is not None and not match_net(pkt_src, src, src_not):
+            return False
+        if dst_mask is not None:
+            if (pkt_dst & dst_mask == dst_net) == dst_not:
+                return False
+        elif dst is not None and not match_net(pkt_dst, dst, dst_not):
+            return False
+        if not need_l4:
+            return True
+        # only the first fragment carries transport header
+        offset = (vhl & 0x0f) * 4
+        if frag & 0x1fff or len(ip_data) < offset + (14 if pkt_proto == tcp else 4):
+            return False
+        if need_ports:
+            if pkt_proto not in l4_protos:
+                return False
+            pkt_sport, pkt_dport = unpack_ports(ip_data, offset)
+            if sport is not None and pkt_sport not in sport:
+                return False
+            if dport is not None and pkt_dport not in dport:
+                return False
+        if flags is not None:
+            # str, bytearray and buffers are all accepted by unpack_from
+            tcp_flags = unpack_byte(ip_data, offset + 13)[0]
+            if established:
+                return tcp_flags & 0x14 != 0
+            return tcp_flags & set_bits == set_bits and tcp_flags & clear_bits == 0
+        return True
+
+    return ip_filter
+
+
+def compile_filter(rule):
+    """
+    Compile a rule in ipfw syntax into a function of (ip_data, is_inbound=None),
+    compiled functions are cached by rule string.
+    Supported syntax:
+        <ip|all|tcp|udp|icmp|number> from [not] <any|addr[/bits][,...]> [ports]
+            to [not] <any|addr[/bits][,...]> [ports] [options]
+    ports are comma separated numbers or ranges like 1000-2000, options are
+    in, out, via/recv/xmit <interface> (ignored), src-port <ports>,
+    dst-port <ports>, tcpflags <[!]flag,...>, setup and established.
+    :raise RuntimeError: if rule could not be parsed
+    """
+    func = _filter_cache.get(rule)
+    if func is None:
+        func = _make_filter(_parse(rule))
+        if len(_filter_cache) >= FILTER_CACHE_SIZE:
+            _filter_cache.clear()
+        _filter_cache[rule] = func
+    return func
@@ -0,0 +1,120 @@
+# encoding: utf8
+
+import sys
+import time
+from ctypes import cdll, Structure, byref, c_uint32, c_uint64, c_long
+from ctypes.util import find_library
+from stats import LogHistogram
+
+__author__ = 'huangyan13@baidu.com'
+
+
+class _MachTimebase(Structure):
+    _fields_ = [('numer', c_uint32), ('denom', c_uint32)]
+
+
+class _Timespec(Structure):
+    _fields_ = [('tv_sec', c_long), ('tv_nsec', c_long)]
+
+
+def _monotonic_ns_func():
+    """
+    :return: function which returns a monotonic clock in integer nanoseconds
+    """
+    try:
+        if sys.platform == 'darwin':
+            libc = cdll.LoadLibrary('libc.dylib')
+            mach_absolute_time = libc.mach_absolute_time
+            mach_absolute_time.argtypes = []
+            mach_absolute_time.restype = c_uint64
+            timebase = _MachTimebase()
+            libc.mach_timebase_info(byref(timebase))
+            if timebase.numer == timebase.denom:
+                return mach_absolute_time
+            numer, denom = timebase.numer, timebase.denom
+            return lambda: mach_absolute_time() * numer // denom
+        libc = cdll.LoadLibrary(find_library('c'))
+        clock_gettime = libc.clock_gettime
+        spec = _Timespec()
+        spec_ref = byref(spec)
+        # CLOCK_MONOTONIC
+        clock_id = 1
+
+        def monotonic_ns():
+            clock_gettime(clock_id, spec_ref)
+            return spec.tv_sec * 1000000000 + spec.tv_nsec
+        monotonic_ns()
+        return monotonic_ns
+    except (OSError, AttributeError, TypeError):
+        # wall clock is the last resort, which may jump
+        return lambda: int(time.time() * 1e9)
+
+
+monotonic_ns = _monotonic_ns_func()
+
+
+class Stage(object):
+    """
+    Timestamps taken on the way of a packet through DivertHandle,
+    each packet keeps them in a list indexed by these values
+    """
+    CALLBACK = 0
+    ENQUEUE = 1
+    DEQUEUE = 2
+
+
+class LatencyTracker(object):
+    """
+    Histograms of time spent by packets in Python, in nanoseconds:
+        callback    from entering ip_callback until queued
+        queue       waiting in the packet queue until read
+        process     from read until write is called
+        reinject    the divert_reinject call itself
+        total       from entering ip_callback until reinjected
+    Each histogram is only updated by one thread, either capture or consumer.
+    """
+    stage_names = ('callback', 'queue', 'process', 'reinject', 'total')
+
+    def __init__(self, sub_bits=3):
+        self.histograms = dict((name, LogHistogram(sub_bits)) for name in self.stage_names)
+        self._callback = self.histograms['callback']
+        self._queue = self.histograms['queue']
+        self._process = self.histograms['process']
+        self._reinject = self.histograms['reinject']
+        self._total = self.histograms['total']
+
+    def on_callback(self, stamps):
+        """
+        :param stamps: list of [callback entry time], enqueue time is appended
+        """
+        now = monotonic_ns()
+        stamps.append(now)
+        self._callback.record(now - stamps[Stage.CALLBACK])
+
+    def on_dequeue(self, packets):
+        now = monotonic_ns()
+        for packet in packets:
+            stamps = packet.stamps
+            if stamps is not None and len(stamps) == Stage.DEQUEUE:
+                stamps.append(now)
+                self._queue.record(now - stamps[Stage.ENQUEUE])
+
+    def on_reinject(self, stamps, start, end):
+        """
+        :param start: time before divert_reinject is called
+        :param end: time after divert_reinject returns
+        """
+        self._reinject.record(end - start)
+        if stamps is None:
+            return
+        if len(stamps) > Stage.DEQUEUE:
+            self._process.record(start - stamps[Stage.DEQUEUE])
+        self._total.record(end - stamps[Stage.CALLBACK])
+
+    def reset(self):
+        for histogram in self.histograms.values():
+            histogram.reset()
+
+    def snapshot(self):
+        return dict((name, histogram.snapshot())
+                    for name, histogram in self.histograms.items())
@@ -1,78 +1,49 @@
 # encoding: utf8
 
 import os
+import time
+import socket
+import struct
 import Queue
 import threading
-import libdivert as nids
-from copy import deepcopy
+try:
+    import libdivert as nids
+except ImportError:
+    # libnids binding is only required by find_tcp_stream()
+    nids = None
+from operator import attrgetter
 from ctypes import cdll
 from enum import Defaults, Flags
-from ctypes import POINTER, pointer, cast
-from ctypes import (c_void_p, c_uint32, c_char_p, c_int, CFUNCTYPE,
-                    create_string_buffer, c_ushort, c_ssize_t, c_char)
+from ctypes import POINTER, pointer, cast, memmove
+from ctypes import (c_void_p, c_char_p, c_int, CFUNCTYPE,
+                    create_string_buffer, c_char)
 from models import ProcInfo, IpHeader, PacketHeader, DivertHandleRaw
+from binding import (load_library, reinject_function, slot_reinject_function,
+                     divert_argtypes, divert_restypes)
+from pool import BufferPool
+from proccache import ProcCache
+from ring import BatchQueue, RingQueue
+from pcap import BufferedPcapWriter
+from latency import LatencyTracker, monotonic_ns
 
 __author__ = 'huangyan13@baidu.com'
 
 
-class MacDivert:
-    divert_argtypes = {
-        # divert functions
-        "divert_create": [c_int, c_uint32],
-        "divert_activate": [POINTER(DivertHandleRaw)],
-        "divert_update_ipfw": [POINTER(DivertHandleRaw), c_char_p],
-        "divert_loop": [POINTER(DivertHandleRaw), c_int],
-        "divert_is_looping": [POINTER(DivertHandleRaw)],
-        "divert_loop_stop": [POINTER(DivertHandleRaw)],
-        "divert_loop_wait": [POINTER(DivertHandleRaw)],
-        "divert_reinject": [POINTER(DivertHandleRaw), c_char_p, c_ssize_t, c_char_p],
-        "divert_close": [POINTER(DivertHandleRaw)],
-        "divert_is_inbound": [c_char_p, c_void_p],
-        "divert_is_outbound": [c_char_p],
-        "divert_set_callback": [c_void_p, c_void_p, c_void_p],
-        "divert_init_pcap": [c_void_p],
-        "divert_dump_pcap": [c_void_p, c_void_p],
-        "divert_find_tcp_stream": [c_char_p],
-        "divert_set_device": [c_void_p, c_char_p],
-
-        # util functions
-        "divert_load_kext": [c_char_p],
-        "divert_unload_kext": [],
-        "divert_dump_packet": [c_char_p, POINTER(PacketHeader), c_uint32, c_char_p],
-
-        # note that we use char[] to store the ipfw rule for convenience
-        # although the type is mismatched, the length of pointer variable is the same
-        # so this would work
-        "ipfw_compile_rule": [c_char_p, c_ushort, c_ushort, c_char_p, c_char_p],
-        "ipfw_print_rule": [c_char_p],
-        "ipfw_flush": [c_char_p],
-    }
+_inet_ntoa = socket.inet_ntoa
+_IPPROTO_TCP = socket.IPPROTO_TCP
 
-    divert_restypes = {
-        "divert_create": POINTER(DivertHandleRaw),
-        "divert_activate": c_int,
-        "divert_update_ipfw": c_int,
-        "divert_loop": c_int,
-        "divert_is_looping": c_int,
-        "divert_loop_stop": None,
-        "divert_loop_wait": None,
-        "divert_reinject": c_ssize_t,
-        "divert_close": c_int,
-        "divert_is_inbound": c_int,
-        "divert_is_outbound": c_int,
-        "divert_set_callback": c_int,
-        "divert_init_pcap": c_int,
-        "divert_dump_pcap": c_int,
-        "divert_find_tcp_stream": c_void_p,
-        "divert_set_device": c_int,
-
-        "divert_load_kext": c_int,
-        "divert_unload_kext": c_int,
-        "divert_dump_packet": c_char_p,
-        "ipfw_compile_rule": c_int,
-        "ipfw_print_rule": None,
-        "ipfw_flush": c_int,
-    }
+_kext_lock = threading.Lock()
+# number of MacDivert instances, handles and emulators using each loaded kernel extension
+_kext_refs = {}
+
+
+class MacDivert:
+    # prototypes are declared in binding module
+    divert_argtypes = divert_argtypes
+    divert_restypes = divert_restypes
+    # instance shared by handles created without libdivert
+    _shared = None
+    _shared_lock = threading.Lock()
 
     def __init__(self, lib_path='', kext_path='', encoding='utf-8'):
         """
@@ -95,9 +66,33 @@ class MacDivert:
         self.dll_path = lib_path
         self.kext_path = kext_path
         self.encoding = encoding
+        self._kext_loaded = False
         self._load_lib(lib_path)
         self._load_kext(kext_path)
 
+    @classmethod
+    def shared(cls):
+        """
+        Return the process-wide instance with default paths,
+        which is created on first call
+        """
+        if cls._shared is None:
+            with cls._shared_lock:
+                if cls._shared is None:
+                    cls._shared = cls()
+        return cls._shared
+
+    @classmethod
+    def close_shared(cls):
+        """
+        Release the process-wide instance, handles and emulators still
+        using it keep working, they hold their own reference of the kext
+        """
+        with cls._shared_lock:
+            instance, cls._shared = cls._shared, None
+        if instance is not None:
+            instance.close()
+
     @staticmethod
     def _find_lib():
         module_path = os.sep.join(__file__.split(os.sep)[0:-1])
@@ -110,22 +105,12 @@ class MacDivert:
 
     def _load_lib(self, lib_path):
         """
-        Loads the libdivert library, and configuring its arguments type
+        Loads the libdivert library, its arguments type are configured only
+        once per process, see binding.load_library()
         :param lib_path: The OS path where to load the libdivert.so
         :return: None
         """
-        self._lib = cdll.LoadLibrary(lib_path)
-
-        # set the types of parameters
-        for func_name, argtypes in self.divert_argtypes.items():
-            # first check if function exists
-            if not hasattr(self._lib, func_name):
-                raise RuntimeError("Not a valid libdivert library")
-            setattr(getattr(self._lib, func_name), "argtypes", argtypes)
-
-        # set the types of return value
-        for func_name, restype in self.divert_restypes.items():
-            setattr(getattr(self._lib, func_name), "restype", restype)
+        self._lib = load_library(lib_path)
 
     @staticmethod
     def chown_recursive(path, uid, gid):
@@ -137,12 +122,53 @@ class MacDivert:
                 os.chown(os.path.join(root, item), uid, gid)
 
     def _load_kext(self, kext_path):
-        uid, gid = os.stat(kext_path).st_uid, os.stat(kext_path).st_gid
-        self.chown_recursive(kext_path, 0, 0)
-        ret_val = self._lib.divert_load_kext(kext_path)
-        self.chown_recursive(kext_path, uid, gid)
-        if ret_val != 0:
-            raise OSError("Could not load kernel extension for libdivert")
+        self.acquire()
+        self._kext_loaded = True
+
+    def acquire(self):
+        """
+        Take a reference of the kernel extension, which is loaded only
+        when nobody in this process holds it. Each instance, open handle
+        and emulator holds one, so that it is not unloaded under them.
+        """
+        kext_path = os.path.realpath(self.kext_path)
+        with _kext_lock:
+            if not _kext_refs.get(kext_path):
+                uid, gid = os.stat(kext_path).st_uid, os.stat(kext_path).st_gid
+                self.chown_recursive(kext_path, 0, 0)
+                ret_val = self._lib.divert_load_kext(kext_path)
+                self.chown_recursive(kext_path, uid, gid)
+                if ret_val != 0:
+                    raise OSError("Could not load kernel extension for libdivert")
+                _kext_refs[kext_path] = 0
+            _kext_refs[kext_path] += 1
+
+    def release(self):
+        """
+        Drop a reference taken by acquire(), the kernel extension
+        is unloaded with the last one
+        """
+        kext_path = os.path.realpath(self.kext_path)
+        with _kext_lock:
+            if not _kext_refs.get(kext_path):
+                raise RuntimeError("Kernel extension is not acquired: %s" % kext_path)
+            if _kext_refs[kext_path] == 1:
+                # the reference is kept if the extension is still loaded
+                if self._lib.divert_unload_kext() != 0:
+                    raise OSError("Could not unload kernel extension for libdivert")
+                del _kext_refs[kext_path]
+            else:
+                _kext_refs[kext_path] -= 1
+
+    def close(self):
+        """
+        Release the reference of this instance, the kernel extension
+        is unloaded when no instance, handle or emulator uses it
+        """
+        if not self._kext_loaded:
+            return
+        self.release()
+        self._kext_loaded = False
 
     def get_reference(self):
         """
@@ -151,16 +177,21 @@ class MacDivert:
         """
         return self._lib
 
-    def open_handle(self, port=0, filter_str="", flags=0, count=-1):
+    def open_handle(self, port=0, filter_str="", flags=0, count=-1,
+                    pool_size=0, ring_size=0, latency=False):
         """
         Return a new handle already opened
         :param port: the port number to be diverted to, use 0 to auto select a unused port
         :param filter_str: the filter string
         :param flags: choose different mode
         :param count: how many packets to divert, negative number means unlimited
+        :param pool_size: number of preallocated packet buffers, 0 to disable buffer pool
+        :param ring_size: capacity of lock-free packet ring for single consumer, 0 to use Queue
+        :param latency: record time spent by packets in Python, see DivertHandle.latency_stats()
         :return: An opened DivertHandle instance
         """
-        return DivertHandle(self, port, filter_str, flags, count, self.encoding).open()
+        return DivertHandle(self, port, filter_str, flags, count,
+                            self.encoding, pool_size, ring_size, latency).open()
 
 
 class DivertHandle:
@@ -168,10 +199,11 @@ class DivertHandle:
                               POINTER(c_char), POINTER(c_char))
 
     def __init__(self, libdivert=None, port=0, filter_str="",
-                 flags=0, count=-1, encoding='utf-8'):
+                 flags=0, count=-1, encoding='utf-8', pool_size=0, ring_size=0,
+                 latency=False):
         if not libdivert:
-            # Try to construct by loading from the library path
-            self._libdivert = MacDivert()
+            # library and kernel extension are loaded only once
+            self._libdivert = MacDivert.shared()
         else:
             self._libdivert = libdivert
 
@@ -181,28 +213,75 @@ class DivertHandle:
         self._filter = filter_str.encode(encoding)
         self._flags = flags
         self.encoding = encoding
-        self.packet_queue = Queue.Queue()
+        # a lock-free ring could be used if there is only one consumer thread
+        if ring_size > 0:
+            self.packet_queue = RingQueue(ring_size)
+        else:
+            self.packet_queue = BatchQueue()
         self.num_queued = 0
+        # packets data would be copied into recycled buffers if pool is enabled
+        self.buffer_pool = BufferPool(pool_size) if pool_size > 0 else None
+        pool = self.buffer_pool
+        # packets from the same process share one immutable record
+        self.proc_cache = ProcCache()
+        proc_cache = self.proc_cache
 
         # create divert handle
         self._handle = self._lib.divert_create(self._port, self._flags)
+        self._reinject_func = reinject_function(self._lib, self._handle)
+        self._reinject_slot = None
+        if pool is not None:
+            self._reinject_slot = slot_reinject_function(self._lib, self._handle, pool)
+        # latency histograms, None if disabled
+        self.latency = None
+        self._reinject = self._reinject_packet
+        if latency:
+            self.enable_latency()
 
         def ip_callback(args, proc_info, ip_data, sockaddr):
-            packet = Packet()
+            tracker = self.latency
+            if tracker is not None:
+                stamps = [monotonic_ns()]
             # check if IP packet is legal
             ptr_packet = cast(ip_data, POINTER(IpHeader))
             header_len = ptr_packet[0].get_header_length()
             packet_length = ptr_packet[0].get_total_length()
             if packet_length > 0 and header_len > 0:
+                slot = None
+                if pool is not None and packet_length <= pool.slot_size:
+                    slot = pool.acquire()
+                if slot is None:
+                    # save the IP packet data and the sockaddr info for re-inject
+                    packet = Packet(ip_data[0:packet_length],
+                                    sockaddr[0:Defaults.SOCKET_ADDR_SIZE])
+                else:
+                    # the packet object of a slot is reused with its buffers
+                    packet = pool.packets[slot]
+                    if packet is None:
+                        packet = pool.packets[slot] = Packet()
+                    else:
+                        # other fields are all assigned below
+                        packet.flag = 0
+                        packet.stamps = None
+                    # copy packet into a free slot of the buffer pool
+                    memmove(pool.data_addrs[slot], ip_data, packet_length)
+                    memmove(pool.addr_addrs[slot], sockaddr, Defaults.SOCKET_ADDR_SIZE)
+                    packet.slot = slot
+                    packet.ip_data = pool.data_view(slot, packet_length)
+                    packet.sockaddr = pool.addr_buffers[slot]
                 packet.valid = True
                 # try to extract the process information
-                if proc_info[0].pid != -1 or proc_info[0].epid != -1:
-                    packet.proc = deepcopy(proc_info[0])
-                # save the IP packet data
-                packet.ip_data = ip_data[0:packet_length]
-                # save the sockaddr info for re-inject
-                packet.sockaddr = sockaddr[0:Defaults.SOCKET_ADDR_SIZE]
-                self.packet_queue.put(packet)
+                packet.proc = proc_cache.get(proc_info)
+                if tracker is not None:
+                    packet.stamps = stamps
+                    tracker.on_callback(stamps)
+                try:
+                    self.packet_queue.put(packet)
+                except Queue.Full:
+                    # the ring is closed while full, see RingQueue.num_dropped
+                    self.release(packet)
+        # called directly when packets are read by DivertReactor
+        self._ip_callback = ip_callback
         # convert callback function type into C type
         self.ip_callback = self.cmp_func_type(ip_callback)
         # and register it into divert handle
@@ -210,8 +289,14 @@ class DivertHandle:
         # finally activate the divert handle
         if self._lib.divert_activate(self._handle) != 0:
             raise RuntimeError(self._handle[0].errmsg)
+        # keep the kernel extension loaded until closed
+        self._libdivert.acquire()
+        self._kext_held = True
         self._cleaned = False
         self.thread = None
+        self.looping = False
+        # the DivertReactor reading this handle instead of a thread
+        self.reactor = None
 
     def __del__(self):
         self.close()
@@ -243,35 +328,79 @@ class DivertHandle:
         """
         :return: True if there is no data to read any more
         """
+        if self.reactor is not None:
+            return False
         if self.thread is not None:
             if not self.thread.isAlive():
                 self.thread = None
         return self.thread is None and self.eof
 
     def close(self):
-        for i in range(self.num_queued):
-            packet = Packet()
-            packet.valid = False
-            self.packet_queue.put(packet)
+        if self.reactor is not None:
+            self.reactor.remove(self)
+        ring = self.packet_queue if isinstance(self.packet_queue, RingQueue) else None
+        if ring is not None:
+            # only the capture thread could put into the ring,
+            # so unblock it if the ring is full instead
+            ring.shutdown()
+        else:
+            for i in range(self.num_queued):
+                packet = Packet()
+                packet.valid = False
+                self.packet_queue.put(packet)
         if self.thread is not None:
             # stop the event loop only when thread is alive
             if self.thread.isAlive():
                 self._lib.divert_loop_stop(self._handle)
             self.thread.join()
             self.thread = None
+        if ring is not None:
+            # nothing would put into the ring any more
+            ring.close()
+        if self._kext_held:
+            self._kext_held = False
+            self._libdivert.release()
 
     def open(self):
+        if not self._kext_held:
+            # reopened after close()
+            self._libdivert.acquire()
+            self._kext_held = True
+
         def _loop():
             self._lib.divert_loop(self._handle, self._count)
+            self.looping = False
+            # wake up the consumer waiting on ring
+            if isinstance(self.packet_queue, RingQueue):
+                self.packet_queue.interrupt()
+        if isinstance(self.packet_queue, RingQueue) and self.packet_queue.closed:
+            # reopened after close()
+            self.packet_queue = RingQueue(self.packet_queue.capacity)
         # set the ipfw filter
         if self._filter:
             self.set_filter(self._filter)
         # and start background thread
+        self.looping = True
         self.thread = threading.Thread(target=_loop)
         self.thread.start()
         return self
 
-    def open_pcap(self, filename):
+    def fileno(self):
+        """
+        :return: file descriptor which becomes readable when packets arrive,
+                 only available with ring transport, see RingQueue.arm()
+        """
+        if not isinstance(self.packet_queue, RingQueue):
+            raise RuntimeError("File descriptor is only available with ring transport.")
+        return self.packet_queue.fileno()
+
+    def open_pcap(self, filename, buffered=False, **kwargs):
+        """
+        :param buffered: write packets in background thread, see BufferedPcapWriter
+                         for other keyword arguments like rotation and compression
+        """
+        if buffered:
+            return BufferedPcapHandle(filename, **kwargs)
         return PcapHandle(filename, self._libdivert)
 
     def set_filter(self, filter_str):
@@ -289,8 +418,24 @@ class DivertHandle:
         self.num_queued += 1
         res = self.packet_queue.get(*args, **kwargs)
         self.num_queued -= 1
+        if self.latency is not None and res is not None:
+            self.latency.on_dequeue((res,))
         return res
 
+    def read_batch(self, max_n=64, timeout=None):
+        """
+        Read multiple packets at once, the queue lock is acquired only once per batch
+        :param max_n: maximum number of packets to read
+        :param timeout: seconds to wait for the first packet, None means block forever
+        :return: a list of at most max_n packets, empty if timeout
+        """
+        self.num_queued += 1
+        batch = self.packet_queue.get_batch(max_n, timeout)
+        self.num_queued -= 1
+        if self.latency is not None:
+            self.latency.on_dequeue(batch)
+        return batch
+
     def write(self, packet_obj):
         if self.closed:
             raise RuntimeError("Divert handle closed.")
@@ -298,8 +443,80 @@ class DivertHandle:
         if not packet_obj or not packet_obj.sockaddr or not packet_obj.ip_data:
             raise RuntimeError("Invalid packet data.")
 
-        return self._lib.divert_reinject(self._handle, packet_obj.ip_data,
-                                         -1, packet_obj.sockaddr)
+        return self._reinject(packet_obj)
+
+    def enable_latency(self, enabled=True):
+        """
+        Start or stop recording monotonic timestamps of packets at callback,
+        enqueue, dequeue and reinject. Nothing is recorded when disabled
+        except checking this flag at callback, read and write_batch.
+        """
+        if enabled:
+            if self.latency is None:
+                self.latency = LatencyTracker()
+            self._reinject = self._timed_reinject
+        else:
+            self.latency = None
+            self._reinject = self._reinject_packet
+
+    def latency_stats(self):
+        """
+        :return: dict of stage name to histogram snapshot in nanoseconds,
+                 see LatencyTracker, None if latency is not recorded
+        """
+        if self.latency is None:
+            return None
+        return self.latency.snapshot()
+
+    def _timed_reinject(self, packet_obj):
+        tracker = self.latency
+        stamps = packet_obj.stamps
+        start = monotonic_ns()
+        ret_val = self._reinject_packet(packet_obj)
+        if tracker is not None:
+            tracker.on_reinject(stamps, start, monotonic_ns())
+        return ret_val
+
+    def _reinject_packet(self, packet_obj):
+        slot = packet_obj.slot
+        if slot is None:
+            return self._reinject_func(packet_obj.ip_data, packet_obj.sockaddr)
+        if isinstance(packet_obj.ip_data, memoryview):
+            # data is still in the pool, pass the buffer to C side directly
+            ret_val = self._reinject_slot(slot)
+        else:
+            ret_val = self._reinject_func(packet_obj.ip_data, packet_obj.sockaddr)
+        self.release(packet_obj)
+        return ret_val
+
+    def release(self, packet_obj):
+        """
+        Recycle the pooled buffer of a packet, this is done automatically by write().
+        Should be called for packets that would not be re-injected,
+        and the packet must not be used any more after that, since
+        the packet object is also reused for later packets.
+        """
+        if packet_obj.slot is not None:
+            self.buffer_pool.release(packet_obj.slot)
+            packet_obj.slot = None
+
+    def write_batch(self, packets):
+        """
+        Re-inject multiple packets, invalid packets are skipped
+        :param packets: iterable of packets, e.g. result of read_batch()
+        :return: list of return values of divert_reinject for each written packet
+        """
+        if self.closed:
+            raise RuntimeError("Divert handle closed.")
+
+        if self.buffer_pool is not None or self.latency is not None:
+            return [self._reinject(packet_obj) for packet_obj in packets
+                    if packet_obj.valid and packet_obj.sockaddr and packet_obj.ip_data]
+
+        reinject = self._reinject_func
+        return [reinject(packet_obj.ip_data, packet_obj.sockaddr)
+                for packet_obj in packets
+                if packet_obj.valid and packet_obj.sockaddr and packet_obj.ip_data]
 
     def is_inbound(self, sockaddr):
         return self._lib.divert_is_inbound(sockaddr, None) != 0
@@ -363,7 +580,11 @@ class PcapHandle:
             setattr(getattr(self._libc, func_name), "restype", restype)
 
     def write(self, packet):
-        if self._lib.divert_dump_pcap(packet.ip_data,
+        ip_data = packet.ip_data
+        if isinstance(ip_data, memoryview):
+            # packets of buffer pool are views into the arena
+            ip_data = ip_data.tobytes()
+        if self._lib.divert_dump_pcap(ip_data,
                                       self._fp, self._errmsg) != 0:
             raise RuntimeError("Couldn't write into %s: %s" %
                                (self.filename, self._errmsg.value))
@@ -378,34 +599,132 @@ class PcapHandle:
             raise RuntimeError("File %s is not opened!" % self.filename)
 
 
-class Packet:
-    def __init__(self):
+class BufferedPcapHandle(object):
+    """
+    Pure Python counterpart of PcapHandle, which never blocks the capture loop on disk
+    """
+
+    def __init__(self, filename, **kwargs):
+        self.filename = filename
+        self._writer = BufferedPcapWriter(filename, **kwargs)
+
+    @property
+    def pending_bytes(self):
+        return self._writer.pending_bytes
+
+    @property
+    def num_dropped(self):
+        return self._writer.num_dropped
+
+    def write(self, packet):
+        ip_data = packet.ip_data
+        if isinstance(ip_data, memoryview):
+            # buffer of packet pool would be recycled
+            ip_data = ip_data.tobytes()
+        self._writer.write(time.time(), ip_data)
+
+    def flush(self):
+        self._writer.flush()
+
+    def close(self):
+        self._writer.close()
+
+    # Context Manager protocol
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def _header_field(index, doc):
+    def get(self):
+        header = self._header
+        if header is None:
+            header = self._decode()
+        return header[index]
+    return property(get, doc=doc)
+
+
+class Packet(object):
+    """
+    Diverted packet, header fields are decoded from ip_data on first access
+    and cached, replacing ip_data discards the decoded fields.
+    Fields which are not available in the packet are None.
+    """
+    __slots__ = ('proc', '_ip_data', 'sockaddr', 'valid', 'flag', 'slot', 'stamps', '_header')
+
+    _item_keys = frozenset(('proc', 'ip_data', 'sockaddr', 'flag'))
+    _ip_header = struct.Struct('!B8xB2x4s4s')
+    _tcp_packet = struct.Struct('!B8xB2x4s4sHH8xBB')
+    _ports = struct.Struct('!HH')
+    _tcp_header = struct.Struct('!HH8xBB')
+    _no_header = (None,) * 7
+
+    def __init__(self, ip_data=None, sockaddr=None):
         self.proc = None
-        self.ip_data = None
-        self.sockaddr = None
+        self.sockaddr = sockaddr
         self.valid = False
         self.flag = 0
+        self.slot = None
+        # monotonic timestamps if latency is recorded, see latency.Stage
+        self.stamps = None
+        self._ip_data = ip_data
+        # decoded header fields, None until the first access
+        self._header = None
+
+    def _set_ip_data(self, value):
+        self._ip_data = value
+        self._header = None
+
+    ip_data = property(attrgetter('_ip_data'), _set_ip_data)
+
+    src = _header_field(0, 'source address')
+    dst = _header_field(1, 'destination address')
+    proto = _header_field(2, 'IP protocol number')
+    sport = _header_field(3, 'TCP/UDP source port')
+    dport = _header_field(4, 'TCP/UDP destination port')
+    tcp_flags = _header_field(5, 'TCP flags byte')
+    payload_offset = _header_field(6, 'offset of transport payload in ip_data')
 
     def __setitem__(self, key, value):
-        if key == 'proc':
-            self.proc = value
-        elif key == 'ip_data':
-            self.ip_data = value
-        elif key == 'sockaddr':
-            self.sockaddr = value
-        elif key == 'flag':
-            self.flag = value
-        else:
+        if key not in self._item_keys:
             raise KeyError("No suck key: %s" % key)
+        setattr(self, key, value)
 
     def __getitem__(self, item):
-        if item == 'proc':
-            return self.proc
-        elif item == 'ip_data':
-            return self.ip_data
-        elif item == 'sockaddr':
-            return self.sockaddr
-        elif item == 'flag':
-            return self.flag
-        else:
+        if item not in self._item_keys:
             return None
+        return getattr(self, item)
+
+    def _decode(self):
+        """
+        Decode IP and TCP/UDP header fields, sport, dport and tcp_flags
+        are None if not available in this packet
+        :return: tuple of header fields, cached until ip_data is replaced
+        """
+        data = self._ip_data
+        size = len(data) if data is not None else 0
+        if size < 20:
+            self._header = header = self._no_header
+            return header
+        if size >= 34:
+            # TCP without IP options is decoded by a single unpack
+            vhl, proto, src, dst, sport, dport, data_off, tcp_flags = \
+                self._tcp_packet.unpack_from(data, 0)
+            if vhl == 0x45 and proto == _IPPROTO_TCP:
+                self._header = header = (_inet_ntoa(src), _inet_ntoa(dst), proto, sport, dport,
+                                         tcp_flags, 20 + (data_off >> 4) * 4)
+                return header
+        vhl, proto, src, dst = self._ip_header.unpack_from(data, 0)
+        offset = (vhl & 0x0f) * 4
+        sport = dport = tcp_flags = None
+        if proto == socket.IPPROTO_TCP and size >= offset + 14:
+            sport, dport, data_off, tcp_flags = self._tcp_header.unpack_from(data, offset)
+            offset += (data_off >> 4) * 4
+        elif proto == socket.IPPROTO_UDP and size >= offset + 8:
+            sport, dport = self._ports.unpack_from(data, offset)
+            offset += 8
+        self._header = header = (_inet_ntoa(src), _inet_ntoa(dst), proto, sport, dport,
+                                 tcp_flags, offset)
+        return header
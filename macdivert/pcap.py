@@ -0,0 +1,584 @@
+# encoding: utf8
+
+import os
+import gzip
+import mmap
+import time
+import shutil
+import socket
+import struct
+import bisect
+import threading
+from array import array
+from multiprocessing.pool import ThreadPool
+
+__author__ = 'huangyan13@baidu.com'
+
+
+class LinkType(object):
+    """
+    refer to http://www.tcpdump.org/linktypes.html
+    """
+    NULL = 0
+    ETHERNET = 1
+    RAW = 101
+    LINUX_SLL = 113
+    # some platforms use the DLT_RAW value directly
+    DLT_RAW = (12, 14)
+
+
+class PcapFormat(object):
+    MAGIC_LE = 0xa1b2c3d4
+    MAGIC_NSEC_LE = 0xa1b23c4d
+    VERSION_MAJOR = 2
+    VERSION_MINOR = 4
+    SNAPLEN = 65535
+    FILE_HEADER_SIZE = 24
+    RECORD_HEADER_SIZE = 16
+
+
+class PcapReader(object):
+    """
+    Pure Python reader for classic .pcap files, yields raw IP packets
+    """
+    ETHERTYPE_IP = 0x0800
+
+    def __init__(self, filename):
+        self.filename = filename
+        self._fp = None
+        self._fp = open(filename, 'rb')
+        header = self._fp.read(PcapFormat.FILE_HEADER_SIZE)
+        if len(header) != PcapFormat.FILE_HEADER_SIZE:
+            raise RuntimeError("Invalid pcap file %s" % filename)
+        for endian in ('<', '>'):
+            magic = struct.unpack(endian + 'I', header[0:4])[0]
+            if magic in (PcapFormat.MAGIC_LE, PcapFormat.MAGIC_NSEC_LE):
+                break
+        else:
+            raise RuntimeError("Invalid pcap magic number in %s" % filename)
+        self.endian = endian
+        self.ts_divisor = 1e9 if magic == PcapFormat.MAGIC_NSEC_LE else 1e6
+        self.snaplen, self.linktype = struct.unpack(endian + 'II', header[16:24])
+        self._record = struct.Struct(endian + 'IIII')
+
+    def __del__(self):
+        self.close()
+
+    def close(self):
+        if self._fp is not None:
+            self._fp.close()
+            self._fp = None
+
+    def strip_link_header(self, frame):
+        """
+        Remove the link layer header and return the IP packet,
+        or None if this frame does not carry an IPv4 packet
+        """
+        if self.linktype == LinkType.RAW or self.linktype in LinkType.DLT_RAW:
+            ip_data = frame
+        elif self.linktype == LinkType.NULL:
+            ip_data = frame[4:]
+        elif self.linktype == LinkType.ETHERNET:
+            if struct.unpack('!H', frame[12:14])[0] != self.ETHERTYPE_IP:
+                return None
+            ip_data = frame[14:]
+        elif self.linktype == LinkType.LINUX_SLL:
+            if struct.unpack('!H', frame[14:16])[0] != self.ETHERTYPE_IP:
+                return None
+            ip_data = frame[16:]
+        else:
+            raise RuntimeError("Unsupported link type: %d" % self.linktype)
+        if not ip_data or ord(ip_data[0]) >> 4 != 4:
+            return None
+        return ip_data
+
+    def __iter__(self):
+        """
+        Iterate over all IPv4 packets as (timestamp, ip_data) tuples
+        """
+        read = self._fp.read
+        unpack = self._record.unpack
+        size = PcapFormat.RECORD_HEADER_SIZE
+        while True:
+            header = read(size)
+            if len(header) < size:
+                break
+            ts_sec, ts_frac, incl_len, orig_len = unpack(header)
+            frame = read(incl_len)
+            if len(frame) < incl_len:
+                break
+            ip_data = self.strip_link_header(frame)
+            if ip_data is not None:
+                yield ts_sec + ts_frac / self.ts_divisor, ip_data
+
+    # Context Manager protocol
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def flow_key(proto, src, sport, dst, dport):
+    """
+    Direction independent key of a 5-tuple flow,
+    addresses could be integers or dotted strings
+    """
+    if isinstance(src, basestring):
+        src = struct.unpack('!I', socket.inet_aton(src))[0]
+    if isinstance(dst, basestring):
+        dst = struct.unpack('!I', socket.inet_aton(dst))[0]
+    if (src, sport) <= (dst, dport):
+        return proto, src, sport, dst, dport
+    return proto, dst, dport, src, sport
+
+
+class IndexedPcapReader(PcapReader):
+    """
+    Memory-mapped pcap reader with a sidecar index, which is built once by
+    scanning the whole file and then saved next to it as <filename>.idx.
+    Records are ordered by time, so seeking to a timestamp is a binary search,
+    and records of each flow are stored together for direct extraction.
+    """
+    INDEX_MAGIC = 'PIDX'
+    INDEX_VERSION = 1
+    _index_header = struct.Struct('<4sIQdIIII')
+    _flow_struct = struct.Struct('<BIHIH')
+
+    def __init__(self, filename, index_file=None, rebuild=False):
+        """
+        :param index_file: path of sidecar index, default to <filename>.idx
+        :param rebuild: ignore existing index and scan the file again
+        """
+        super(IndexedPcapReader, self).__init__(filename)
+        self.index_file = index_file or filename + '.idx'
+        stat = os.fstat(self._fp.fileno())
+        self._file_size, self._mtime = stat.st_size, stat.st_mtime
+        self._mm = mmap.mmap(self._fp.fileno(), 0, access=mmap.ACCESS_READ) \
+            if self._file_size else ''
+        if rebuild or not self._load_index():
+            self._build_index()
+            self._save_index()
+        self._flow_ids = dict((key, i) for i, key in enumerate(self.flow_keys))
+
+    def close(self):
+        if getattr(self, '_mm', None):
+            self._mm.close()
+            self._mm = None
+        super(IndexedPcapReader, self).close()
+
+    def _flow_of(self, ip_data):
+        proto = ord(ip_data[9])
+        src, dst = struct.unpack_from('!II', ip_data, 12)
+        sport = dport = 0
+        header_len = (ord(ip_data[0]) & 0x0f) * 4
+        if proto in (socket.IPPROTO_TCP, socket.IPPROTO_UDP) and \
+                len(ip_data) >= header_len + 4:
+            sport, dport = struct.unpack_from('!HH', ip_data, header_len)
+        return flow_key(proto, src, sport, dst, dport)
+
+    def _build_index(self):
+        mm, size = self._mm, self._file_size
+        unpack_from = self._record.unpack_from
+        header_size = PcapFormat.RECORD_HEADER_SIZE
+        timestamps, offsets, flows = array('d'), array('L'), array('I')
+        flow_ids, flow_keys = {}, []
+        pos = PcapFormat.FILE_HEADER_SIZE
+        while pos + header_size <= size:
+            ts_sec, ts_frac, incl_len, orig_len = unpack_from(mm, pos)
+            if pos + header_size + incl_len > size:
+                break
+            ip_data = self.strip_link_header(mm[pos + header_size:pos + header_size + incl_len])
+            if ip_data is not None and len(ip_data) >= 20:
+                key = self._flow_of(ip_data)
+                flow_id = flow_ids.get(key)
+                if flow_id is None:
+                    flow_id = flow_ids[key] = len(flow_keys)
+                    flow_keys.append(key)
+                timestamps.append(ts_sec + ts_frac / self.ts_divisor)
+                offsets.append(pos)
+                flows.append(flow_id)
+            pos += header_size + incl_len
+        # keep records in time order, which is almost always the file order
+        if any(timestamps[i] > timestamps[i + 1] for i in xrange(len(timestamps) - 1)):
+            order = sorted(xrange(len(timestamps)), key=timestamps.__getitem__)
+            timestamps = array('d', (timestamps[i] for i in order))
+            offsets = array('L', (offsets[i] for i in order))
+            flows = array('I', (flows[i] for i in order))
+        # counting sort of records by flow
+        flow_start = array('I', [0] * (len(flow_keys) + 1))
+        for flow_id in flows:
+            flow_start[flow_id + 1] += 1
+        for i in xrange(len(flow_keys)):
+            flow_start[i + 1] += flow_start[i]
+        fill = array('I', flow_start[0:len(flow_keys)])
+        flow_order = array('I', [0] * len(flows))
+        for i, flow_id in enumerate(flows):
+            flow_order[fill[flow_id]] = i
+            fill[flow_id] += 1
+        self.timestamps, self.offsets = timestamps, offsets
+        self.flow_keys, self.flow_start, self.flow_order = flow_keys, flow_start, flow_order
+
+    def _save_index(self):
+        tmp_file = self.index_file + '.tmp'
+        try:
+            with open(tmp_file, 'wb') as fid:
+                fid.write(self._index_header.pack(
+                    self.INDEX_MAGIC, self.INDEX_VERSION, self._file_size, self._mtime,
+                    len(self.timestamps), len(self.flow_keys),
+                    self.offsets.itemsize, self.flow_order.itemsize))
+                self.timestamps.tofile(fid)
+                self.offsets.tofile(fid)
+                self.flow_order.tofile(fid)
+                self.flow_start.tofile(fid)
+                fid.write(''.join(self._flow_struct.pack(*key) for key in self.flow_keys))
+            os.rename(tmp_file, self.index_file)
+        except (IOError, OSError):
+            # index could still be used in memory, e.g. on read-only media
+            if os.path.exists(tmp_file):
+                os.remove(tmp_file)
+
+    def _load_index(self):
+        """
+        :return: True if a valid index of current pcap file is loaded
+        """
+        if not os.path.isfile(self.index_file):
+            return False
+        with open(self.index_file, 'rb') as fid:
+            header = fid.read(self._index_header.size)
+            if len(header) != self._index_header.size:
+                return False
+            magic, version, file_size, mtime, num_records, num_flows, \
+                offset_size, order_size = self._index_header.unpack(header)
+            if magic != self.INDEX_MAGIC or version != self.INDEX_VERSION or \
+                    file_size != self._file_size or mtime != self._mtime or \
+                    offset_size != array('L').itemsize or order_size != array('I').itemsize:
+                return False
+            try:
+                self.timestamps = array('d')
+                self.timestamps.fromfile(fid, num_records)
+                self.offsets = array('L')
+                self.offsets.fromfile(fid, num_records)
+                self.flow_order = array('I')
+                self.flow_order.fromfile(fid, num_records)
+                self.flow_start = array('I')
+                self.flow_start.fromfile(fid, num_flows + 1)
+            except EOFError:
+                return False
+            data = fid.read(self._flow_struct.size * num_flows)
+            if len(data) != self._flow_struct.size * num_flows:
+                return False
+        unpack_from, size = self._flow_struct.unpack_from, self._flow_struct.size
+        self.flow_keys = [unpack_from(data, i * size) for i in xrange(num_flows)]
+        return True
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def __getitem__(self, i):
+        """
+        :return: the i-th (timestamp, ip_data) tuple in time order
+        """
+        pos = self.offsets[i]
+        incl_len = self._record.unpack_from(self._mm, pos)[2]
+        pos += PcapFormat.RECORD_HEADER_SIZE
+        return self.timestamps[i], self.strip_link_header(self._mm[pos:pos + incl_len])
+
+    def __iter__(self):
+        for i in xrange(len(self.offsets)):
+            yield self[i]
+
+    def seek_time(self, timestamp):
+        """
+        :return: position of the first record not earlier than timestamp
+        """
+        return bisect.bisect_left(self.timestamps, timestamp)
+
+    def between(self, t_start, t_end):
+        """
+        Iterate over records with t_start <= timestamp < t_end
+        """
+        for i in xrange(self.seek_time(t_start), self.seek_time(t_end)):
+            yield self[i]
+
+    def flow(self, key):
+        """
+        Iterate over records of one flow in time order, both directions included
+        :param key: result of flow_key(), or (proto, src, sport, dst, dport) tuple
+        """
+        flow_id = self._flow_ids.get(flow_key(*key))
+        if flow_id is None:
+            return
+        for i in xrange(self.flow_start[flow_id], self.flow_start[flow_id + 1]):
+            yield self[self.flow_order[i]]
+
+    def extract_flow(self, key, filename):
+        """
+        Save records of one flow into a new pcap file
+        :return: number of packets written
+        """
+        num = 0
+        with PcapWriter(filename) as writer:
+            for ts, ip_data in self.flow(key):
+                writer.write(ts, ip_data)
+                num += 1
+        return num
+
+
+_record_header = struct.Struct('<IIII')
+
+
+def pack_record(timestamp, ip_data, snaplen=PcapFormat.SNAPLEN):
+    ts_sec = int(timestamp)
+    ts_usec = int(round((timestamp - ts_sec) * 1e6))
+    if ts_usec >= 1000000:
+        ts_sec += 1
+        ts_usec -= 1000000
+    incl_len = min(len(ip_data), snaplen)
+    return _record_header.pack(ts_sec, ts_usec, incl_len, len(ip_data)) + ip_data[0:incl_len]
+
+
+class PcapWriter(object):
+    """
+    Pure Python writer for classic .pcap files with raw IP link type
+    """
+
+    def __init__(self, filename, snaplen=PcapFormat.SNAPLEN):
+        self.filename = filename
+        self.snaplen = snaplen
+        self._fp = None
+        self._fp = open(filename, 'wb')
+        self._fp.write(self.file_header(snaplen))
+
+    def __del__(self):
+        self.close()
+
+    @staticmethod
+    def file_header(snaplen=PcapFormat.SNAPLEN):
+        return struct.pack('<IHHiIII', PcapFormat.MAGIC_LE,
+                           PcapFormat.VERSION_MAJOR, PcapFormat.VERSION_MINOR,
+                           0, 0, snaplen, LinkType.RAW)
+
+    def write(self, timestamp, ip_data):
+        self._fp.write(pack_record(timestamp, ip_data, self.snaplen))
+
+    def close(self):
+        if self._fp is not None:
+            self._fp.close()
+            self._fp = None
+
+    # Context Manager protocol
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def compress_file(filename):
+    """
+    Gzip a closed pcap segment and remove the original file
+    """
+    with open(filename, 'rb') as src:
+        with gzip.open(filename + '.gz', 'wb') as dst:
+            shutil.copyfileobj(src, dst, 1 << 20)
+    os.remove(filename)
+    return filename + '.gz'
+
+
+class BufferedPcapWriter(object):
+    """
+    Pcap writer which never blocks the caller on disk I/O.
+    Records are packed into memory, and a background thread writes them
+    with large writes, rotates segments by size or time, and hands closed
+    segments to a worker pool for compression.
+    If the disk could not keep up, new records are dropped once
+    max_pending bytes are waiting, instead of stalling the caller.
+    An error of the background thread is raised by later write() or close().
+    The writer must be closed, or used as a context manager.
+    """
+
+    def __init__(self, filename, max_bytes=0, max_seconds=0, compress=False,
+                 num_workers=1, flush_size=1 << 20, flush_interval=0.5,
+                 max_pending=64 << 20, snaplen=PcapFormat.SNAPLEN):
+        """
+        :param filename: path of pcap file, segments are named like name.0001.pcap on rotation
+        :param max_bytes: rotate when a segment grows over so many bytes, 0 to disable
+        :param max_seconds: rotate when the first record of a segment is written so many
+                            seconds ago, 0 to disable, no empty segment is created when idle
+        :param compress: gzip closed segments in worker pool
+        :param num_workers: number of compression workers
+        :param flush_size: wake up background thread when so many bytes are pending
+        :param flush_interval: maximum seconds before pending records are written
+        :param max_pending: maximum pending bytes, records are dropped beyond that
+        """
+        self.filename = filename
+        self.max_bytes = max_bytes
+        self.max_seconds = max_seconds
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.snaplen = snaplen
+        self.num_dropped = 0
+        self.segments = []
+        self._chunks = []
+        self._pending = 0
+        self._closing = False
+        # exception raised in background thread
+        self._error = None
+        self._fp = None
+        self._segment_size = 0
+        self._segment_start = 0.
+        self._cond = threading.Condition()
+        self._pool = ThreadPool(num_workers) if compress else None
+        self._compressed = []
+        self._thread = None
+        self._open_segment()
+        self._thread = threading.Thread(target=self._flush_loop)
+        self._thread.daemon = True
+        self._thread.start()
+
+    @property
+    def rotating(self):
+        return self.max_bytes > 0 or self.max_seconds > 0
+
+    @property
+    def pending_bytes(self):
+        """
+        :return: bytes which are not written to disk yet
+        """
+        return self._pending
+
+    def _segment_name(self):
+        if not self.rotating:
+            return self.filename
+        root, ext = os.path.splitext(self.filename)
+        return '%s.%04d%s' % (root, len(self.segments), ext or '.pcap')
+
+    def _open_segment(self):
+        name = self._segment_name()
+        self._fp = open(name, 'wb')
+        self._fp.write(PcapWriter.file_header(self.snaplen))
+        self._segment_size = PcapFormat.FILE_HEADER_SIZE
+        self._segment_start = time.time()
+        self.segments.append(name)
+
+    def _close_segment(self):
+        self._fp.close()
+        self._fp = None
+        if self._pool is not None:
+            self._compressed.append(self._pool.apply_async(compress_file, (self.segments[-1],)))
+
+    def _need_rotate(self):
+        if self._segment_size <= PcapFormat.FILE_HEADER_SIZE:
+            # an empty segment is kept until records arrive
+            return False
+        if self.max_bytes > 0 and self._segment_size >= self.max_bytes:
+            return True
+        if self.max_seconds > 0 and time.time() - self._segment_start >= self.max_seconds:
+            return True
+        return False
+
+    def write(self, timestamp, ip_data):
+        record = pack_record(timestamp, ip_data, self.snaplen)
+        with self._cond:
+            if self._error is not None:
+                raise self._error
+            if self._closing:
+                raise RuntimeError("File %s is closed!" % self.filename)
+            if self._pending + len(record) > self.max_pending:
+                self.num_dropped += 1
+                return
+            self._chunks.append(record)
+            self._pending += len(record)
+            if self._pending >= self.flush_size:
+                self._cond.notify()
+
+    def _flush_loop(self):
+        try:
+            self._write_loop()
+        except Exception as e:
+            with self._cond:
+                self._error = e
+                self._cond.notify_all()
+            if self._fp is not None:
+                try:
+                    self._fp.close()
+                except (IOError, OSError):
+                    pass
+                self._fp = None
+
+    def _write_loop(self):
+        while True:
+            with self._cond:
+                if not self._chunks and not self._closing:
+                    self._cond.wait(self.flush_interval)
+                chunks, self._chunks = self._chunks, []
+                closing = self._closing
+            group = []
+            for record in chunks:
+                # rotation happens only on record boundary
+                if self._need_rotate():
+                    self._write_chunks(group)
+                    group = []
+                    self._close_segment()
+                    self._open_segment()
+                elif self._segment_size == PcapFormat.FILE_HEADER_SIZE:
+                    # time of segment starts from its first record
+                    self._segment_start = time.time()
+                group.append(record)
+                self._segment_size += len(record)
+            self._write_chunks(group)
+            if closing:
+                break
+        self._close_segment()
+
+    def _write_chunks(self, chunks):
+        if not chunks:
+            return
+        self._fp.write(''.join(chunks))
+        self._fp.flush()
+        with self._cond:
+            self._pending -= sum(len(record) for record in chunks)
+            self._cond.notify_all()
+
+    def flush(self):
+        """
+        Block until all pending records are written to disk
+        """
+        with self._cond:
+            self._cond.notify()
+            while self._pending > 0 and self._thread.is_alive():
+                self._cond.wait(self.flush_interval)
+            if self._error is not None:
+                raise self._error
+
+    def close(self):
+        """
+        Write all pending records, close current segment,
+        and wait for compression of all segments
+        """
+        if self._thread is None:
+            return
+        with self._cond:
+            if self._closing:
+                return
+            self._closing = True
+            self._cond.notify_all()
+        self._thread.join()
+        if self._pool is not None:
+            try:
+                for result in self._compressed:
+                    result.get()
+            finally:
+                self._pool.close()
+                self._pool.join()
+        if self._error is not None:
+            raise self._error
+
+    # Context Manager protocol
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -0,0 +1,65 @@
+# encoding: utf8
+
+from collections import deque
+from ctypes import c_char, addressof
+from enum import Defaults
+
+__author__ = 'huangyan13@baidu.com'
+
+
+class BufferPool(object):
+    """
+    Preallocated arena of fixed size packet buffers.
+    Slots are acquired by the capture thread and released by the
+    consumer after re-injection, both operations are atomic on deque.
+    """
+
+    def __init__(self, num_slots=Defaults.BUFFER_POOL_SIZE,
+                 slot_size=Defaults.PACKET_BUF_SIZE):
+        self.num_slots = num_slots
+        self.slot_size = slot_size
+        addr_size = Defaults.SOCKET_ADDR_SIZE
+        self.arena = (c_char * (num_slots * slot_size))()
+        self.addr_arena = (c_char * (num_slots * addr_size))()
+        data_type = c_char * slot_size
+        addr_type = c_char * addr_size
+        # ctypes views into the arena, passed to C side directly
+        self.data_buffers = [data_type.from_buffer(self.arena, i * slot_size)
+                             for i in xrange(num_slots)]
+        self.addr_buffers = [addr_type.from_buffer(self.addr_arena, i * addr_size)
+                             for i in xrange(num_slots)]
+        # python views into the arena, exposed as Packet.ip_data
+        self.data_views = [memoryview(buf) for buf in self.data_buffers]
+        self.data_addrs = [addressof(buf) for buf in self.data_buffers]
+        self.addr_addrs = [addressof(buf) for buf in self.addr_buffers]
+        # Packet object of each slot and view of its last ip_data,
+        # reused by capture callback, so that no object is allocated
+        self.packets = [None] * num_slots
+        self._views = [None] * num_slots
+        self._free = deque(xrange(num_slots))
+
+    @property
+    def num_free(self):
+        return len(self._free)
+
+    def data_view(self, slot, length):
+        """
+        :return: memoryview of the first length bytes of a slot,
+                 reused while packets in this slot have the same length
+        """
+        view = self._views[slot]
+        if view is None or len(view) != length:
+            view = self._views[slot] = self.data_views[slot][0:length]
+        return view
+
+    def acquire(self):
+        """
+        :return: index of a free slot, or None if the pool is exhausted
+        """
+        try:
+            return self._free.pop()
+        except IndexError:
+            return None
+
+    def release(self, slot):
+        self._free.append(slot)
@@ -0,0 +1,75 @@
+# encoding: utf8
+
+import struct
+from collections import namedtuple
+from enum import Defaults
+from models import ProcInfo
+
+__author__ = 'huangyan13@baidu.com'
+
+
+# immutable process information attached to packets,
+# with the same fields as ProcInfo structure
+ProcRecord = namedtuple('ProcRecord', ('pid', 'epid', 'comm'))
+
+_proc_struct = struct.Struct('=ii%ds' % ProcInfo.MAXCOMLEN)
+
+
+class ProcCache(object):
+    """
+    Intern process information of packets, so that packets from the same
+    process share one ProcRecord instead of a copy of ProcInfo each.
+    Records are keyed by raw bytes of the structure, so a hit costs one
+    copy of 40 bytes and one dict lookup. The cache is bounded by two
+    generations: hits in the young one cost nothing more, hits in the
+    old one are promoted, and the old one is dropped when the young one
+    is full, which keeps recently used records like an LRU.
+    """
+
+    _missing = object()
+
+    def __init__(self, capacity=Defaults.PROC_CACHE_SIZE):
+        # each generation holds half of the records
+        self.capacity = max(capacity // 2, 1)
+        self._young = {}
+        self._old = {}
+        # records created, hits are not counted to keep them cheap
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._young) + len(self._old)
+
+    def _decode(self, key):
+        pid, epid, comm = _proc_struct.unpack(key)
+        # the same check as done for ProcInfo before
+        if pid == -1 and epid == -1:
+            return None
+        return ProcRecord(pid, epid, comm.split('\x00', 1)[0])
+
+    def get(self, proc_info):
+        """
+        :param proc_info: pointer to ProcInfo structure
+        :return: ProcRecord, or None if process is unknown
+        """
+        info = proc_info[0]
+        # most packets of unknown process skip copying and hashing
+        if info.pid == -1 and info.epid == -1:
+            return None
+        # cheaper than reading the fields one by one
+        key = buffer(info)[:]
+        record = self._young.get(key, self._missing)
+        if record is not self._missing:
+            return record
+        record = self._old.pop(key, self._missing)
+        if record is self._missing:
+            self.misses += 1
+            record = self._decode(key)
+        if len(self._young) >= self.capacity:
+            self._old = self._young
+            self._young = {}
+        self._young[key] = record
+        return record
+
+    def clear(self):
+        self._young = {}
+        self._old = {}
@@ -0,0 +1,181 @@
+# encoding: utf8
+
+import os
+import ast
+import mmap
+import struct
+from array import array
+from ctypes import c_float, Array
+
+__author__ = 'huangyan13@baidu.com'
+
+
+class ProfileFormat(object):
+    NPY_MAGIC = '\x93NUMPY'
+    # little endian float32, the type of pipe arrays on C side
+    NPY_DESCR = '<f4'
+    NPY_EXT = '.npy'
+    NPZ_EXT = '.npz'
+    # separator between file name and array name of a .npz profile
+    KEY_SEP = ':'
+
+
+def _map_float32(filename, offset, count):
+    """
+    Map count float32 values at offset of file into a ctypes array,
+    pages are shared with the page cache until written
+    """
+    arr_type = c_float * count
+    if count == 0:
+        return arr_type()
+    with open(filename, 'rb') as fid:
+        # copy-on-write mapping is writable, which from_buffer requires
+        mm = mmap.mmap(fid.fileno(), 0, access=mmap.ACCESS_COPY)
+    # the array keeps the mapping alive
+    return arr_type.from_buffer(mm, offset)
+
+
+def _read_npy_header(filename):
+    """
+    :return: (descr, fortran_order, shape, data_offset) of a .npy file
+    """
+    with open(filename, 'rb') as fid:
+        magic = fid.read(8)
+        if magic[0:6] != ProfileFormat.NPY_MAGIC:
+            raise RuntimeError('Not a .npy file: %s' % filename)
+        if ord(magic[6]) == 1:
+            header_len, = struct.unpack('<H', fid.read(2))
+        else:
+            header_len, = struct.unpack('<I', fid.read(4))
+        header = ast.literal_eval(fid.read(header_len))
+        return header['descr'], header['fortran_order'], header['shape'], fid.tell()
+
+
+def _load_npy(filename):
+    descr, fortran_order, shape, offset = _read_npy_header(filename)
+    count = 1
+    for dim in shape:
+        count *= dim
+    if descr == ProfileFormat.NPY_DESCR and (len(shape) <= 1 or not fortran_order):
+        return _map_float32(filename, offset, count)
+    # other types have to be converted, which needs numpy
+    import numpy as np
+    return float32_array(np.load(filename, mmap_mode='r').ravel())
+
+
+def load_profile(reference):
+    """
+    Load a pipe schedule from binary profile without intermediate Python lists.
+    :param reference: one of
+        <file>.npy        float32 arrays are memory-mapped, other types are converted
+        <file>.npz:<key>  array named key in a NumPy archive
+        <file>            any other file is raw little endian float32
+    :return: ctypes c_float array
+    """
+    filename, sep, key = reference.rpartition(ProfileFormat.KEY_SEP)
+    if not sep or not filename.lower().endswith(ProfileFormat.NPZ_EXT):
+        filename, key = reference, None
+    if not os.path.isfile(filename):
+        raise RuntimeError('Profile not found: %s' % filename)
+    ext = os.path.splitext(filename)[1].lower()
+    if ext == ProfileFormat.NPZ_EXT:
+        import numpy as np
+        with np.load(filename) as archive:
+            if key is None:
+                if len(archive.files) != 1:
+                    raise RuntimeError('Array name required for profile: %s' % filename)
+                key = archive.files[0]
+            return float32_array(archive[key])
+    if ext == ProfileFormat.NPY_EXT:
+        return _load_npy(filename)
+    size = os.path.getsize(filename)
+    if size % 4 != 0:
+        raise RuntimeError('Size of raw float32 profile is not aligned: %s' % filename)
+    return _map_float32(filename, 0, size // 4)
+
+
+def save_profile(filename, values):
+    """
+    Save values as float32 .npy file, or raw float32 for other extensions.
+    numpy is not required, and saved files could be loaded by numpy.
+    """
+    data = array('f', float32_array(values))
+    if array('H', [1]).tostring()[0] != '\x01':
+        data.byteswap()
+    with open(filename, 'wb') as fid:
+        if filename.lower().endswith(ProfileFormat.NPY_EXT):
+            header = "{'descr': '%s', 'fortran_order': False, 'shape': (%d,), }" % (
+                ProfileFormat.NPY_DESCR, len(data))
+            # header is padded so that data is 64 bytes aligned
+            header += ' ' * (63 - (len(header) + 10) % 64) + '\n'
+            fid.write(ProfileFormat.NPY_MAGIC + '\x01\x00' + struct.pack('<H', len(header)))
+            fid.write(header)
+        data.tofile(fid)
+
+
+def float32_array(values):
+    """
+    Convert a pipe schedule into ctypes c_float array for pipe constructors.
+    Objects exposing float32 data through buffer protocol, like NumPy arrays,
+    array('f') and memory-mapped profiles are used without copy.
+    :param values: sequence of numbers, buffer object, or profile reference
+    :return: ctypes c_float array
+    """
+    if isinstance(values, basestring):
+        return load_profile(values)
+    if isinstance(values, Array) and values._type_ is c_float:
+        return values
+    if isinstance(values, array):
+        if values.typecode != 'f':
+            values = array('f', values)
+        return (c_float * len(values)).from_buffer(values)
+    dtype = getattr(values, 'dtype', None)
+    if dtype is not None:
+        # NumPy array, convert the type with C loop if needed
+        import numpy as np
+        values = np.ascontiguousarray(values, dtype=np.float32).ravel()
+        if not values.flags.writeable:
+            values = values.copy()
+        return (c_float * len(values)).from_buffer(values)
+    return (c_float * len(values))(*values)
+
+
+def optional_float32_array(values):
+    """
+    Same as float32_array(), but None or empty schedule gives None
+    """
+    if values is None:
+        return None
+    values = float32_array(values)
+    return values if len(values) else None
+
+
+def check_schedule(t, values):
+    """
+    Check that a pipe schedule has one time point for each value,
+    as pipe constructors pass a single length for both arrays
+    :param t: converted time array, or None if the schedule has no time
+    :param values: converted value array
+    """
+    if t is not None and len(t) != len(values):
+        raise ValueError('Length of time and value array mismatch: %d != %d' %
+                         (len(t), len(values)))
+
+
+def resolve_profiles(conf_list, base_dir):
+    """
+    Make relative profile references in pipe configurations relative to
+    base_dir, which is usually the directory of the json file, e.g.
+        {"pipe": "delay", "direction": "in",
+         "t": "drive.npz:t", "delay_time": "drive.npz:delay"}
+    :return: conf_list, modified in place
+    """
+    for pipe in conf_list:
+        if not isinstance(pipe, dict):
+            continue
+        for key, value in pipe.items():
+            if key in ('pipe', 'direction') or not isinstance(value, basestring):
+                continue
+            if not os.path.isabs(value):
+                pipe[key] = os.path.join(base_dir, value)
+    return conf_list
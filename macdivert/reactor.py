@@ -0,0 +1,291 @@
+# encoding: utf8
+
+import os
+import sys
+import time
+import errno
+import fcntl
+import select
+import threading
+import traceback
+from ctypes import (CDLL, byref, get_errno, pointer, create_string_buffer,
+                    c_int, c_uint32, c_void_p, c_size_t, c_ssize_t)
+from ctypes.util import find_library
+from enum import Defaults
+from models import ProcInfo
+from macdivert import DivertHandle
+from ring import RingQueue
+
+__author__ = 'huangyan13@baidu.com'
+
+
+def _load_recvfrom():
+    libc = CDLL('libc.dylib' if sys.platform == 'darwin' else find_library('c'), use_errno=True)
+    recvfrom = libc.recvfrom
+    recvfrom.argtypes = [c_int, c_void_p, c_size_t, c_int, c_void_p, c_void_p]
+    recvfrom.restype = c_ssize_t
+    return recvfrom
+
+
+_recvfrom = _load_recvfrom()
+# read without blocking even if the descriptor is blocking
+MSG_DONTWAIT = 0x80 if sys.platform == 'darwin' else 0x40
+
+
+class _Entry(object):
+    __slots__ = ('handle', 'fd', 'callback', 'remaining')
+
+    def __init__(self, handle, fd, callback, remaining):
+        self.handle = handle
+        self.fd = fd
+        self.callback = callback
+        self.remaining = remaining
+
+
+class DivertReactor(object):
+    """
+    Read many divert handles in one thread instead of one divert_loop
+    thread per handle. The thread waits on divert sockets of all handles
+    with select(), reads ready packets without blocking and passes them
+    to the callback of their handle, so they are queued as usual, or
+    handed to a function given with add().
+
+    Process information is queried by divert_loop of libdivert, so
+    packets read by reactor have no process information (proc is None).
+    Use DivertHandle.open() if packets have to be matched by process.
+
+        with DivertReactor() as reactor:
+            for rule in rules:
+                reactor.open_handle(libdivert, 0, rule, callback=process)
+            reactor.wait()
+    """
+
+    def __init__(self, max_batch=64, timeout=1.0):
+        """
+        :param max_batch: maximum number of packets read from one handle in a
+                          row, so that a busy handle does not starve others
+        :param timeout: seconds between checks of handles closed by libdivert
+        """
+        self.max_batch = max_batch
+        self.timeout = timeout
+        self._entries = {}
+        self._lock = threading.Condition()
+        # incremented by each iteration of loop, see remove()
+        self._generation = 0
+        self._wake_r, self._wake_w = os.pipe()
+        for fd in (self._wake_r, self._wake_w):
+            fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+        self._quit = False
+        self.thread = None
+        self._ip_buf = create_string_buffer(Defaults.PACKET_BUF_SIZE)
+        self._addr_buf = create_string_buffer(Defaults.SOCKET_ADDR_SIZE)
+        self._addr_len = c_uint32(Defaults.SOCKET_ADDR_SIZE)
+        # the process of packets is unknown
+        self._proc_ptr = pointer(ProcInfo(-1, -1, ''))
+
+    def __del__(self):
+        for fd in (self._wake_r, self._wake_w):
+            try:
+                os.close(fd)
+            except OSError:
+                pass
+
+    def _wake(self):
+        try:
+            os.write(self._wake_w, '\x00')
+        except OSError:
+            # pipe is full, the loop would wake up anyway
+            pass
+
+    def add(self, handle, callback=None):
+        """
+        Start reading packets of a handle which is not opened
+        :param handle: DivertHandle, its filter rule is applied here
+        :param callback: called with each packet in reactor thread,
+                         packets are put into handle.packet_queue if None
+        :return: the handle
+        """
+        if handle.thread is not None or handle.reactor is not None:
+            raise RuntimeError("Divert handle already opened.")
+        handle.set_filter(handle._filter)
+        fd = handle._handle[0].divert_fd
+        # zero is the fd of a handle never activated, not a divert socket
+        if fd <= 0:
+            raise RuntimeError("Divert handle is not activated.")
+        with self._lock:
+            if fd in self._entries:
+                raise RuntimeError("Divert socket already added.")
+            remaining = handle._count if handle._count >= 0 else None
+            self._entries[fd] = _Entry(handle, fd, callback, remaining)
+            handle.reactor = self
+            handle.looping = True
+        self._wake()
+        return handle
+
+    def open_handle(self, libdivert=None, port=0, filter_str="", flags=0, count=-1,
+                    encoding='utf-8', pool_size=0, ring_size=0, latency=False,
+                    callback=None):
+        """
+        Create a DivertHandle and add it, see MacDivert.open_handle()
+        """
+        handle = DivertHandle(libdivert, port, filter_str, flags, count,
+                              encoding, pool_size, ring_size, latency)
+        return self.add(handle, callback)
+
+    def _detach(self, entry):
+        # called with lock held
+        del self._entries[entry.fd]
+        handle = entry.handle
+        handle.reactor = None
+        handle.looping = False
+        # wake up the consumer waiting on ring, like the loop of DivertHandle
+        if isinstance(handle.packet_queue, RingQueue):
+            handle.packet_queue.interrupt()
+        # see wait()
+        self._lock.notify_all()
+
+    def remove(self, handle):
+        """
+        Stop reading packets of a handle, packets already queued are kept.
+        After return the handle is not used by reactor thread any more.
+        """
+        with self._lock:
+            for entry in self._entries.values():
+                if entry.handle is handle:
+                    self._detach(entry)
+                    break
+            else:
+                return
+            if self.thread is None or threading.current_thread() is self.thread:
+                return
+            # wait until the loop is not handling this handle any more
+            generation = self._generation
+            self._wake()
+            while self._generation == generation and self.thread is not None:
+                self._lock.wait(self.timeout)
+
+    @property
+    def handles(self):
+        with self._lock:
+            return [entry.handle for entry in self._entries.values()]
+
+    def _read(self, entry):
+        """
+        Read ready packets of one handle
+        :return: False if divert socket is closed or count is reached
+        """
+        handle = entry.handle
+        ip_callback = handle._ip_callback
+        ip_buf, addr_buf, addr_len = self._ip_buf, self._addr_buf, self._addr_len
+        proc_ptr = self._proc_ptr
+        num_read = 0
+        alive = True
+        for _ in xrange(self.max_batch):
+            if entry.remaining == 0:
+                alive = False
+                break
+            addr_len.value = Defaults.SOCKET_ADDR_SIZE
+            length = _recvfrom(entry.fd, ip_buf, Defaults.PACKET_BUF_SIZE,
+                               MSG_DONTWAIT, addr_buf, byref(addr_len))
+            if length < 0:
+                alive = get_errno() in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR)
+                break
+            if length == 0:
+                continue
+            num_read += 1
+            if entry.remaining is not None:
+                entry.remaining -= 1
+            ip_callback(None, proc_ptr, ip_buf, addr_buf)
+        handle._handle[0].num_diverted += num_read
+        if entry.callback is not None and num_read:
+            for packet in handle.read_batch(num_read, timeout=0):
+                entry.callback(packet)
+        return alive and entry.remaining != 0
+
+    def _loop(self):
+        while not self._quit:
+            with self._lock:
+                self._generation += 1
+                self._lock.notify_all()
+                entries = dict(self._entries)
+            try:
+                readable, _, _ = select.select([self._wake_r] + entries.keys(), [], [],
+                                               self.timeout)
+            except (select.error, OSError, ValueError):
+                # some descriptor is closed, check them one by one below
+                readable = [fd for fd in entries if not self._valid(fd)]
+            for fd in readable:
+                if fd == self._wake_r:
+                    try:
+                        os.read(self._wake_r, 4096)
+                    except OSError:
+                        pass
+                    continue
+                entry = entries[fd]
+                # removed during this iteration
+                if self._entries.get(fd) is not entry:
+                    continue
+                try:
+                    alive = self._valid(fd) and self._read(entry)
+                except Exception:
+                    # a failing callback should not stop other handles
+                    traceback.print_exc()
+                    alive = True
+                if not alive:
+                    with self._lock:
+                        if self._entries.get(fd) is entry:
+                            self._detach(entry)
+        with self._lock:
+            self.thread = None
+            self._lock.notify_all()
+
+    @staticmethod
+    def _valid(fd):
+        try:
+            os.fstat(fd)
+            return True
+        except OSError:
+            return False
+
+    def start(self):
+        if self.thread is not None:
+            raise RuntimeError("Reactor already started.")
+        self._quit = False
+        self.thread = threading.Thread(target=self._loop)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        """
+        Stop the reactor thread, handles are closed by their owners
+        """
+        thread = self.thread
+        self._quit = True
+        self._wake()
+        if thread is not None and thread is not threading.current_thread():
+            thread.join()
+
+    def wait(self, timeout=None):
+        """
+        Block until all handles are finished or removed, or reactor thread is stopped.
+        The thread keeps running, so that more handles could be added.
+        :return: True if no handle is left
+        """
+        end_time = None if timeout is None else time.time() + timeout
+        with self._lock:
+            while self._entries and self.thread is not None:
+                remaining = self.timeout
+                if end_time is not None:
+                    remaining = min(remaining, end_time - time.time())
+                    if remaining <= 0.0:
+                        break
+                self._lock.wait(remaining)
+            return not self._entries
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        for handle in self.handles:
+            handle.close()
+        self.stop()
@@ -0,0 +1,573 @@
+# encoding: utf8
+
+import os
+import sys
+import json
+import copy
+import heapq
+import socket
+import struct
+import numpy as np
+from collections import deque
+from pcap import PcapReader, PcapWriter
+from profiles import load_profile, resolve_profiles
+from stats import PipeStats
+
+__author__ = 'huangyan13@baidu.com'
+
+
+class Flags(object):
+    # direction flags, same values as emulator.Flags
+    DIRECTION_IN = 0
+    DIRECTION_OUT = 1
+
+    # buffer size
+    DELAY_QUEUE_SIZE = 8172
+
+    # transport protocols which carry port numbers
+    IPPROTO_TCP = 6
+    IPPROTO_UDP = 17
+
+
+def ip2int(addr):
+    return struct.unpack('!I', socket.inet_aton(addr))[0]
+
+
+def as_float_array(values):
+    """
+    Pipe schedule as float64 array, values could also be a profile reference
+    """
+    if isinstance(values, basestring):
+        values = np.ctypeslib.as_array(load_profile(values))
+    return np.asarray(values, dtype=np.float64)
+
+
+class PacketTrace(object):
+    """
+    A set of IPv4 packets stored as parallel arrays,
+    so that pipe models could work on all packets at once.
+    Packet payloads are kept in a list and referenced by index,
+    thus duplicated packets share the same payload.
+    """
+
+    def __init__(self, timestamps, data):
+        if len(timestamps) != len(data):
+            raise RuntimeError('Length of timestamps and data mismatch')
+        self.data = list(data)
+        self.ts = np.asarray(timestamps, dtype=np.float64)
+        self.idx = np.arange(len(self.data), dtype=np.int64)
+        self._decode_headers()
+
+    @classmethod
+    def from_pcap(cls, filename):
+        timestamps, data = [], []
+        with PcapReader(filename) as reader:
+            for ts, ip_data in reader:
+                timestamps.append(ts)
+                data.append(ip_data)
+        return cls(timestamps, data)
+
+    def _decode_headers(self):
+        num = len(self.data)
+        self.size = np.empty(num, dtype=np.int64)
+        self.src = np.zeros(num, dtype=np.uint32)
+        self.dst = np.zeros(num, dtype=np.uint32)
+        self.sport = np.full(num, -1, dtype=np.int32)
+        self.dport = np.full(num, -1, dtype=np.int32)
+        unpack_from = struct.unpack_from
+        for i, ip_data in enumerate(self.data):
+            self.size[i] = len(ip_data)
+            if len(ip_data) < 20:
+                continue
+            self.src[i], self.dst[i] = unpack_from('!II', ip_data, 12)
+            header_len = (ord(ip_data[0]) & 0x0f) * 4
+            if ord(ip_data[9]) in (Flags.IPPROTO_TCP, Flags.IPPROTO_UDP) and \
+                    len(ip_data) >= header_len + 4:
+                self.sport[i], self.dport[i] = unpack_from('!HH', ip_data, header_len)
+
+    def append_data(self, ip_data):
+        """
+        Store a newly created payload and return its index
+        """
+        self.data.append(ip_data)
+        return len(self.data) - 1
+
+    def packets(self, ts, idx):
+        for t, i in zip(ts.tolist(), idx.tolist()):
+            yield t, self.data[i]
+
+
+class Schedule(object):
+    """
+    A single period of the periodic function described by `t` and `values`.
+    If `t` is omitted, the value changes by packet instead of by time.
+    """
+
+    def __init__(self, values, t=None):
+        self.values = as_float_array(values)
+        self.t = None if t is None else as_float_array(t)
+        if len(self.values) == 0:
+            raise RuntimeError('Empty pipe schedule')
+        if self.t is not None and len(self.t) != len(self.values):
+            raise RuntimeError('Length of time and value array mismatch')
+
+    def lookup(self, ts, seq):
+        """
+        :param ts: relative arrival time of packets
+        :param seq: sequence number of packets in this pipe
+        :return: the value at each packet
+        """
+        if self.t is None:
+            return self.values[seq % len(self.values)]
+        period = self.t[-1]
+        phase = np.mod(ts, period) if period > 0 else ts
+        pos = np.searchsorted(self.t, phase, side='right') - 1
+        return self.values[np.clip(pos, 0, len(self.values) - 1)]
+
+
+class IPFilterModel(object):
+    def __init__(self, ip_src, ip_src_mask, ip_dst,
+                 ip_dst_mask, port_src, port_dst):
+        self.src_mask = ip2int(ip_src_mask)
+        self.src = ip2int(ip_src) & self.src_mask
+        self.dst_mask = ip2int(ip_dst_mask)
+        self.dst = ip2int(ip_dst) & self.dst_mask
+        self.port_src = port_src
+        self.port_dst = port_dst
+
+    def match(self, trace, idx, rng):
+        mask = (trace.src[idx] & self.src_mask) == self.src
+        mask &= (trace.dst[idx] & self.dst_mask) == self.dst
+        if self.port_src >= 0:
+            mask &= trace.sport[idx] == self.port_src
+        if self.port_dst >= 0:
+            mask &= trace.dport[idx] == self.port_dst
+        return mask
+
+
+class SizeFilterModel(object):
+    def __init__(self, size_arr, rate_arr):
+        if len(size_arr) != len(rate_arr):
+            raise RuntimeError('Invalid packet size filter')
+        self.size = np.asarray(size_arr, dtype=np.int64)
+        self.rate = np.asarray(rate_arr, dtype=np.float64)
+
+    def match(self, trace, idx, rng):
+        # each packet falls into the first bucket which could hold it
+        pos = np.searchsorted(self.size, trace.size[idx], side='left')
+        rate = self.rate[np.minimum(pos, len(self.rate) - 1)]
+        return rng.random_sample(len(idx)) < rate
+
+
+class BasicModel(object):
+    """
+    Offline counterpart of emulator.BasicPipe, which transforms
+    the arrival time array of packets into departure time array.
+    """
+
+    pipe_name = None
+
+    def __init__(self, ip_filter_obj=None, size_filter_obj=None, queue_size=None):
+        self.ip_filter = ip_filter_obj
+        self.size_filter = size_filter_obj
+        self.num_packets = 0
+        self.queue_size = queue_size
+        self.stats = PipeStats(queue_size)
+
+    def apply(self, trace, ts, idx, rng):
+        """
+        :param trace: the PacketTrace which owns these packets
+        :param ts: relative arrival time, sorted
+        :param idx: packet indexes into trace
+        :param rng: numpy RandomState instance
+        :return: tuple of (ts, idx) of departed packets, sorted by time
+        """
+        mask = np.ones(len(idx), dtype=bool)
+        for packet_filter in (self.ip_filter, self.size_filter):
+            if packet_filter is not None:
+                mask &= packet_filter.match(trace, idx, rng)
+        if mask.all():
+            out_ts, out_idx = self._process_seq(trace, ts, idx, rng)
+        else:
+            out_ts, out_idx = self._process_seq(trace, ts[mask], idx[mask], rng)
+            # packets not selected by filters just flow through this pipe
+            out_ts = np.concatenate((ts[~mask], out_ts))
+            out_idx = np.concatenate((idx[~mask], out_idx))
+            order = np.argsort(out_ts, kind='mergesort')
+            out_ts, out_idx = out_ts[order], out_idx[order]
+        stats = self.stats
+        stats.packets_in += len(idx)
+        stats.packets_out += len(out_idx)
+        if len(out_idx) < len(idx):
+            stats.dropped += len(idx) - len(out_idx)
+        else:
+            stats.duplicated += len(out_idx) - len(idx)
+        return out_ts, out_idx
+
+    def _process_seq(self, trace, ts, idx, rng):
+        seq = np.arange(self.num_packets, self.num_packets + len(idx))
+        self.num_packets += len(idx)
+        return self.process(trace, ts, idx, seq, rng)
+
+    def process(self, trace, ts, idx, seq, rng):
+        raise NotImplementedError()
+
+    def _record(self, ts, depart):
+        """
+        Record applied delay and queue occupancy of packets held by this pipe
+        :param ts: arrival time of packets, sorted
+        :param depart: departure time of the same packets
+        """
+        if len(ts) == 0:
+            return
+        self.stats.delay.record_array(np.round((depart - ts) * 1e6))
+        # occupancy grows at each arrival and shrinks at each departure,
+        # departures go first when both happen at the same time
+        events = np.concatenate((ts, depart))
+        change = np.concatenate((np.ones(len(ts), dtype=np.int64),
+                                 -np.ones(len(depart), dtype=np.int64)))
+        level = np.cumsum(change[np.lexsort((change, events))])
+        self.stats.queue_peak = max(self.stats.queue_peak, int(level.max()))
+        self.stats.queue_len = int(np.count_nonzero(depart > ts[-1]))
+
+
+def _limit_queue(ts, depart, queue_size):
+    """
+    Simulate a pipe queue which holds at most `queue_size` packets,
+    returns the mask of packets that are not dropped on arrival
+    """
+    keep = np.ones(len(ts), dtype=bool)
+    if len(ts) <= queue_size:
+        return keep
+    queue = []
+    for i, (arrive, leave) in enumerate(zip(ts.tolist(), depart.tolist())):
+        while queue and queue[0] <= arrive:
+            heapq.heappop(queue)
+        if len(queue) >= queue_size:
+            keep[i] = False
+        else:
+            heapq.heappush(queue, leave)
+    return keep
+
+
+class DelayModel(BasicModel):
+    pipe_name = 'delay'
+
+    def __init__(self, delay_time, t=None,
+                 queue_size=Flags.DELAY_QUEUE_SIZE,
+                 ip_filter_obj=None, size_filter_obj=None):
+        super(DelayModel, self).__init__(ip_filter_obj, size_filter_obj, queue_size)
+        self.schedule = Schedule(delay_time, t)
+
+    def process(self, trace, ts, idx, seq, rng):
+        depart = ts + self.schedule.lookup(ts, seq)
+        keep = _limit_queue(ts, depart, self.queue_size)
+        depart, idx = depart[keep], idx[keep]
+        self._record(ts[keep], depart)
+        order = np.argsort(depart, kind='mergesort')
+        return depart[order], idx[order]
+
+
+class DropModel(BasicModel):
+    pipe_name = 'drop'
+
+    def __init__(self, drop_rate, t=None,
+                 ip_filter_obj=None, size_filter_obj=None):
+        super(DropModel, self).__init__(ip_filter_obj, size_filter_obj)
+        self.schedule = Schedule(drop_rate, t)
+
+    def process(self, trace, ts, idx, seq, rng):
+        keep = rng.random_sample(len(idx)) >= self.schedule.lookup(ts, seq)
+        return ts[keep], idx[keep]
+
+
+class BandwidthModel(BasicModel):
+    pipe_name = 'bandwidth'
+
+    def __init__(self, t, bandwidth, queue_size=Flags.DELAY_QUEUE_SIZE,
+                 ip_filter_obj=None, size_filter_obj=None):
+        super(BandwidthModel, self).__init__(ip_filter_obj, size_filter_obj, queue_size)
+        # bandwidth is measured in KB/s
+        self.schedule = Schedule(bandwidth, t)
+
+    def process(self, trace, ts, idx, seq, rng):
+        rate = self.schedule.lookup(ts, seq) * 1024.
+        keep = rate > 0
+        tx_time = np.zeros(len(idx))
+        tx_time[keep] = trace.size[idx[keep]] / rate[keep]
+        depart = np.zeros(len(idx))
+        # the link serializes packets one by one, which is inherently sequential
+        queue = deque()
+        last = -np.inf
+        for i, (arrive, cost) in enumerate(zip(ts.tolist(), tx_time.tolist())):
+            if not keep[i]:
+                continue
+            while queue and queue[0] <= arrive:
+                queue.popleft()
+            if len(queue) >= self.queue_size:
+                keep[i] = False
+                continue
+            last = max(arrive, last) + cost
+            depart[i] = last
+            queue.append(last)
+        self._record(ts[keep], depart[keep])
+        return depart[keep], idx[keep]
+
+
+class BiterrModel(BasicModel):
+    pipe_name = 'biterr'
+
+    def __init__(self, t, biterr_rate, max_flip,
+                 ip_filter_obj=None, size_filter_obj=None):
+        super(BiterrModel, self).__init__(ip_filter_obj, size_filter_obj)
+        self.schedule = Schedule(biterr_rate, t)
+        self.max_flip = max_flip
+
+    def process(self, trace, ts, idx, seq, rng):
+        hit = np.flatnonzero(rng.random_sample(len(idx)) < self.schedule.lookup(ts, seq))
+        if len(hit) == 0:
+            return ts, idx
+        idx = idx.copy()
+        num_flips = rng.randint(1, self.max_flip + 1, size=len(hit))
+        for pos, num in zip(hit.tolist(), num_flips.tolist()):
+            data = bytearray(trace.data[idx[pos]])
+            header_len = (data[0] & 0x0f) * 4
+            if len(data) <= header_len:
+                continue
+            # keep the IP header intact so that packet could still be routed
+            for bit in rng.randint(header_len * 8, len(data) * 8, size=num).tolist():
+                data[bit >> 3] ^= 1 << (bit & 7)
+            idx[pos] = trace.append_data(str(data))
+        return ts, idx
+
+
+class DisorderModel(BasicModel):
+    pipe_name = 'disorder'
+
+    def __init__(self, t, disorder_rate, queue_size, max_disorder,
+                 ip_filter_obj=None, size_filter_obj=None):
+        super(DisorderModel, self).__init__(ip_filter_obj, size_filter_obj, queue_size)
+        self.schedule = Schedule(disorder_rate, t)
+        # a packet could not be held back longer than the queue could hold
+        self.max_disorder = max(1, min(max_disorder, queue_size))
+
+    def process(self, trace, ts, idx, seq, rng):
+        num = len(idx)
+        if num == 0:
+            return ts, idx
+        hit = rng.random_sample(num) < self.schedule.lookup(ts, seq)
+        shift = rng.randint(1, self.max_disorder + 1, size=num) * hit
+        # held packets are released right after the packet which overtakes them
+        release = np.minimum(np.arange(num) + shift, num - 1)
+        key = release + 0.5 * hit
+        order = np.argsort(key, kind='mergesort')
+        self._record(ts, ts[release])
+        return ts[release][order], idx[order]
+
+
+class DuplicateModel(BasicModel):
+    pipe_name = 'duplicate'
+
+    def __init__(self, t, duplicate_rate, max_duplicate,
+                 ip_filter_obj=None, size_filter_obj=None):
+        super(DuplicateModel, self).__init__(ip_filter_obj, size_filter_obj)
+        self.schedule = Schedule(duplicate_rate, t)
+        self.max_duplicate = max_duplicate
+
+    def process(self, trace, ts, idx, seq, rng):
+        hit = rng.random_sample(len(idx)) < self.schedule.lookup(ts, seq)
+        counts = 1 + hit * rng.randint(1, self.max_duplicate + 1, size=len(idx))
+        return np.repeat(ts, counts), np.repeat(idx, counts)
+
+
+class ThrottleModel(BasicModel):
+    pipe_name = 'throttle'
+
+    def __init__(self, t_start, t_end, queue_size,
+                 ip_filter_obj=None, size_filter_obj=None):
+        super(ThrottleModel, self).__init__(ip_filter_obj, size_filter_obj, queue_size)
+        self.t_start = as_float_array(t_start)
+        self.t_end = as_float_array(t_end)
+        if len(self.t_start) != len(self.t_end):
+            raise RuntimeError('Length of t_start and t_end mismatch')
+
+    def process(self, trace, ts, idx, seq, rng):
+        period = self.t_end.max()
+        cycle = np.floor_divide(ts, period)
+        phase = ts - cycle * period
+        pos = np.searchsorted(self.t_start, phase, side='right') - 1
+        held = (pos >= 0) & (phase < self.t_end[np.maximum(pos, 0)])
+        depart = ts.copy()
+        depart[held] = ts[held] - phase[held] + self.t_end[pos[held]]
+        # at most queue_size packets could be held during each throttle window
+        window = (cycle[held] * len(self.t_start) + pos[held]).astype(np.int64)
+        rank = np.arange(len(window)) - np.searchsorted(window, window, side='left')
+        keep = np.ones(len(idx), dtype=bool)
+        keep[np.flatnonzero(held)[rank >= self.queue_size]] = False
+        depart, idx = depart[keep], idx[keep]
+        self._record(ts[keep], depart)
+        order = np.argsort(depart, kind='mergesort')
+        return depart[order], idx[order]
+
+
+class ReplayEmulator(object):
+    """
+    Run the pipe chain of emulator on recorded packets without the kernel.
+    Every pipe processes all packets of a direction at once,
+    so the emulation is much faster than real time.
+    """
+
+    pipe_name2type = {
+        'drop': DropModel,
+        'delay': DelayModel,
+        'biterr': BiterrModel,
+        'disorder': DisorderModel,
+        'throttle': ThrottleModel,
+        'duplicate': DuplicateModel,
+        'bandwidth': BandwidthModel,
+    }
+
+    def __init__(self, local_addrs=None, seed=None):
+        """
+        :param local_addrs: IP addresses of the emulated host, packets sent from
+                            them are outbound. Defaults to the source of first packet.
+        :param seed: seed of random generator, for reproducible emulation
+        """
+        self.local_addrs = local_addrs
+        self.seed = seed
+        self.pipes = {
+            Flags.DIRECTION_IN: [],
+            Flags.DIRECTION_OUT: [],
+        }
+
+    def add_pipe(self, pipe, direction=Flags.DIRECTION_IN):
+        if pipe in self.pipes[direction]:
+            raise RuntimeError("Pipe already exists.")
+        self.pipes[direction].append(pipe)
+
+    def del_pipe(self, pipe):
+        for pipe_list in self.pipes.values():
+            if pipe in pipe_list:
+                pipe_list.remove(pipe)
+                return
+        raise RuntimeError("Pipe do not exists.")
+
+    def load_config(self, conf_list):
+        """
+        Create pipes from the json configuration used by EmulatorGUI
+        """
+        for pipe in copy.deepcopy(conf_list):
+            if not isinstance(pipe, dict):
+                raise TypeError('Invalid configuration')
+            pipe_name = pipe.pop('pipe', None)
+            if not pipe_name:
+                raise RuntimeError('Configuration do not have pipe type')
+            direction = pipe.pop('direction', None)
+            if not direction:
+                raise RuntimeError('Configuration do not have direction field')
+            if direction == "out":
+                dir_flag = Flags.DIRECTION_OUT
+            elif direction == "in":
+                dir_flag = Flags.DIRECTION_IN
+            else:
+                raise RuntimeError('Unknown direction flag')
+            ip_filter = self._create_ip_filter(pipe.pop('ip_filter', None))
+            size_filter = self._create_size_filter(pipe.pop('size_filter', None))
+            try:
+                pipe_type = self.pipe_name2type[pipe_name.lower()]
+            except KeyError:
+                raise RuntimeError('Invalid pipe type')
+            self.add_pipe(pipe_type(ip_filter_obj=ip_filter,
+                                    size_filter_obj=size_filter, **pipe), dir_flag)
+        return self
+
+    @staticmethod
+    def _create_size_filter(filter_dict):
+        if not filter_dict:
+            return None
+        return SizeFilterModel(filter_dict['size'], filter_dict['rate'])
+
+    @staticmethod
+    def _create_ip_filter(filter_dict):
+        if not filter_dict:
+            return None
+        strip_func = lambda x: x.strip()
+        src_addr, port_src = map(strip_func, filter_dict['src'].split(':'))
+        src_addr, src_mask = map(strip_func, src_addr.split('/'))
+        dst_addr, port_dst = map(strip_func, filter_dict['dst'].split(':'))
+        dst_addr, dst_mask = map(strip_func, dst_addr.split('/'))
+        return IPFilterModel(src_addr, src_mask, dst_addr, dst_mask,
+                             int(port_src), int(port_dst))
+
+    def _outbound_mask(self, trace):
+        if self.local_addrs:
+            local = np.array([ip2int(addr) for addr in self.local_addrs], dtype=np.uint32)
+        elif len(trace.src):
+            local = trace.src[0:1]
+        else:
+            local = np.zeros(0, dtype=np.uint32)
+        return np.in1d(trace.src, local)
+
+    def run(self, trace):
+        """
+        Emulate on a PacketTrace
+        :return: list of (timestamp, ip_data) tuples sorted by time
+        """
+        rng = np.random.RandomState(self.seed)
+        order = np.argsort(trace.ts, kind='mergesort')
+        base = trace.ts[order[0]] if len(order) else 0.
+        ts, idx = trace.ts[order] - base, trace.idx[order]
+        outbound = self._outbound_mask(trace)[idx]
+        results_ts, results_idx = [], []
+        for pipe_list in self.pipes.values():
+            for pipe in pipe_list:
+                pipe.num_packets = 0
+                pipe.stats.reset()
+        for direction, mask in ((Flags.DIRECTION_IN, ~outbound),
+                                (Flags.DIRECTION_OUT, outbound)):
+            dir_ts, dir_idx = ts[mask], idx[mask]
+            for pipe in self.pipes[direction]:
+                dir_ts, dir_idx = pipe.apply(trace, dir_ts, dir_idx, rng)
+            results_ts.append(dir_ts)
+            results_idx.append(dir_idx)
+        out_ts = np.concatenate(results_ts) + base
+        out_idx = np.concatenate(results_idx)
+        order = np.argsort(out_ts, kind='mergesort')
+        return list(trace.packets(out_ts[order], out_idx[order]))
+
+    def stats(self):
+        """
+        Statistics of the last run, per pipe counters of each direction
+        """
+        result = {}
+        for direction, name in ((Flags.DIRECTION_IN, 'in'), (Flags.DIRECTION_OUT, 'out')):
+            pipes = []
+            for pipe in self.pipes[direction]:
+                pipe_stats = pipe.stats.snapshot()
+                pipe_stats['pipe'] = pipe.pipe_name
+                pipes.append(pipe_stats)
+            result[name] = {'pipes': pipes}
+        return result
+
+    def replay(self, in_file, out_file):
+        """
+        Emulate on packets from in_file, and save the result into out_file
+        :return: number of packets written
+        """
+        packets = self.run(PacketTrace.from_pcap(in_file))
+        with PcapWriter(out_file) as writer:
+            for ts, ip_data in packets:
+                writer.write(ts, ip_data)
+        return len(packets)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 4:
+        print 'Usage: python replay.py <config.json> <input.pcap> <output.pcap> [seed]'
+        exit(-1)
+
+    with open(sys.argv[1], 'r') as fid:
+        conf = resolve_profiles(json.loads(fid.read()), os.path.dirname(sys.argv[1]))
+    seed = int(sys.argv[4]) if len(sys.argv) > 4 else None
+    emulator = ReplayEmulator(seed=seed).load_config(conf)
+    print 'Write %d packets.' % emulator.replay(sys.argv[2], sys.argv[3])
@@ -0,0 +1,203 @@
+# encoding: utf8
+
+import time
+import select
+import threading
+import psutil
+
+__author__ = 'huangyan13@baidu.com'
+
+
+class ProcessResolver(object):
+    """
+    Keep the PIDs of processes whose names contain any of the given names.
+    A PID to name index is kept between scans, so each scan only lists PIDs
+    and looks up names of processes started since the last one. Children of
+    matched processes are matched too. On Mac OS matched processes are also
+    watched with kqueue, so that fork, exec and exit trigger a scan at once.
+    """
+
+    def __init__(self, names, pids=(), callback=None, interval=0.2, children=True):
+        """
+        :param names: process names to match, case insensitive substrings
+        :param pids: PIDs which are always included
+        :param callback: called with the sorted PID list whenever it changes,
+                         from the background thread if started
+        :param interval: seconds between scans
+        :param children: also match processes whose parent is matched
+        """
+        self.names = [name.lower() for name in names]
+        self.fixed_pids = set(pids)
+        self.callback = callback
+        self.interval = interval
+        self.children = children
+        # PID to lower case name of all processes seen
+        self.index = {}
+        self.matched = set()
+        # unmatched PIDs first seen by last scan
+        self._recent = set()
+        # names which matched at least one process
+        self.found = set()
+        self.num_scans = 0
+        self.num_lookups = 0
+        self._cond = threading.Condition()
+        self._quit = False
+        self.thread = None
+        self._kqueue = None
+        if hasattr(select, 'kqueue'):
+            self._kqueue = select.kqueue()
+
+    @property
+    def pid_list(self):
+        return sorted(self.fixed_pids | self.matched)
+
+    @property
+    def all_found(self):
+        """
+        :return: True if every name matched at least one process
+        """
+        return len(self.found) == len(set(self.names))
+
+    def _match(self, proc_name):
+        for name in self.names:
+            if name in proc_name:
+                return name
+        return None
+
+    def _lookup(self, pid):
+        self.num_lookups += 1
+        try:
+            proc = psutil.Process(pid)
+            return proc.name().lower(), (proc.ppid() if self.children else None)
+        except psutil.Error:
+            return None, None
+
+    def _watch(self, pid):
+        if self._kqueue is None:
+            return
+        event = select.kevent(pid, filter=select.KQ_FILTER_PROC, flags=select.KQ_EV_ADD,
+                              fflags=select.KQ_NOTE_EXIT | select.KQ_NOTE_FORK | select.KQ_NOTE_EXEC)
+        try:
+            self._kqueue.control([event], 0)
+        except OSError:
+            # process exited already
+            pass
+
+    def scan(self):
+        """
+        Update the index from one listing of PIDs
+        :return: True if the matched PIDs changed
+        """
+        self.num_scans += 1
+        current = set(psutil.pids())
+        index = self.index
+        changed = False
+        for pid in list(index):
+            if pid not in current:
+                del index[pid]
+                if pid in self.matched:
+                    self.matched.discard(pid)
+                    changed = True
+        # a process seen between fork and exec still has the name of its
+        # parent, so new processes are looked up once more by next scan
+        recheck = self._recent & current
+        self._recent = set()
+        # parents are usually older, so they are resolved first
+        for pid in sorted(current.difference(index) | recheck):
+            proc_name, ppid = self._lookup(pid)
+            if proc_name is None:
+                continue
+            is_new = pid not in index
+            index[pid] = proc_name
+            name = self._match(proc_name)
+            if name is not None:
+                self.found.add(name)
+            elif ppid not in self.matched:
+                if is_new:
+                    self._recent.add(pid)
+                continue
+            self.matched.add(pid)
+            self._watch(pid)
+            changed = True
+        return changed
+
+    def refresh(self, pid):
+        """
+        Look up a matched process again after it called exec,
+        since it may run another program now
+        :return: True if the matched PIDs changed
+        """
+        proc_name, ppid = self._lookup(pid)
+        if proc_name is None:
+            return False
+        self.index[pid] = proc_name
+        if self._match(proc_name) is None and ppid not in self.matched and pid in self.matched:
+            self.matched.discard(pid)
+            return True
+        return False
+
+    def _wait_event(self):
+        """
+        Sleep until next scan, or until a watched process changes
+        """
+        if self._kqueue is None:
+            with self._cond:
+                if not self._quit:
+                    self._cond.wait(self.interval)
+            return ()
+        events = self._kqueue.control(None, 64, self.interval)
+        return [event.ident for event in events if event.fflags & select.KQ_NOTE_EXEC]
+
+    def _notify(self):
+        if self.callback is not None:
+            self.callback(self.pid_list)
+        # wake up wait_all()
+        with self._cond:
+            self._cond.notify_all()
+
+    def _loop(self):
+        while not self._quit:
+            changed = False
+            for pid in self._wait_event():
+                changed |= self.refresh(pid)
+            if self._quit:
+                break
+            changed |= self.scan()
+            if changed:
+                self._notify()
+
+    def start(self):
+        """
+        Scan once, and keep scanning in a background thread
+        """
+        if self.scan():
+            self._notify()
+        self._quit = False
+        self.thread = threading.Thread(target=self._loop)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self._quit = True
+        with self._cond:
+            self._cond.notify_all()
+        thread, self.thread = self.thread, None
+        if thread is not None and thread is not threading.current_thread():
+            thread.join()
+        kq, self._kqueue = self._kqueue, None
+        if kq is not None:
+            kq.close()
+
+    def wait_all(self, timeout=None):
+        """
+        Scan until every name matched a process
+        :return: True if all names are found
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        while not self.all_found and not self._quit:
+            if deadline is not None and time.time() >= deadline:
+                break
+            with self._cond:
+                self._cond.wait(self.interval)
+        return self.all_found
@@ -0,0 +1,227 @@
+# encoding: utf8
+
+import os
+import time
+import errno
+import fcntl
+import Queue
+import select
+from enum import Defaults
+
+__author__ = 'huangyan13@baidu.com'
+
+
+class BatchQueue(Queue.Queue):
+    """
+    Queue.Queue which could also hand out packets in batches
+    """
+
+    def get_batch(self, max_n, timeout=None):
+        """
+        Take at most max_n items while holding the queue lock only once
+        :return: list of items, empty if timeout
+        """
+        with self.not_empty:
+            if timeout is None:
+                while not self.queue:
+                    self.not_empty.wait()
+            else:
+                end_time = time.time() + timeout
+                while not self.queue:
+                    remaining = end_time - time.time()
+                    if remaining <= 0.0:
+                        break
+                    self.not_empty.wait(remaining)
+            popleft = self.queue.popleft
+            batch = [popleft() for _ in xrange(min(max_n, len(self.queue)))]
+            if batch:
+                self.not_full.notify()
+        return batch
+
+
+class RingQueue(object):
+    """
+    Bounded single-producer/single-consumer ring buffer without locks.
+    The producer only moves the tail and the consumer only moves the head,
+    each single assignment is atomic under the GIL. An empty consumer sleeps
+    on a pipe, which is written by the producer only when someone is waiting.
+    A producer blocked on a full ring gives up and drops its item once the
+    ring is shut down or closed.
+    """
+    # how long the producer backs off when the ring is full
+    FULL_BACKOFF = 0.0001
+
+    def __init__(self, capacity=Defaults.RING_CAPACITY):
+        # round capacity up to power of two, so that index is a cheap mask
+        size = 1
+        while size < capacity:
+            size <<= 1
+        self.capacity = size
+        self._mask = size - 1
+        self._buf = [None] * size
+        self._head = 0
+        self._tail = 0
+        self._waiting = False
+        self._interrupted = False
+        # set by shutdown() or close(), never cleared by the consumer
+        self.closed = False
+        # number of times the producer found the ring full
+        self.num_full = 0
+        # number of items dropped because the ring is closed while full
+        self.num_dropped = 0
+        self._rfd, self._wfd = os.pipe()
+        for fd in (self._rfd, self._wfd):
+            fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+
+    def __del__(self):
+        self.close()
+
+    def close(self):
+        """
+        Shut down the ring and release its pipe, items already in the ring
+        could still be read without blocking
+        """
+        self.closed = True
+        if self._rfd is not None:
+            os.close(self._rfd)
+            os.close(self._wfd)
+            self._rfd = self._wfd = None
+
+    def fileno(self):
+        """
+        :return: file descriptor which becomes readable when packets arrive while waiting
+        """
+        return self._rfd
+
+    def qsize(self):
+        return self._tail - self._head
+
+    def empty(self):
+        return self._tail == self._head
+
+    def _notify(self):
+        wfd = self._wfd
+        if wfd is None:
+            return
+        try:
+            os.write(wfd, '\0')
+        except OSError as e:
+            # pipe already full of wakeups, the consumer would wake anyway
+            if e.errno != errno.EAGAIN:
+                raise
+
+    def drain(self):
+        """
+        Consume all pending wakeups from the pipe
+        """
+        rfd = self._rfd
+        if rfd is None:
+            return
+        try:
+            while os.read(rfd, 4096):
+                pass
+        except OSError as e:
+            if e.errno != errno.EAGAIN:
+                raise
+
+    def put(self, item, block=True):
+        """
+        Only the single producer thread should call this.
+        Raise Queue.Full if the ring is full and closed, the item is dropped.
+        """
+        if self._tail - self._head >= self.capacity:
+            if not block:
+                raise Queue.Full
+            # apply back pressure on the producer until consumer catches up
+            self.num_full += 1
+            while self._tail - self._head >= self.capacity:
+                if self.closed:
+                    # nobody would make room any more
+                    self.num_dropped += 1
+                    raise Queue.Full
+                time.sleep(self.FULL_BACKOFF)
+        self._buf[self._tail & self._mask] = item
+        self._tail += 1
+        if self._waiting:
+            # one wakeup is enough until the consumer waits again
+            self._waiting = False
+            self._notify()
+
+    def arm(self):
+        """
+        Ask the producer to wake up fileno() on next put, used by event loops.
+        :return: True if ring is not empty, then the caller should read again
+        """
+        self._waiting = True
+        return self._tail != self._head
+
+    def interrupt(self):
+        """
+        Wake up a blocking consumer, which would raise Queue.Empty if nothing to read
+        """
+        self._interrupted = True
+        self._notify()
+
+    def shutdown(self):
+        """
+        Stop waiting for the consumer, a producer blocked on full ring drops
+        its item, and wake up a blocking consumer like interrupt()
+        """
+        self.closed = True
+        self.interrupt()
+
+    def _wait(self, timeout):
+        """
+        Wait until ring is not empty, interrupted or timeout
+        :return: True if ring is not empty
+        """
+        end_time = None if timeout is None else time.time() + timeout
+        while self._tail == self._head:
+            if self._rfd is None:
+                # the ring is closed, nothing would be put any more
+                return False
+            if self._interrupted:
+                self._interrupted = False
+                return False
+            remaining = None
+            if end_time is not None:
+                remaining = end_time - time.time()
+                if remaining <= 0.0:
+                    return False
+            self._waiting = True
+            # check again, the producer may put an item before we set the flag
+            if self._tail == self._head:
+                select.select([self._rfd], [], [], remaining)
+                self.drain()
+            self._waiting = False
+        return True
+
+    def get(self, block=True, timeout=None):
+        """
+        Only the single consumer thread should call this
+        """
+        if self._tail == self._head:
+            if not block or not self._wait(timeout):
+                raise Queue.Empty
+        pos = self._head & self._mask
+        item = self._buf[pos]
+        self._buf[pos] = None
+        self._head += 1
+        return item
+
+    def get_batch(self, max_n, timeout=None):
+        """
+        Take at most max_n items at once
+        :return: list of items, empty if timeout or interrupted
+        """
+        if self._tail == self._head and not self._wait(timeout):
+            return []
+        head = self._head
+        num = min(max_n, self._tail - head)
+        buf, mask = self._buf, self._mask
+        batch = []
+        for i in xrange(head, head + num):
+            batch.append(buf[i & mask])
+            buf[i & mask] = None
+        self._head = head + num
+        return batch
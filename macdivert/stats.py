@@ -0,0 +1,170 @@
+# encoding: utf8
+
+__author__ = 'huangyan13@baidu.com'
+
+
+class LogHistogram(object):
+    """
+    Histogram of non-negative integers with logarithmic buckets like HdrHistogram.
+    Each power of two is split into 2 ** sub_bits linear buckets, so that
+    recorded values keep a relative precision of 2 ** -sub_bits with a
+    fixed number of buckets for the whole 64 bits range.
+    """
+    __slots__ = ('sub_bits', 'sub_count', 'counts', 'count', 'total', 'min', 'max')
+
+    def __init__(self, sub_bits=3):
+        self.sub_bits = sub_bits
+        self.sub_count = 1 << sub_bits
+        self.counts = [0] * ((64 - sub_bits) << sub_bits)
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = None
+
+    def bucket(self, value):
+        # values below 2 * sub_count are exact
+        if value < 2 * self.sub_count:
+            return value
+        shift = value.bit_length() - self.sub_bits - 1
+        return (shift << self.sub_bits) + (value >> shift)
+
+    def lower_bound(self, index):
+        """
+        :return: the smallest value which falls into bucket index
+        """
+        if index < 2 * self.sub_count:
+            return index
+        shift = (index >> self.sub_bits) - 1
+        return (index - (shift << self.sub_bits)) << shift
+
+    def record(self, value):
+        value = int(value)
+        if value < 0:
+            return
+        self.counts[self.bucket(value)] += 1
+        self.count += 1
+        self.total += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def record_array(self, values):
+        """
+        Record all values of a NumPy array at once
+        """
+        import numpy as np
+        values = np.asarray(values, dtype=np.int64)
+        values = values[values >= 0]
+        if len(values) == 0:
+            return
+        # exponent of frexp is the bit length of integers
+        _, exp = np.frexp(values.astype(np.float64))
+        shift = np.maximum(exp.astype(np.int64) - self.sub_bits - 1, 0)
+        index = (shift << self.sub_bits) + (values >> shift)
+        for pos, num in zip(*[arr.tolist() for arr in np.unique(index, return_counts=True)]):
+            self.counts[pos] += num
+        self.count += len(values)
+        self.total += int(values.sum())
+        low, high = int(values.min()), int(values.max())
+        self.min = low if self.min is None else min(self.min, low)
+        self.max = high if self.max is None else max(self.max, high)
+
+    def merge(self, other):
+        if other.sub_bits != self.sub_bits:
+            raise RuntimeError('Histograms with different precision')
+        for index, num in enumerate(other.counts):
+            if num:
+                self.counts[index] += num
+        self.count += other.count
+        self.total += other.total
+        for value in (other.min, other.max):
+            if value is not None:
+                self.min = value if self.min is None else min(self.min, value)
+                self.max = value if self.max is None else max(self.max, value)
+
+    def percentile(self, percent):
+        """
+        :return: lower bound of the bucket which holds the given percentile
+        """
+        if self.count == 0:
+            return None
+        rank = max(1, int(round(self.count * percent / 100.)))
+        seen = 0
+        for index, num in enumerate(self.counts):
+            seen += num
+            if seen >= rank:
+                return min(max(self.lower_bound(index), self.min), self.max)
+        return self.max
+
+    def reset(self):
+        self.counts = [0] * len(self.counts)
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = None
+
+    def snapshot(self):
+        result = {
+            'count': self.count,
+            'min': self.min,
+            'max': self.max,
+            'mean': float(self.total) / self.count if self.count else None,
+        }
+        for percent in (50, 90, 99, 99.9):
+            result['p%g' % percent] = self.percentile(percent)
+        return result
+
+
+class PipeStats(object):
+    """
+    Runtime counters of a single pipe
+    """
+    __slots__ = ('queue_size', 'packets_in', 'packets_out', 'dropped', 'duplicated',
+                 'queue_len', 'queue_peak', 'delay')
+
+    def __init__(self, queue_size=None):
+        """
+        :param queue_size: capacity of the pipe queue, None if it has no queue
+        """
+        self.queue_size = queue_size
+        self.packets_in = 0
+        self.packets_out = 0
+        self.dropped = 0
+        self.duplicated = 0
+        self.queue_len = 0
+        self.queue_peak = 0
+        # applied delay of packets, in microseconds
+        self.delay = LogHistogram()
+
+    def reset(self):
+        self.__init__(self.queue_size)
+
+    def snapshot(self):
+        result = {
+            'queue_size': self.queue_size,
+            'packets_in': self.packets_in,
+            'packets_out': self.packets_out,
+            'dropped': self.dropped,
+            'duplicated': self.duplicated,
+            'queue_len': self.queue_len,
+            'queue_peak': self.queue_peak,
+            'delay_us': self.delay.snapshot(),
+            'counters': True,
+        }
+        if self.queue_size:
+            result['queue_usage'] = float(self.queue_peak) / self.queue_size
+        return result
+
+    @classmethod
+    def unavailable(cls, queue_size=None):
+        """
+        Snapshot with the same keys for a pipe which keeps no counters,
+        every counter is None and 'counters' is False
+        """
+        result = cls(queue_size).snapshot()
+        for key in result:
+            if key != 'queue_size':
+                result[key] = None
+        result['counters'] = False
+        return result
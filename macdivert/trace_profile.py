@@ -0,0 +1,461 @@
+# encoding: utf8
+
+import os
+import sys
+import json
+import socket
+import struct
+import bisect
+import numpy as np
+from pcap import PcapReader
+
+__author__ = 'huangyan13@baidu.com'
+
+
+class Flags(object):
+    # direction flags, same values as emulator.Flags
+    DIRECTION_IN = 0
+    DIRECTION_OUT = 1
+
+    # TCP flags
+    TCP_FIN = 0x01
+    TCP_SYN = 0x02
+    TCP_ACK = 0x10
+
+    IPPROTO_TCP = 6
+
+    # bytes of each packet kept for header decoding, enough for
+    # IP header with options and the fixed part of TCP header
+    HEADER_SIZE = 80
+
+
+class _FlowState(object):
+    """
+    Per-flow state carried from one chunk to the next
+    """
+    __slots__ = ('isn', 'max_end', 'holes', 'last_ts', 'seg_end', 'seg_ts', 'acked', 'retx')
+
+    def __init__(self):
+        # initial sequence number of each direction
+        self.isn = [None, None]
+        # highest relative sequence end seen
+        self.max_end = [-1, -1]
+        # ranges skipped below the highest sequence end, sorted
+        # (end, start, ts) tuples where ts is when the range was skipped
+        self.holes = [[], []]
+        # time of the last packet, for expiry of idle flows
+        self.last_ts = 0.
+        # outbound segments not acknowledged yet, used for RTT samples
+        self.seg_end = np.zeros(0, dtype=np.int64)
+        self.seg_ts = np.zeros(0, dtype=np.float64)
+        # highest relative ACK of outbound data
+        self.acked = -1
+        # outbound (start, end, ts) ranges retransmitted but not acknowledged yet
+        self.retx = []
+
+
+class WindowStats(object):
+    """
+    Per-window accumulators of one direction, which grow with capture duration only
+    """
+
+    def __init__(self):
+        self.bytes = np.zeros(0)
+        self.segments = np.zeros(0)
+        self.lost = np.zeros(0)
+        self.reordered = np.zeros(0)
+
+    @staticmethod
+    def _add(acc, win, weights=None):
+        counts = np.bincount(win, weights=weights)
+        if len(counts) > len(acc):
+            acc = np.concatenate([acc, np.zeros(len(counts) - len(acc))])
+        acc[:len(counts)] += counts
+        return acc
+
+    def add(self, name, win, weights=None):
+        if len(win):
+            setattr(self, name, self._add(getattr(self, name), win, weights))
+
+
+class TraceProfiler(object):
+    """
+    Derive pipe schedules from a captured pcap. Packets are read in chunks
+    and header fields of each chunk are decoded with NumPy, so that memory
+    usage depends on the number of windows and active flows, not on the
+    size of capture. For each window it estimates:
+        RTT         outbound TCP segments (including SYN) to their first ACK,
+                    retransmitted segments are skipped
+        goodput     IP bytes per direction, without TCP retransmissions
+        loss        TCP segments filling a sequence hole later than reorder_time
+                    after the hole was seen, or repeating data already seen
+        reordering  TCP segments filling a sequence hole within reorder_time
+    State of flows idle for flow_timeout is dropped, and at most MAX_FLOWS
+    flows are tracked.
+    """
+    # keep at most so many outstanding segments per flow for RTT matching
+    MAX_OUTSTANDING = 4096
+    # keep at most so many sequence holes per flow and direction
+    MAX_HOLES = 1024
+    # least recently active flows are dropped beyond this
+    MAX_FLOWS = 65536
+
+    def __init__(self, window=1.0, local_addrs=None, chunk_size=65536,
+                 reorder_time=0.005, base_rtt=0.0, flow_timeout=300.0):
+        """
+        :param window: length of each schedule step in seconds
+        :param local_addrs: addresses of the capturing host,
+                            default to the source address of first packet
+        :param chunk_size: number of packets decoded at once
+        :param reorder_time: out-of-order segments within this time are reordered,
+                             later ones are counted as loss
+        :param base_rtt: RTT of the emulation network, subtracted from samples
+        :param flow_timeout: seconds of capture time without packets before
+                             the state of a flow is dropped
+        """
+        self.window = float(window)
+        self.local_addrs = None
+        if local_addrs:
+            self.local_addrs = np.array([struct.unpack('!I', socket.inet_aton(addr))[0]
+                                         for addr in local_addrs], dtype=np.uint32)
+        self.chunk_size = chunk_size
+        self.reorder_time = reorder_time
+        self.base_rtt = base_rtt
+        self.flow_timeout = flow_timeout
+        self.start_ts = None
+        self.stats = [WindowStats(), WindowStats()]
+        self.rtt_sum = np.zeros(0)
+        self.rtt_num = np.zeros(0)
+        self._flows = {}
+        self.num_packets = 0
+
+    def _chunks(self, filename):
+        with PcapReader(filename) as reader:
+            ts_list, headers, sizes = [], [], []
+            for ts, ip_data in reader:
+                ts_list.append(ts)
+                sizes.append(len(ip_data))
+                headers.append(ip_data[0:Flags.HEADER_SIZE].ljust(Flags.HEADER_SIZE, '\0'))
+                if len(ts_list) >= self.chunk_size:
+                    yield ts_list, headers, sizes
+                    ts_list, headers, sizes = [], [], []
+            if ts_list:
+                yield ts_list, headers, sizes
+
+    @staticmethod
+    def _be32(raw, rows, cols):
+        """
+        Big endian 32 bits integers at byte offset cols of each row
+        """
+        return ((raw[rows, cols].astype(np.int64) << 24) | (raw[rows, cols + 1].astype(np.int64) << 16) |
+                (raw[rows, cols + 2].astype(np.int64) << 8) | raw[rows, cols + 3])
+
+    def _decode(self, ts_list, headers, sizes):
+        raw = np.frombuffer(''.join(headers), dtype=np.uint8).reshape(-1, Flags.HEADER_SIZE)
+        rows = np.arange(len(raw))
+        fields = {
+            'ts': np.array(ts_list, dtype=np.float64),
+            'size': np.array(sizes, dtype=np.int64),
+            'proto': raw[:, 9],
+            'src': self._be32(raw, rows, 12),
+            'dst': self._be32(raw, rows, 16),
+        }
+        ihl = (raw[:, 0] & 0x0f).astype(np.int64) * 4
+        total_len = (raw[:, 2].astype(np.int64) << 8) | raw[:, 3]
+        is_tcp = (fields['proto'] == Flags.IPPROTO_TCP) & (ihl >= 20) & (ihl <= 60)
+        ihl = np.where(is_tcp, ihl, 20)
+        fields['is_tcp'] = is_tcp
+        fields['sport'] = (raw[rows, ihl].astype(np.int64) << 8) | raw[rows, ihl + 1]
+        fields['dport'] = (raw[rows, ihl + 2].astype(np.int64) << 8) | raw[rows, ihl + 3]
+        fields['seq'] = self._be32(raw, rows, ihl + 4)
+        fields['ack'] = self._be32(raw, rows, ihl + 8)
+        doff = (raw[rows, ihl + 12] >> 4).astype(np.int64) * 4
+        flags = raw[rows, ihl + 13]
+        fields['flags'] = flags
+        # SYN and FIN consume one sequence number
+        fields['seg_len'] = np.maximum(total_len - ihl - doff, 0) + \
+            ((flags & (Flags.TCP_SYN | Flags.TCP_FIN)) != 0)
+        return fields
+
+    def process_file(self, filename):
+        for chunk in self._chunks(filename):
+            self.process_chunk(self._decode(*chunk))
+        return self
+
+    def process_chunk(self, f):
+        n = len(f['ts'])
+        if n == 0:
+            return
+        if self.start_ts is None:
+            self.start_ts = f['ts'][0]
+            if self.local_addrs is None:
+                self.local_addrs = f['src'][0:1].astype(np.uint32)
+        self.num_packets += n
+        win = np.maximum(np.floor((f['ts'] - self.start_ts) / self.window), 0).astype(np.int64)
+        outbound = np.in1d(f['src'].astype(np.uint32), self.local_addrs)
+        # lost and reordered segments found by the flow pass
+        retrans = np.zeros(n, dtype=bool)
+        reordered = np.zeros(n, dtype=bool)
+        is_tcp = f['is_tcp']
+        tcp_idx = np.flatnonzero(is_tcp)
+        if len(tcp_idx):
+            self._process_tcp(f, tcp_idx, outbound, win, retrans, reordered)
+        for direction, mask in ((Flags.DIRECTION_IN, ~outbound), (Flags.DIRECTION_OUT, outbound)):
+            stats = self.stats[direction]
+            good = mask & ~retrans
+            stats.add('bytes', win[good], f['size'][good])
+            data = mask & is_tcp & (f['seg_len'] > 0)
+            stats.add('segments', win[data])
+            stats.add('lost', win[data & retrans])
+            stats.add('reordered', win[data & reordered])
+        self._expire_flows(float(f['ts'][-1]))
+
+    def _expire_flows(self, now):
+        """
+        Drop state of idle flows, and of least recently active flows
+        if there are still too many
+        """
+        deadline = now - self.flow_timeout
+        flows = self._flows
+        for key in [key for key, state in flows.iteritems() if state.last_ts < deadline]:
+            del flows[key]
+        if len(flows) > self.MAX_FLOWS:
+            by_age = sorted(flows.iteritems(), key=lambda item: item[1].last_ts)
+            for key, _ in by_age[:len(flows) - self.MAX_FLOWS]:
+                del flows[key]
+
+    def _process_tcp(self, f, tcp_idx, outbound, win, retrans, reordered):
+        # direction independent flow key, local endpoint first
+        local_addr = np.where(outbound, f['src'], f['dst'])[tcp_idx]
+        remote_addr = np.where(outbound, f['dst'], f['src'])[tcp_idx]
+        local_port = np.where(outbound, f['sport'], f['dport'])[tcp_idx]
+        remote_port = np.where(outbound, f['dport'], f['sport'])[tcp_idx]
+        key = np.rec.fromarrays([local_addr, remote_addr, local_port, remote_port])
+        flow_keys, flow_ids = np.unique(key, return_inverse=True)
+        # stable sort keeps packets of each flow in time order
+        order = np.argsort(flow_ids, kind='mergesort')
+        bounds = np.searchsorted(flow_ids[order], np.arange(len(flow_keys) + 1))
+        for i, flow_key in enumerate(flow_keys.tolist()):
+            rows = tcp_idx[order[bounds[i]:bounds[i + 1]]]
+            state = self._flows.get(flow_key)
+            if state is None:
+                state = self._flows[flow_key] = _FlowState()
+            state.last_ts = float(f['ts'][rows[-1]])
+            for direction in (Flags.DIRECTION_IN, Flags.DIRECTION_OUT):
+                mask = outbound[rows] if direction == Flags.DIRECTION_OUT else ~outbound[rows]
+                self._sequence(f, rows[mask], state, direction, retrans, reordered)
+            self._rtt(f, rows, outbound[rows], state, retrans, win)
+
+    def _relative(self, seq, state, direction):
+        if state.isn[direction] is None:
+            state.isn[direction] = int(seq[0])
+        return (seq - state.isn[direction]) % (1 << 32)
+
+    def _sequence(self, f, rows, state, direction, retrans, reordered):
+        rows = rows[f['seg_len'][rows] > 0]
+        if len(rows) == 0:
+            return
+        ts = f['ts'][rows]
+        start = self._relative(f['seq'][rows], state, direction)
+        end = start + f['seg_len'][rows]
+        # highest sequence end before each segment, carried over chunks
+        prev_max = np.maximum.accumulate(np.concatenate([[state.max_end[direction]], end]))[:-1]
+        # segments jumping over missing data open a hole at their arrival
+        gap_pos = np.flatnonzero((start > prev_max) & (prev_max >= 0))
+        new_holes = zip(gap_pos.tolist(), start[gap_pos].tolist(),
+                        prev_max[gap_pos].tolist(), ts[gap_pos].tolist())
+        holes = state.holes[direction]
+        num_added = 0
+        # segments behind the highest sequence are rare, check them one by one
+        for pos in np.flatnonzero(start < prev_max).tolist():
+            while num_added < len(new_holes) and new_holes[num_added][0] < pos:
+                holes.append(new_holes[num_added][1:])
+                num_added += 1
+            hole_ts = self._fill_holes(holes, int(start[pos]), int(end[pos]))
+            if hole_ts is not None and ts[pos] - hole_ts <= self.reorder_time:
+                reordered[rows[pos]] = True
+            else:
+                # late for the hole, or data already seen
+                retrans[rows[pos]] = True
+        holes.extend(hole[1:] for hole in new_holes[num_added:])
+        if len(holes) > self.MAX_HOLES:
+            # the lowest holes would hardly be filled any more
+            del holes[:len(holes) - self.MAX_HOLES]
+        state.max_end[direction] = int(max(prev_max[-1], end[-1]))
+
+    @staticmethod
+    def _fill_holes(holes, start, end):
+        """
+        Remove range [start, end) from sorted holes
+        :return: time when the earliest hole overlapped was seen, None if no overlap
+        """
+        # first hole which ends after start
+        i = bisect.bisect_right(holes, (start, float('inf')))
+        first_ts = None
+        while i < len(holes) and holes[i][1] < end:
+            hole_end, hole_start, hole_ts = holes[i]
+            if first_ts is None or hole_ts < first_ts:
+                first_ts = hole_ts
+            rest = []
+            if hole_start < start:
+                rest.append((start, hole_start, hole_ts))
+            if end < hole_end:
+                rest.append((hole_end, end, hole_ts))
+            holes[i:i + 1] = rest
+            i += len(rest)
+        return first_ts
+
+    def _rtt(self, f, rows, outbound, state, retrans, win):
+        """
+        Match outbound segments with inbound ACKs, by Karn's algorithm:
+        ACKs which cover a retransmitted range give no sample
+        """
+        sent = outbound & (f['seg_len'][rows] > 0)
+        out_rows = rows[sent & ~retrans[rows]]
+        if len(out_rows):
+            start = self._relative(f['seq'][out_rows], state, Flags.DIRECTION_OUT)
+            end = start + f['seg_len'][out_rows]
+            state.seg_end = np.concatenate([state.seg_end, end])
+            state.seg_ts = np.concatenate([state.seg_ts, f['ts'][out_rows]])
+        retx_rows = rows[sent & retrans[rows]]
+        if len(retx_rows):
+            start = self._relative(f['seq'][retx_rows], state, Flags.DIRECTION_OUT)
+            end = start + f['seg_len'][retx_rows]
+            state.retx.extend(zip(start.tolist(), end.tolist(), f['ts'][retx_rows].tolist()))
+            if len(state.retx) > self.MAX_OUTSTANDING:
+                del state.retx[:len(state.retx) - self.MAX_OUTSTANDING]
+        in_rows = rows[~outbound & ((f['flags'][rows] & Flags.TCP_ACK) != 0)]
+        if len(in_rows) == 0 or state.isn[Flags.DIRECTION_OUT] is None:
+            return
+        ack = (f['ack'][in_rows] - state.isn[Flags.DIRECTION_OUT]) % (1 << 32)
+        ack_ts = f['ts'][in_rows]
+        # highest ACK before each one, ACKs only count data above it
+        prev_ack = np.maximum.accumulate(np.concatenate([[state.acked], ack]))[:-1]
+        state.acked = int(max(prev_ack[-1], ack[-1]))
+        ambiguous = np.zeros(len(ack), dtype=bool)
+        if state.retx:
+            # retransmissions are rare, check the ranges one by one
+            for retx_start, retx_end, retx_ts in state.retx:
+                ambiguous |= (ack_ts >= retx_ts) & (ack > retx_start) & (prev_ack < retx_end)
+            state.retx = [rng for rng in state.retx if rng[1] > state.acked]
+        if len(state.seg_end) == 0:
+            return
+        # segments are mostly in order, keep them sorted for binary search
+        sort = np.argsort(state.seg_end, kind='mergesort')
+        seg_end, seg_ts = state.seg_end[sort], state.seg_ts[sort]
+        pos = np.searchsorted(seg_end, ack, side='right') - 1
+        prev = np.maximum.accumulate(np.concatenate([[-1], pos]))[:-1]
+        new_ack = (pos > prev) & (pos >= 0)
+        sample = ack_ts - seg_ts[np.maximum(pos, 0)]
+        valid = new_ack & (sample >= 0) & ~ambiguous
+        ack_win = win[in_rows][valid]
+        if len(ack_win):
+            self.rtt_sum = WindowStats._add(self.rtt_sum, ack_win, sample[valid])
+            self.rtt_num = WindowStats._add(self.rtt_num, ack_win)
+        acked = int(max(prev[-1], pos[-1]))
+        # drop acknowledged segments, and bound the outstanding ones
+        keep = slice(acked + 1, None)
+        state.seg_end, state.seg_ts = seg_end[keep], seg_ts[keep]
+        if len(state.seg_end) > self.MAX_OUTSTANDING:
+            state.seg_end = state.seg_end[-self.MAX_OUTSTANDING:]
+            state.seg_ts = state.seg_ts[-self.MAX_OUTSTANDING:]
+
+    @property
+    def num_windows(self):
+        return max([len(self.rtt_num)] +
+                   [len(getattr(stats, name)) for stats in self.stats
+                    for name in ('bytes', 'segments')])
+
+    @staticmethod
+    def _fill(values, valid, default=0.):
+        """
+        Carry the last valid value forward over windows without samples,
+        leading gaps take the first valid value
+        """
+        values = np.asarray(values, dtype=np.float64)
+        if not valid.any():
+            return np.full(len(values), default)
+        pos = np.maximum.accumulate(np.where(valid, np.arange(len(values)), -1))
+        pos[pos < 0] = np.flatnonzero(valid)[0]
+        return values[pos]
+
+    def _padded(self, values):
+        result = np.zeros(self.num_windows)
+        result[:len(values)] = values
+        return result
+
+    def schedules(self):
+        """
+        :return: dict of arrays, one value per window, and t with an extra
+                 point at the end, so that the period equals the capture length
+        """
+        n = self.num_windows
+        result = {'t': np.arange(n + 1) * self.window}
+        rtt_num = self._padded(self.rtt_num)
+        rtt = self._padded(self.rtt_sum) / np.maximum(rtt_num, 1)
+        rtt = np.maximum(self._fill(rtt, rtt_num > 0) - self.base_rtt, 0.)
+        for direction, name in ((Flags.DIRECTION_IN, 'in'), (Flags.DIRECTION_OUT, 'out')):
+            stats = self.stats[direction]
+            segments = self._padded(stats.segments)
+            data_bytes = self._padded(stats.bytes)
+            # idle windows say nothing about capacity, keep the last known one
+            bandwidth = self._fill(data_bytes / 1024. / self.window, data_bytes > 0)
+            has_data = segments > 0
+            result['delay_' + name] = rtt / 2.
+            result['bandwidth_' + name] = bandwidth
+            result['drop_' + name] = self._fill(
+                self._padded(stats.lost) / np.maximum(segments, 1), has_data)
+            result['disorder_' + name] = self._fill(
+                self._padded(stats.reordered) / np.maximum(segments, 1), has_data)
+        # the value at the extra last point is never used, repeat the last one
+        for name, values in result.items():
+            if name != 't':
+                result[name] = np.append(values, values[-1:])
+        return result
+
+    def config(self, profile_file=None, queue_size=1024, max_disorder=8):
+        """
+        Build pipe configurations for EmulatorGUI and ReplayEmulator
+        :param profile_file: save arrays into this .npz file and reference it,
+                             arrays are embedded into json if not set
+        :return: list of pipe configurations
+        """
+        sched = self.schedules()
+        if profile_file is not None:
+            np.savez(profile_file, **dict((name, values.astype(np.float32))
+                                          for name, values in sched.items()))
+            ref_name = os.path.basename(profile_file)
+            ref = lambda name: '%s:%s' % (ref_name, name)
+        else:
+            ref = lambda name: [round(x, 6) for x in sched[name].tolist()]
+        conf = []
+        for name in ('in', 'out'):
+            conf.append({'pipe': 'delay', 'direction': name, 't': ref('t'),
+                         'delay_time': ref('delay_' + name), 'queue_size': queue_size})
+            if sched['bandwidth_' + name].any():
+                conf.append({'pipe': 'bandwidth', 'direction': name, 't': ref('t'),
+                             'bandwidth': ref('bandwidth_' + name), 'queue_size': queue_size})
+            if sched['drop_' + name].any():
+                conf.append({'pipe': 'drop', 'direction': name, 't': ref('t'),
+                             'drop_rate': ref('drop_' + name)})
+            if sched['disorder_' + name].any():
+                conf.append({'pipe': 'disorder', 'direction': name, 't': ref('t'),
+                             'disorder_rate': ref('disorder_' + name),
+                             'queue_size': queue_size, 'max_disorder': max_disorder})
+        return conf
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 3:
+        print 'Usage: python trace_profile.py <input.pcap> <output.json> [window] [--binary]'
+        exit(-1)
+
+    window = float(sys.argv[3]) if len(sys.argv) > 3 and sys.argv[3] != '--binary' else 1.0
+    profiler = TraceProfiler(window=window).process_file(sys.argv[1])
+    out_file = sys.argv[2]
+    profile_file = None
+    if '--binary' in sys.argv[3:]:
+        profile_file = os.path.splitext(out_file)[0] + '.npz'
+    with open(out_file, 'w') as fid:
+        json.dump(profiler.config(profile_file), fid, indent=2)
+    print 'Processed %d packets in %d windows.' % (profiler.num_packets, profiler.num_windows)